@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+import signal
+import asyncio
+from datetime import datetime
+
+import http_transport
+
+# aiohttp is optional - without it the watchers fetch through the shared
+# requests transport in worker threads
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+##
+# asyncio runtime (config.yml RUNTIME: "asyncio")
+#
+# Runs the polling watchers, the orderbook fetcher, the grin51 history wait
+# and the control loop as tasks on one event loop instead of a thread each.
+# Watcher samples, detection scoring and order management are the same code
+# the threads runtime uses.  NiceHash calls stay on the signed, rate limited
+# requests client and run in worker threads so they never block the loop.
+# SIGINT / SIGTERM cancel every task, then the HTTP session and history
+# files are closed.  Live orders are left alone - the next start adopts them.
+
+SAMPLER_RECHECK = 1.0     # Seconds - how often a sleeping task looks for a shorter adaptive interval
+
+
+class AsyncRuntime():
+    def __init__(self, defender, logger):
+        self.defender = defender
+        self.logger = logger
+        self.config = defender.config
+        self.grin51 = defender.grin51
+        self.session = None
+        self.wake = None
+        self.loop = None
+        self.main_task = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def stop(self):
+        if self.main_task is not None:
+            self.main_task.cancel()
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        self.wake = asyncio.Event()
+        # Detection changes and config reloads can come from worker threads
+        self.defender.wake_listeners.append(lambda: self.loop.call_soon_threadsafe(self.wake.set))
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            try:
+                self.loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if aiohttp is not None:
+            connector = aiohttp.TCPConnector(limit_per_host=int(self.config.get("HTTP_POOL_SIZE", http_transport.DEFAULT_POOL_SIZE)))
+            self.session = aiohttp.ClientSession(connector=connector)
+        else:
+            self.logger.warning("aiohttp is not installed - asyncio runtime watchers will use worker threads for HTTP")
+
+        tasks = []
+        try:
+            await asyncio.to_thread(self.defender.startup)
+            history_tasks = []
+            for algo, grin51 in self.grin51.items():
+                for watcher in grin51.getPollingWatchers():
+                    tasks.append(asyncio.create_task(self.runWatcher(watcher), name="{}_{}".format(watcher.name, algo)))
+                history_tasks.append(asyncio.create_task(self.waitForHistory(grin51), name="grin51_history_{}".format(algo)))
+            tasks.extend(history_tasks)
+            tasks.append(asyncio.create_task(self.runOrderBook(), name="orderbook"))
+            # Like the threads runtime: no order management until detection has enough history
+            if len(history_tasks) > 0:
+                await asyncio.gather(*history_tasks)
+                self.logger.warning("Grin51 detection module is running")
+            tasks.append(asyncio.create_task(self.controlLoop(), name="control"))
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            self.logger.warning("Shutting down asyncio runtime")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.session is not None:
+                await self.session.close()
+            for grin51 in self.grin51.values():
+                if grin51.watchers is not None:
+                    grin51.close()
+            self.logger.warning("Asyncio runtime stopped")
+
+    # Sleep one polling interval - when a sampler is set, re-check its
+    # (possibly shrinking) interval every SAMPLER_RECHECK seconds
+    async def sleep(self, interval, sampler=None):
+        started = time.time()
+        while True:
+            if sampler is not None:
+                interval = sampler.getInterval()
+            remaining = started + interval - time.time()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(remaining, SAMPLER_RECHECK))
+
+    async def getJson(self, url):
+        timeout = http_transport.get_transport().getTimeout(url)
+        if self.session is None:
+            r = await asyncio.to_thread(http_transport.get_transport().get, url)
+            r.raise_for_status()
+            return r.json()
+        async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+            r.raise_for_status()
+            return await r.json(content_type=None)
+
+    async def runWatcher(self, watcher):
+        # Skip the first poll if a sample was just fetched (ex: during startup)
+        if watcher.isFresh():
+            await self.sleep(watcher.interval, watcher.sampler)
+        while True:
+            try:
+                if watcher.source is not None:
+                    # Every provider is fetched on the shared HTTP session
+                    value = await watcher.source.fetchAsync(self.getJson)
+                else:
+                    value = watcher.parse(await self.getJson(watcher.url))
+                watcher.notify(watcher.addSample(value))
+                watcher.recordFetch(True)
+            except Exception as e:
+                watcher.recordFetch(False)
+                self.logger.error("Error in Grin51::{} - {}".format(watcher.__class__.__name__, e))
+            await self.sleep(watcher.interval, watcher.sampler)
+
+    async def runOrderBook(self):
+        orderbook = self.defender.orderbook
+        if orderbook.isFresh():
+            await self.sleep(orderbook.interval, orderbook.sampler)
+        while True:
+            await asyncio.to_thread(orderbook.refreshAll)
+            await self.sleep(orderbook.interval, orderbook.sampler)
+
+    # Wait until there is enough history, then start scoring
+    async def waitForHistory(self, grin51):
+        last_sz = None
+        while True:
+            sz = grin51.getHistorySize()
+            if sz >= grin51.min_history:
+                break
+            if sz != last_sz:
+                self.logger.warning("Waiting for more {} data history. Status: {} of {}".format(grin51.algo, sz, grin51.min_history))
+                last_sz = sz
+            await asyncio.sleep(5)
+        grin51.scheduler.enable()
+        self.logger.warning("Grin51 {} detection is running".format(grin51.algo))
+
+    async def controlLoop(self):
+        self.logger.warning("Running {} (asyncio): {}".format(self.config["NAME"], datetime.now()))
+        while True:
+            await asyncio.to_thread(self.defender.controlStep)
+            try:
+                # The defender config, LOOP_INTERVAL can change on a config reload
+                await asyncio.wait_for(self.wake.wait(), self.defender.config["LOOP_INTERVAL"])
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
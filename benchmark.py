@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import time
+import uuid
+import timeit
+import random
+import tracemalloc
+import yaml
+import logging
+import argparse
+from datetime import datetime, timedelta
+from collections import deque
+
+import ratelimit
+from nicehash_api import NiceHash, DEFAULT_MARKETS, RequestBuilder, signRequest
+from nicehash_orderbook import OrderBookService
+from nicehash_standin import NiceHashStandIn
+from source_standin import SourceStandIn
+import sources
+from grin_nicehash_defender import GrinNiceHashDefender
+from detectors import detector, Detector
+from timeseries import TieredSeries, defaultTiers, DAY
+
+
+##
+# Defender benchmarks against the local NiceHash stand-in
+#
+# Measures control loop latency and NiceHash calls per loop while idle,
+# while defending and while cleaning up, plus the time from "attack
+# detected" until both market orders are live.  Run it before and after a
+# performance change and compare the numbers.
+
+ALGO = "GRINCUCKATOO32"
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    index = min(int(round(pct / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def summarize(name, durations, calls):
+    return {
+            "benchmark": name,
+            "loops": len(durations),
+            "latency_ms_p50": round(percentile(durations, 50) * 1000, 2),
+            "latency_ms_p95": round(percentile(durations, 95) * 1000, 2),
+            "latency_ms_max": round(max(durations) * 1000, 2),
+            "calls_per_loop": round(sum(calls) / float(len(calls)), 2),
+        }
+
+
+# Detection outcome is set by the benchmark
+@detector("benchmark")
+class BenchmarkDetector(Detector):
+    attack = False
+
+    def check(self, algos):
+        return dict((algo, BenchmarkDetector.attack) for algo in algos), {"attack": BenchmarkDetector.attack}
+
+
+class DefenderBenchmark():
+    def __init__(self, config, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.config = dict(config)
+        self.config["CHECK_TYPE"] = "benchmark"
+        # Measure the defender, not the rate limiter
+        ratelimit.configure(dict(self.config, NICEHASH_RATE_LIMIT=100000, NICEHASH_RATE_BURST=1000))
+        self.standin = NiceHashStandIn(latency=latency, jitter=jitter, error_rate=error_rate).start()
+        self.nh_api = NiceHash(self.standin.api_id, self.standin.api_key, self.standin.org_id, url=self.standin.getUrl())
+
+    def newDefender(self):
+        defender = GrinNiceHashDefender(nh_api=self.nh_api)
+        defender.config = self.config
+        defender.nh_order_add_duration = timedelta(minutes=int(self.config["ADD_ORDER_DURATION"]))
+        defender.nh_pool_ids[ALGO] = self.nh_api.getPoolId(self.config["POOL_NAME"])
+        defender.orderbook = OrderBookService(logging.getLogger("gnd"), [ALGO], nh_api=self.nh_api)
+        return defender
+
+    # Time one full control loop: detection and order management
+    def loop(self, defender, under_attack):
+        BenchmarkDetector.attack = under_attack
+        calls = self.standin.getCallCount()
+        started = time.time()
+        defender.controlStep()
+        return time.time() - started, self.standin.getCallCount() - calls
+
+    # The market moves - the next loop has to raise the bids
+    def moveMarkets(self, defender, step):
+        self.standin.setMarket("EU", 0.30 + 0.001 * step, 2.0)
+        self.standin.setMarket("USA", 0.31 + 0.001 * step, 1.0)
+        defender.orderbook.refresh(ALGO)
+
+    def liveOrders(self):
+        return sum(len(self.standin.sim.getMyOrders(market, ALGO)) for market in DEFAULT_MARKETS)
+
+    def run(self, loops=20):
+        results = []
+        defender = self.newDefender()
+
+        # Idle: no attack, no orders
+        durations, calls = [], []
+        for i in range(loops):
+            d, c = self.loop(defender, False)
+            durations.append(d)
+            calls.append(c)
+        results.append(summarize("idle_loop", durations, calls))
+
+        # Attack detected -> both orders live
+        started = time.time()
+        d, c = self.loop(defender, True)
+        live = self.liveOrders()
+        results.append({
+                "benchmark": "attack_to_orders_live",
+                "latency_ms": round((time.time() - started) * 1000, 2),
+                "calls": c,
+                "orders_live": live,
+            })
+
+        # Defending: orders live, the market moves every loop so the bids do too
+        durations, calls = [], []
+        for i in range(loops):
+            self.moveMarkets(defender, i + 1)
+            d, c = self.loop(defender, True)
+            durations.append(d)
+            calls.append(c)
+        results.append(summarize("defending_loop", durations, calls))
+
+        # Attack over and order duration passed -> cancel
+        defender.attack_start[ALGO] = datetime.now() - defender.nh_order_add_duration - timedelta(seconds=1)
+        d, c = self.loop(defender, False)
+        results.append({
+                "benchmark": "cleanup",
+                "latency_ms": round(d * 1000, 2),
+                "calls": c,
+                "orders_live": self.liveOrders(),
+            })
+        return results
+
+    def stop(self):
+        self.standin.stop()
+
+
+
+# Client side cost of building and signing one NiceHash request
+def microBenchmarks(number=20000):
+    builder = RequestBuilder("https://api2.nicehash.com", "00000000-api-id", "11111111-1111-api-key", "22222222-org-id")
+    path = "/main/api/v2/hashpower/order/33333333-order-id/updatePriceAndLimit"
+    body = { "marketFactor": "1000000000000", "displayMarketFactor": "TH", "limit": "0.50", "price": "0.3750" }
+    timestamp = str(int(time.time() * 1000))
+    nonce = str(uuid.uuid4())
+    query = "ts=" + timestamp
+    benchmarks = [
+            ("sign_pure", lambda: signRequest("11111111-1111-api-key", "00000000-api-id", "22222222-org-id", timestamp, nonce, "GET", path, query)),
+            ("sign_prepared", lambda: builder.sign(timestamp, nonce, "GET", path, query)),
+            ("build_get", lambda: builder.build("GET", "/main/api/v2/hashpower/orderBook", {"algorithm": ALGO, "size": 1000}, None, timestamp, nonce)),
+            ("build_post", lambda: builder.build("POST", path, None, body, timestamp, nonce)),
+            ("build_get_with_nonce", lambda: builder.build("GET", "/main/api/v2/hashpower/orderBook", {"algorithm": ALGO, "size": 1000}, None, str(int(time.time() * 1000)), str(uuid.uuid4()))),
+        ]
+    results = []
+    for name, fn in benchmarks:
+        best = min(timeit.repeat(fn, number=number, repeat=7))
+        results.append({
+                "benchmark": name,
+                "calls": number,
+                "us_per_call": round(best / number * 1e6, 2),
+            })
+    return results
+
+
+# Grin price fetch latency from one slow-tailed provider vs hedged and
+# median fetches over three stand-in providers
+def sourceBenchmarks(fetches=200):
+    standins = [
+            SourceStandIn(latency=0.02, tail_rate=0.1, tail_latency=1.0).start(),
+            SourceStandIn(latency=0.05, jitter=0.02).start(),
+            SourceStandIn(latency=0.03, error_rate=0.3).start(),
+        ]
+    providers = [sources.JsonSource("standin{}".format(i), s.getUrl("/price"), "grin.btc") for i, s in enumerate(standins)]
+    candidates = [
+            ("source_single", sources.MultiSource("single", providers[:1])),
+            ("source_hedged", sources.MultiSource("hedged", providers, mode="hedged", hedge_delay=0.1, timeout=5)),
+            ("source_median", sources.MultiSource("median", providers, mode="median", timeout=0.5)),
+        ]
+    results = []
+    try:
+        for name, source in candidates:
+            durations = []
+            errors = 0
+            calls = sum(s.calls for s in standins)
+            for i in range(fetches):
+                started = time.time()
+                try:
+                    source.fetch()
+                except Exception:
+                    errors += 1
+                durations.append(time.time() - started)
+            results.append({
+                    "benchmark": name,
+                    "fetches": fetches,
+                    "latency_ms_p50": round(percentile(durations, 50) * 1000, 2),
+                    "latency_ms_p99": round(percentile(durations, 99) * 1000, 2),
+                    "latency_ms_max": round(max(durations) * 1000, 2),
+                    "errors": errors,
+                    "calls_per_fetch": round((sum(s.calls for s in standins) - calls) / float(fetches), 2),
+                })
+    finally:
+        for s in standins:
+            s.stop()
+    return results
+
+
+# Bytes held by one watcher history in each representation: the original
+# list of {"price", "ts": datetime} dicts, python float lists with rollup
+# buckets as tuples, and the array backed TieredSeries
+def memoryBenchmarks(window=1440, baseline_days=30):
+    def measure(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        held = build()
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del held
+        return size
+
+    start = time.time() - baseline_days * DAY
+    samples = [(start + i * 60, 1.0 + random.random()) for i in range(baseline_days * DAY // 60)]
+
+    def dicts(count):
+        return lambda: [{"price": v, "ts": datetime.fromtimestamp(ts)} for ts, v in samples[-count:]]
+
+    def lists():
+        # Float objects are created by the parsing, not the sample list
+        values = [v + 0.0 for ts, v in samples[-window:]]
+        times = [ts + 0.0 for ts, v in samples[-window:]]
+        rollups = []
+        for resolution, capacity in defaultTiers(baseline_days):
+            buckets = deque(maxlen=capacity)
+            for i in range(capacity):
+                v = samples[-1][1] + i
+                buckets.append((start + i * resolution, resolution // 60, v * 5, v - 0.5, v + 0.5, v + 0.0))
+            rollups.append(buckets)
+        return values, times, rollups
+
+    def compact(days):
+        def build():
+            series = TieredSeries(window, defaultTiers(days))
+            for ts, v in samples:
+                series.append(v, ts)
+            return series
+        return build
+
+    results = []
+    for name, samples_held, build in [
+            ("history_dicts", window, dicts(window)),
+            ("history_dicts_baseline", len(samples), dicts(len(samples))),
+            ("history_lists", window, lists),
+            ("history_compact", window, compact(baseline_days)),
+        ]:
+        size = measure(build)
+        results.append({
+                "benchmark": name,
+                "raw_samples": samples_held,
+                "kib": round(size / 1024.0, 1),
+                "bytes_per_raw_sample": round(size / float(samples_held), 1),
+            })
+    series = compact(baseline_days)()
+    results.append({
+            "benchmark": "history_compact_view",
+            "raw_samples": series.getSize(),
+            "kib": round(series.getBytes() / 1024.0, 1),
+            "zero_copy": all(view.obj is series.values.data for view in series.getValueViews()),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grin NiceHash Defender benchmarks against a local NiceHash stand-in")
+    parser.add_argument("--config", default="config.yml", help="Configuration file (default: config.yml)")
+    parser.add_argument("--loops", type=int, default=20, help="Control loops per benchmark")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stand-in response latency in seconds (default: 0.05)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Stand-in random extra latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of stand-in requests that fail")
+    parser.add_argument("--json", action="store_true", help="Print results as json lines")
+    parser.add_argument("--micro", action="store_true", help="Only run the request signing micro-benchmarks")
+    parser.add_argument("--sources", action="store_true", help="Only run the multi-provider grin data source benchmarks")
+    parser.add_argument("--memory", action="store_true", help="Only run the watcher history memory benchmarks")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as c:
+        config = yaml.safe_load(c.read())[0]
+    logging.getLogger("gnd").setLevel(logging.CRITICAL)
+
+    if args.micro:
+        results = microBenchmarks()
+    elif args.sources:
+        results = sourceBenchmarks()
+    elif args.memory:
+        results = memoryBenchmarks()
+    else:
+        bench = DefenderBenchmark(config, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+        try:
+            results = bench.run(args.loops)
+        finally:
+            bench.stop()
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("{:<24} {}".format(result["benchmark"], ", ".join("{}={}".format(k, v) for k, v in result.items() if k != "benchmark")))
+
+if __name__ == "__main__":
+    main()
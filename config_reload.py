@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import sys
+import time
+import yaml
+from threading import Thread
+
+import metrics
+import detectors
+from scoring import SCORE_FUNCTIONS
+
+
+##
+# config.yml validation and hot reload
+#
+# Every setting has a schema entry: its accepted types, a value check, and
+# whether it is "live" - picked up by the running defender - or needs a
+# restart (credentials, history sizes, connection pools, ...).  A
+# ConfigWatcher polls the file mtime and hands every changed config that
+# validates to a callback.  The defender applies it between two control
+# loops, all live settings at once.  Changes that need a restart keep
+# their running value and are logged as such.  A config that does not
+# validate is logged and ignored, the running config stays.
+
+RELOADS = metrics.counter("gnd_config_reloads_total", "config.yml reload attempts by outcome", ["result"])
+
+NUMBER = (int, float)
+UNSET = "(unset)"
+
+
+def positive(value):
+    if value <= 0:
+        return "must be greater than 0"
+
+def notNegative(value):
+    if value < 0:
+        return "must not be negative"
+
+def fraction(value):
+    if value < 0 or value > 1:
+        return "must be between 0 and 1"
+
+def oneOf(*choices):
+    def check(value):
+        if value not in choices:
+            return "must be one of {}".format(", ".join(str(c) for c in choices))
+    return check
+
+def logLevel(value):
+    if str(value).upper() not in ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]:
+        return "must be a log level (DEBUG, INFO, WARNING, ERROR, CRITICAL)"
+
+def eachValue(check):
+    def checkAll(value):
+        for key, item in value.items():
+            error = check(item)
+            if error is not None:
+                return "{}: {}".format(key, error)
+    return checkAll
+
+def checkType(value):
+    names = value if isinstance(value, list) else [value]
+    for name in names:
+        if name != "all" and name not in detectors.DETECTORS:
+            return "unknown detector {} - use all or {}".format(name, sorted(detectors.DETECTORS))
+
+def checkDetector(settings):
+    if not isinstance(settings, dict):
+        return "must be a mapping of deadline / ttl / weight"
+    for key, value in settings.items():
+        if key not in ["deadline", "ttl", "weight"]:
+            return "unknown setting {}".format(key)
+        if not isNumber(value) or value < 0:
+            return "{} must be a number of at least 0".format(key)
+
+def checkSources(value):
+    for source in value:
+        if not isinstance(source, dict) or not all(isinstance(source.get(key), str) for key in ["name", "url", "path"]):
+            return "every source needs a name, url and path"
+
+
+class Setting():
+    def __init__(self, types, live=False, required=False, check=None, secret=False):
+        self.types = types if isinstance(types, tuple) else (types,)
+        self.live = live            # Applied to the running defender without a restart
+        self.required = required
+        self.check = check          # check(value) returns an error message or None
+        self.secret = secret        # Never logged
+
+    # Error message for value, or None
+    def validate(self, value):
+        if value is None and type(None) in self.types:
+            return None
+        # yaml true / false are not numbers
+        if not isinstance(value, self.types) or (isinstance(value, bool) and bool not in self.types):
+            return "must be {}".format(" or ".join("null" if t is type(None) else t.__name__ for t in self.types))
+        if self.check is not None:
+            return self.check(value)
+        return None
+
+
+SCHEMA = {
+        "NAME": Setting(str, live=True, required=True),
+        "NICEHASH_API_ID": Setting(str, required=True, secret=True),
+        "NICEHASH_API_KEY": Setting(str, required=True, secret=True),
+        "NICEHASH_ORG_ID": Setting(str, required=True, secret=True),
+        "POOL_NAME": Setting(str, required=True),
+        "MAX_SPEED": Setting(NUMBER, live=True, required=True, check=positive),
+        "ORDER_AMOUNT": Setting(NUMBER, live=True, required=True, check=positive),
+        "MAX_PRICE": Setting(NUMBER, live=True, required=True, check=positive),
+        "ADD_ORDER_DURATION": Setting(NUMBER, live=True, required=True, check=notNegative),
+        "ALGORITHMS": Setting((dict, type(None)), live=True),
+        "VERBOSE": Setting(bool, live=True, required=True),
+        "ORDER_PRICE_ADD": Setting(NUMBER, live=True, required=True, check=notNegative),
+        "ORDER_PRICING": Setting(str, live=True, check=oneOf("depth", "lowest")),
+        "LOOP_INTERVAL": Setting(NUMBER, live=True, required=True, check=positive),
+        "ORDER_STATUS_INTERVAL": Setting(NUMBER, live=True, check=notNegative),
+        "RUNTIME": Setting(str, check=oneOf("threads", "asyncio")),
+        "CHECK_TYPE": Setting((str, list), required=True, check=checkType),
+        "DETECTION_MODE": Setting(str, live=True, check=oneOf("any", "quorum", "weighted")),
+        "DETECTION_QUORUM": Setting(int, live=True, check=positive),
+        "DETECTION_WEIGHT": Setting(NUMBER, live=True, check=notNegative),
+        "DETECTORS": Setting((dict, type(None)), live=True, check=eachValue(checkDetector)),
+        "POLL_MAX_INTERVAL": Setting(NUMBER, live=True, check=positive),
+        "POLL_MIN_INTERVAL": Setting(NUMBER, live=True, check=positive),
+        "POLL_APPROACH": Setting(NUMBER, live=True, check=fraction),
+        "POLL_API_BUDGET": Setting(NUMBER + (type(None),), live=True, check=positive),
+        "METRICS_PORT": Setting(int, check=notNegative),
+        "METRICS_HOST": Setting(str),
+        "JOURNAL_DIR": Setting((str, type(None))),
+        "CONFIG_POLL_INTERVAL": Setting(NUMBER, check=notNegative),
+        "LOG_LEVEL": Setting(str, live=True, check=logLevel),
+        "LOG_LEVELS": Setting((dict, type(None)), live=True, check=eachValue(logLevel)),
+        "LOG_FORMAT": Setting(str, live=True, check=oneOf("text", "json")),
+        "LOG_RATE_WINDOW": Setting(NUMBER, live=True, check=notNegative),
+        "LOG_RATE_BURST": Setting(int, live=True, check=notNegative),
+        "HTTP_POOL_SIZE": Setting(int, check=positive),
+        "HTTP_TIMEOUT": Setting(NUMBER, check=positive),
+        "HTTP_HOSTS": Setting((dict, type(None))),
+        "NICEHASH_RATE_LIMIT": Setting(NUMBER, check=positive),
+        "NICEHASH_RATE_BURST": Setting(int, check=positive),
+        "NICEHASH_ORDER_RESERVE": Setting(int, check=notNegative),
+        "NICEHASH_MAX_RETRIES": Setting(int, check=notNegative),
+        "NICEHASH_BREAKER_FAILURES": Setting(int, check=positive),
+        "NICEHASH_BREAKER_COOLDOWN": Setting(NUMBER, check=positive),
+        "GRIN51_MIN_HISTORY": Setting(int, required=True, check=positive),
+        "GRIN51_MAX_HISTORY": Setting(int, required=True, check=positive),
+        "GRIN51_SCORE_THREASHOLD": Setting(NUMBER, live=True, required=True, check=positive),
+        "GRIN51_HISTORY_DIR": Setting((str, type(None))),
+        "GRIN51_SCORE_FUNCTION": Setting(str, check=oneOf(*sorted(SCORE_FUNCTIONS))),
+        "GRIN51_MIN_ZSCORE": Setting(NUMBER, check=notNegative),
+        "GRIN51_BASELINE_DAYS": Setting(NUMBER, check=notNegative),
+        "GRIN51_BASELINE_CHECK": Setting(bool, live=True),
+        "GRIN_PRICE_SOURCES": Setting((list, type(None)), check=checkSources),
+        "GRIN_SPEED_SOURCES": Setting((list, type(None)), check=checkSources),
+        "SOURCE_MODE": Setting(str, check=oneOf("hedged", "median")),
+        "SOURCE_HEDGE_DELAY": Setting(NUMBER, live=True, check=notNegative),
+        "SOURCE_TIMEOUT": Setting(NUMBER, live=True, check=positive),
+        "GRINHEALTH_URL": Setting(str, live=True),
+        "GRINHEALTH_SCORE_THREASHOLD": Setting(int, live=True),
+    }
+
+# Settings an ALGORITHMS entry can override, besides its MARKETS
+ALGORITHM_SETTINGS = ["POOL_NAME", "MAX_SPEED", "ORDER_AMOUNT", "MAX_PRICE", "ORDER_PRICE_ADD"]
+
+# Settings read by the detectors - changing one rebuilds the DetectorSet
+DETECTION_SETTINGS = ["DETECTION_MODE", "DETECTION_QUORUM", "DETECTION_WEIGHT", "DETECTORS", "GRINHEALTH_URL", "GRINHEALTH_SCORE_THREASHOLD"]
+
+
+def isNumber(value):
+    return isinstance(value, NUMBER) and not isinstance(value, bool)
+
+def validateAlgorithms(algorithms):
+    errors = []
+    for algo, settings in (algorithms or {}).items():
+        if settings is None:
+            continue
+        if not isinstance(settings, dict):
+            errors.append("ALGORITHMS {}: must be a mapping".format(algo))
+            continue
+        for key, value in settings.items():
+            if key == "MARKETS":
+                if not isinstance(value, list) or len(value) == 0 or not all(isinstance(m, str) for m in value):
+                    errors.append("ALGORITHMS {} MARKETS: must be a list of market names".format(algo))
+            elif key in ALGORITHM_SETTINGS:
+                error = SCHEMA[key].validate(value)
+                if error is not None:
+                    errors.append("ALGORITHMS {} {}: {}".format(algo, key, error))
+            else:
+                errors.append("ALGORITHMS {}: unknown setting {}".format(algo, key))
+    return errors
+
+# Returns a list of error messages, empty when the config is valid
+def validate(config):
+    if not isinstance(config, dict):
+        return ["configuration must be a mapping of settings"]
+    errors = []
+    for key, setting in SCHEMA.items():
+        if key not in config:
+            if setting.required:
+                errors.append("{}: is required".format(key))
+            continue
+        error = setting.validate(config[key])
+        if error is not None:
+            errors.append("{}: {}".format(key, error))
+    if isinstance(config.get("ALGORITHMS"), dict):
+        errors += validateAlgorithms(config["ALGORITHMS"])
+    return errors
+
+# Settings the schema does not know (ex: typos)
+def getUnknownKeys(config):
+    return sorted(key for key in config if key not in SCHEMA)
+
+# Read and validate a config file - raises an Exception describing every problem
+def load(path):
+    with open(path, "r") as c:
+        config = yaml.safe_load(c.read())[0]
+    errors = validate(config)
+    if len(errors) > 0:
+        raise Exception("Invalid configuration in {}:\n  {}".format(path, "\n  ".join(errors)))
+    return config
+
+
+# [(path tuple, value)] of every leaf setting - mappings are walked into
+def flatten(value, path=()):
+    if isinstance(value, dict) and len(value) > 0:
+        leaves = []
+        for key, item in value.items():
+            leaves += flatten(item, path + (str(key),))
+        return leaves
+    return [(path, value)]
+
+# [(path, old value, new value)] of every leaf setting that differs
+def diff(old, new):
+    old = dict(flatten(old))
+    new = dict(flatten(new))
+    changes = []
+    for path in sorted(set(old) | set(new)):
+        before = old.get(path, UNSET)
+        after = new.get(path, UNSET)
+        if before != after:
+            changes.append((path, before, after))
+    return changes
+
+def needsRestart(path):
+    key = path[0]
+    if key == "ALGORITHMS":
+        # Defended algos, markets and pools are set up at startup
+        return len(path) < 3 or path[2] in ["MARKETS", "POOL_NAME"]
+    setting = SCHEMA.get(key)
+    return setting is not None and not setting.live
+
+# Split a config change into what can be applied now and what needs a restart
+# Returns (config to apply, live changes, restart changes) - settings with a
+# change that needs a restart keep their running value in the config to apply
+def split(running, new):
+    changes = diff(running, new)
+    restart = [change for change in changes if needsRestart(change[0])]
+    keep = set(path[0] for path, old, value in restart)
+    config = dict(new)
+    for key in keep:
+        if key in running:
+            config[key] = running[key]
+        else:
+            config.pop(key, None)
+    live = [change for change in changes if change[0][0] not in keep]
+    return config, live, restart
+
+def formatChange(change):
+    path, old, new = change
+    if path[0] in SCHEMA and SCHEMA[path[0]].secret:
+        old, new = "***", "***"
+    return "{}: {} -> {}".format(".".join(path), old, new)
+
+
+class ConfigWatcher():
+    def __init__(self, logger, path, callback, interval=5):
+        self.logger = logger
+        self.path = path
+        self.callback = callback    # callback(config) with every changed config that validates
+        self.interval = interval
+        self.stat = self.getStat()
+
+    # (mtime, size) of the file, None if it is missing
+    def getStat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    # Load the file if it changed since the last check
+    def check(self):
+        stat = self.getStat()
+        if stat is None or stat == self.stat:
+            return False
+        self.stat = stat
+        try:
+            config = load(self.path)
+        except Exception as e:
+            RELOADS.inc(result="invalid")
+            self.logger.error("Ignoring config change, keeping the running configuration - {}".format(e))
+            return False
+        unknown = getUnknownKeys(config)
+        if len(unknown) > 0:
+            self.logger.warning("Unknown settings in {}: {}".format(self.path, ", ".join(unknown)))
+        try:
+            self.callback(config)
+            RELOADS.inc(result="ok")
+        except Exception as e:
+            RELOADS.inc(result="error")
+            self.logger.error("Error applying config change - {}".format(e))
+        return True
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def start(self):
+        thread = Thread(target = self.run, name = "config_watcher")
+        thread.daemon = True
+        thread.start()
+
+
+
+def main():
+    # Validate a config file: python config_reload.py [config.yml]
+    path = sys.argv[1] if len(sys.argv) > 1 else "config.yml"
+    try:
+        config = load(path)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    for key in getUnknownKeys(config):
+        print("Unknown setting: {}".format(key))
+    print("{} is valid".format(path))
+
+if __name__ == "__main__":
+    main()
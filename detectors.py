@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import time
+from abc import ABC, abstractmethod
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import http_transport
+import metrics
+
+
+##
+# Attack detector plugins
+#
+# Each detector (config.yml CHECK_TYPE / DETECTORS) answers "is this algo
+# under attack" for every defended algo.  All detectors run at the same
+# time in a thread pool and each gets its own deadline.  A detector that
+# misses its deadline or fails falls back to its last good answer while
+# that is younger than its ttl, else it abstains, so one slow upstream can
+# not hold up the control loop for longer than the largest deadline.  The
+# answers are combined by DETECTION_MODE:
+#   "any":      attack if any detector says so (the original behavior)
+#   "quorum":   attack if at least DETECTION_QUORUM detectors say so
+#   "weighted": attack if the weights of the detectors that say so add up
+#               to DETECTION_WEIGHT
+
+DETECTOR_SECONDS = metrics.histogram("gnd_detector_seconds", "Detector evaluation time", ["detector"])
+DETECTOR_RESULTS = metrics.counter("gnd_detector_results_total", "Detector evaluations by outcome", ["detector", "status"])
+
+DETECTORS = {}
+
+def detector(name):
+    def register(cls):
+        DETECTORS[name] = cls
+        cls.name = name
+        return cls
+    return register
+
+
+class Detector(ABC):
+    name = None
+
+    def __init__(self, config, settings):
+        self.config = config
+        self.deadline = float(settings.get("deadline", 5))     # Seconds to wait for an answer
+        self.ttl = float(settings.get("ttl", 300))             # Seconds the last good answer can stand in
+        self.weight = float(settings.get("weight", 1))
+        self.last = None      # Last good (time, { algo: attack }, stats)
+        self.running = None   # Evaluation still in flight (ex: from a previous loop)
+
+    # Returns ({ algo: attack }, stats) - called in a worker thread
+    @abstractmethod
+    def check(self, algos):
+        pass
+
+
+@detector("file")
+class FileDetector(Detector):
+    # For debugging: a file called "./attack" means every algo is under attack
+    def check(self, algos):
+        exists = os.path.exists("attack")
+        return dict((algo, exists) for algo in algos), {"exists": exists}
+
+
+@detector("grin-health")
+class GrinHealthDetector(Detector):
+    # The request keeps its HTTP_HOSTS timeout - an answer after the deadline
+    # is still picked up by the next evaluation
+    def check(self, algos):
+        r = http_transport.get_transport().get(self.config["GRINHEALTH_URL"])
+        stats = r.json()
+        attack = int(stats["overall_score"]) <= int(self.config["GRINHEALTH_SCORE_THREASHOLD"])
+        return dict((algo, attack) for algo in algos), stats
+
+
+@detector("grin51")
+class Grin51Detector(Detector):
+    def __init__(self, config, settings, grin51):
+        super().__init__(config, settings)
+        self.grin51 = grin51    # { algo: Grin51 } - scored by their own schedulers, algos without one get no vote
+
+    # Reports what the schedulers last computed - scoring here would race them.
+    # A scheduler that stopped scoring is an error, not a fresh answer.
+    def check(self, algos):
+        attack = {}
+        stats = {}
+        for algo in algos:
+            if algo not in self.grin51:
+                continue
+            grin51_stats = self.grin51[algo].stats
+            if grin51_stats is None:
+                raise Exception("Grin51 {} has not scored yet".format(algo))
+            age = time.time() - grin51_stats["scored"]
+            if age > self.ttl:
+                raise Exception("Grin51 {} last scored {:.0f}s ago".format(algo, age))
+            attack[algo] = grin51_stats["under_attack"]
+            stats[algo] = grin51_stats
+        return attack, stats
+
+
+class DetectorSet():
+    def __init__(self, logger, detectors, mode="any", quorum=1, weight=1.0):
+        if mode not in ["any", "quorum", "weighted"]:
+            raise Exception("Unknown DETECTION_MODE {} - use any, quorum or weighted".format(mode))
+        self.logger = logger
+        self.detectors = list(detectors)
+        self.mode = mode
+        self.quorum = int(quorum)
+        self.weight = float(weight)
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.detectors), 1), thread_name_prefix="detector")
+        self.lock = Lock()
+
+    # Take over the cached answers and in flight evaluations of the same
+    # detectors from the set this one replaces (config reload)
+    def adopt(self, previous):
+        found = dict((d.name, d) for d in previous.detectors)
+        for d in self.detectors:
+            if d.name in found:
+                d.last = found[d.name].last
+                d.running = found[d.name].running
+
+    # Evaluations in flight still finish
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    # Returns ({ algo: attack }, stats, seconds taken)
+    def timedCheck(self, detector, algos):
+        started = time.time()
+        try:
+            attack, stats = detector.check(algos)
+            return attack, stats, time.time() - started
+        finally:
+            DETECTOR_SECONDS.observe(time.time() - started, detector=detector.name)
+
+    # Run every detector at once, wait for each until its deadline
+    # Returns ({ algo: attack }, attack_stats)
+    def evaluate(self, algos):
+        started = time.time()
+        with self.lock:
+            for d in self.detectors:
+                # A detector still busy from an earlier loop is not started twice
+                if d.running is None:
+                    d.running = self.executor.submit(self.timedCheck, d, algos)
+        votes = []          # (detector, { algo: attack }) of the detectors with an answer
+        stats = {}
+        timing = {}
+        for d in sorted(self.detectors, key=lambda d: d.deadline):
+            future = d.running
+            status = "ok"
+            seconds = None
+            try:
+                attack, d_stats, seconds = future.result(timeout=max(0.0, started + d.deadline - time.time()))
+                d.last = (time.time(), attack, d_stats)
+            except TimeoutError:
+                status = "timeout"
+                self.logger.warning("Detector {} missed its {}s deadline".format(d.name, d.deadline))
+            except Exception as e:
+                status = "error"
+                self.logger.warning("Detector {} failed: {}".format(d.name, e))
+            if future.done():
+                d.running = None
+            if status != "ok":
+                if d.last is not None and time.time() - d.last[0] <= d.ttl:
+                    status = "cached"
+                    attack, d_stats = d.last[1], d.last[2]
+                else:
+                    attack, d_stats = None, None
+            DETECTOR_RESULTS.inc(detector=d.name, status=status)
+            timing[d.name] = {
+                    "status": status,
+                    "seconds": None if seconds is None else round(seconds, 3),
+                    "age": None if d.last is None else round(time.time() - d.last[0], 1),
+                }
+            if attack is not None:
+                votes.append((d, attack))
+                stats[d.name] = d_stats
+        stats["detectors"] = timing
+        return dict((algo, self.combine(algo, votes)) for algo in algos), stats
+
+    def combine(self, algo, votes):
+        yes = [d for d, attack in votes if attack.get(algo)]
+        if self.mode == "quorum":
+            return len(yes) >= self.quorum
+        if self.mode == "weighted":
+            return sum(d.weight for d in yes) >= self.weight
+        return len(yes) > 0
+
+
+# Detector names for config.yml CHECK_TYPE: "all", one name or a list of names
+def getNames(config):
+    check_type = config["CHECK_TYPE"]
+    if check_type == "all":
+        return ["file", "grin-health", "grin51"]
+    if isinstance(check_type, list):
+        return list(check_type)
+    return [check_type]
+
+# The CHECK_TYPE detectors with their DETECTORS settings
+def build(config, logger, grin51=None):
+    settings = config.get("DETECTORS") or {}
+    detectors = []
+    for name in getNames(config):
+        if name not in DETECTORS:
+            raise Exception("Unknown detector {} - use one of {}".format(name, sorted(DETECTORS)))
+        if name == "grin51":
+            detectors.append(DETECTORS[name](config, settings.get(name) or {}, grin51))
+        else:
+            detectors.append(DETECTORS[name](config, settings.get(name) or {}))
+    return DetectorSet(
+            logger,
+            detectors,
+            mode = config.get("DETECTION_MODE", "any"),
+            quorum = config.get("DETECTION_QUORUM", 1),
+            weight = config.get("DETECTION_WEIGHT", 1.0),
+        )
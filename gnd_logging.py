@@ -1,23 +1,175 @@
+import json
+import time
+import queue
+import atexit
 import logging
 import logging.handlers
+from threading import Lock
 
-def get_logger():
-    log_level = "DEBUG"
-    logFormatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
-    logger = logging.getLogger("gnd")
-    logfilename = "gnd.log"
-
-    consoleHandler = logging.StreamHandler()
-    consoleHandler.setFormatter(logFormatter)
-    consoleHandler.setLevel(log_level)
-    logger.addHandler(consoleHandler)
-
-    fileHandler = logging.handlers.RotatingFileHandler(
-            filename = logfilename,
-            mode = "a",
-            maxBytes = 10000000,
-            backupCount = 3,
-        )
-    fileHandler.setFormatter(logFormatter)
-    logger.addHandler(fileHandler)
-    return logger
+import metrics
+
+##
+# Non-blocking logging pipeline
+#
+# Loggers only put records on a bounded queue; one background listener
+# thread formats them and writes the console and the rotating log file, so
+# logging never waits on disk (or a slow terminal) in the order path.
+# Subsystems log to children of "gnd" (gnd.orders, gnd.nicehash, gnd.grin51,
+# gnd.orderbook, ...) whose levels can be set one by one, and identical
+# messages repeated within LOG_RATE_WINDOW seconds are collapsed.
+
+LOG_FILE = "gnd.log"
+QUEUE_SIZE = 10000           # Records waiting for the listener - more are dropped, never blocked on
+
+DROPPED = metrics.counter("gnd_log_dropped_total", "Log records dropped because the logging queue was full")
+SUPPRESSED = metrics.counter("gnd_log_suppressed_total", "Repeated log records suppressed by the rate limit", ["logger"])
+
+_pipeline = None
+_pipeline_lock = Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+                "ts": round(record.created, 3),
+                "level": record.levelname,
+                "logger": record.name,
+                "thread": record.threadName,
+                "msg": record.getMessage(),
+            }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Let through at most burst identical messages per window seconds, then
+# note how many were suppressed on the next one that gets through
+class RateLimitFilter(logging.Filter):
+    def __init__(self, window=60, burst=5):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.seen = {}       # { (logger, level, message): [window start, count, suppressed] }
+        self.lock = Lock()
+
+    def filter(self, record):
+        if not self.window:
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        now = time.time()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is None or now - entry[0] >= self.window:
+                suppressed = entry[2] if entry is not None else 0
+                self.seen[key] = [now, 1, 0]
+                if len(self.seen) > 1000:
+                    self.trim(now)
+                if suppressed > 0:
+                    record.msg = "{} (suppressed {} identical messages)".format(record.getMessage(), suppressed)
+                    record.args = None
+                return True
+            entry[1] += 1
+            if entry[1] <= self.burst:
+                return True
+            entry[2] += 1
+            SUPPRESSED.inc(logger=record.name)
+            return False
+
+    def trim(self, now):
+        for key in [k for k, e in self.seen.items() if now - e[0] >= self.window]:
+            del self.seen[key]
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # Formatting happens on the listener thread - only freeze the message here
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            DROPPED.inc()
+
+
+class LoggingPipeline():
+    def __init__(self):
+        self.text_formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
+        self.console = logging.StreamHandler()
+        self.console.setFormatter(self.text_formatter)
+        self.console.setLevel("DEBUG")
+        self.file = logging.handlers.RotatingFileHandler(
+                filename = LOG_FILE,
+                mode = "a",
+                maxBytes = 10000000,
+                backupCount = 3,
+                delay = True,
+            )
+        self.file.setFormatter(self.text_formatter)
+        self.file.setLevel("DEBUG")
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.rate_limit = RateLimitFilter()
+        self.handler.addFilter(self.rate_limit)
+        self.listener = logging.handlers.QueueListener(self.queue, self.console, self.file, respect_handler_level=True)
+        self.listener.start()
+        self.running = True
+        self.lock = Lock()
+        self.levels = {}     # { subsystem: level } set from LOG_LEVELS
+        self.logger = logging.getLogger("gnd")
+        self.logger.addHandler(self.handler)
+        atexit.register(self.stop)
+
+    def stop(self):
+        # Flush whatever is still queued
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        self.listener.stop()
+
+    def configure(self, config):
+        if config.get("VERBOSE"):
+            self.logger.setLevel("DEBUG")
+        else:
+            self.logger.setLevel(config.get("LOG_LEVEL", "WARNING"))
+        levels = dict(config.get("LOG_LEVELS") or {})
+        # Subsystems no longer listed follow "gnd" again
+        for subsystem in self.levels:
+            if subsystem not in levels:
+                logging.getLogger("gnd.{}".format(subsystem)).setLevel(logging.NOTSET)
+        for subsystem, level in levels.items():
+            logging.getLogger("gnd.{}".format(subsystem)).setLevel(level)
+        self.levels = levels
+        if config.get("LOG_FORMAT", "text") == "json":
+            self.file.setFormatter(JsonFormatter())
+        else:
+            self.file.setFormatter(self.text_formatter)
+        self.rate_limit.window = config.get("LOG_RATE_WINDOW", 60)
+        self.rate_limit.burst = config.get("LOG_RATE_BURST", 5)
+
+
+def get_pipeline():
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = LoggingPipeline()
+        return _pipeline
+
+# "gnd", or the "gnd.<subsystem>" child logger
+def get_logger(subsystem=None):
+    get_pipeline()
+    if subsystem is None:
+        return logging.getLogger("gnd")
+    return logging.getLogger("gnd.{}".format(subsystem))
+
+# Apply the config.yml LOG_* settings
+def configure(config):
+    get_pipeline().configure(config)
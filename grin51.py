@@ -19,229 +19,361 @@ import sys
 import uuid
 import time
 import json
-import requests
 import traceback
 from datetime import datetime, timedelta
 from threading import Thread
 
-from nicehash_api import NiceHash
+import http_transport
+import metrics
+from timeseries import TieredSeries, defaultTiers, ROLLUP_MAGIC, ROLLUP_RECORD
+from history_store import HistoryStore
+from scheduler import DetectionScheduler
+from scoring import ScoringEngine
+from nicehash_api import DEFAULT_ALGO, DEFAULT_MARKETS
+from nicehash_orderbook import OrderBookService, FETCHES
+
+## Metrics
+# FETCHES (gnd_watcher_fetch_total) is shared with the orderbook service
+SAMPLE_AGE = metrics.gauge("gnd_watcher_sample_age_seconds", "Age of the newest watcher sample", ["algo", "watcher"])
+SCORES = metrics.gauge("gnd_grin51_score", "Grin51 attack detection scores", ["algo", "score"])
+UNDER_ATTACK = metrics.gauge("gnd_grin51_under_attack", "Grin51 attack detection state (1 = attack)", ["algo"])
 
 ##
 # Watchers for external data
 
-class GrinHashSpeedWatcher():
+# Common base - keeps a rolling window of samples with O(1) stats, plus
+# optional 5 minute / hourly rollups for long baselines
+class SeriesWatcher():
     def __init__(self, logger, max_history=1440):
+        self.name = self.__class__.__name__
         self.interval = 60
+        self.resolution = 60     # Seconds - keep at most one history sample per this long
         self.max_size = max_history
-        self.speeds = []
+        self.series = TieredSeries(max_history)
+        self.current = None      # Newest sample, even if not kept in history
+        self.current_ts = None
+        self.store = None
+        self.sampler = None
+        self.source = None       # Optional sources.MultiSource used instead of url / parse
+        self.listeners = []
         self.logger = logger
 
     def getSize(self):
-        return len(self.speeds)
-    
-    def getCurrentSpeed(self):
-        return self.speeds[-1]["speed"]
+        return self.series.getSize()
+
+    def getCurrent(self):
+        if self.current is None:
+            return self.series.getLast()
+        return self.current
+
+    # Seconds since the newest sample (None if there is none yet)
+    def getAge(self):
+        if self.current_ts is None:
+            return None
+        return time.time() - self.current_ts
+
+    def recordFetch(self, ok):
+        FETCHES.inc(watcher=self.name, result="ok" if ok else "error")
+
+    # Sleep until the next poll - adaptive when a sampler is set
+    def wait(self):
+        if self.sampler is not None:
+            self.sampler.sleep()
+        else:
+            time.sleep(self.interval)
 
-    def getAverageSpeed(self):
-        total = sum([sp["speed"] for sp in self.speeds])
-        return total / len(self.speeds)
+    def addSample(self, value, ts=None):
+        if ts is None:
+            ts = time.time()
+        self.current = float(value)
+        self.current_ts = ts
+        # When polling faster than the history resolution only the current
+        # value moves, so the history window keeps covering the same time
+        if self.series.getSize() > 0 and ts - self.series.getLastTime() < self.resolution:
+            return ts
+        self.series.append(value, ts)
+        if self.store is not None:
+            try:
+                self.store.append(value, ts)
+            except Exception as e:
+                self.logger.error("Error writing history for {} - {}".format(self.store.path, e))
+        return ts
+
+    # callback(ts) is called after each new sample is published
+    def addListener(self, callback):
+        self.listeners.append(callback)
+
+    def notify(self, ts):
+        for callback in self.listeners:
+            callback(ts)
+
+    # Polling watchers: fetch one sample and publish it
+    def fetch(self):
+        if self.source is not None:
+            self.notify(self.addSample(self.source.fetch()))
+            return
+        r = http_transport.get_transport().get(self.url)
+        self.notify(self.addSample(self.parse(r.json())))
+
+    # True if the newest sample is younger than the polling interval
+    def isFresh(self):
+        age = self.getAge()
+        return age is not None and age < self.interval
 
     def run(self):
+        # Skip the first poll if a sample was just fetched (ex: during startup)
+        if self.isFresh():
+            self.wait()
         while True:
             try:
-                # Get grin GPS (from GrinMint Pool API)
-                url = "https://api.grinmint.com/v2/networkStats"
-                r = requests.get(url, timeout=20)
-                speedpoint = { 
-                        "speed": r.json()["hashrates"]["32"],
-                        "ts": datetime.now(),
-                    }
-                self.speeds.append(speedpoint)
-                if len(self.speeds) > self.max_size:
-                    self.speeds.pop(0)
+                self.fetch()
+                self.recordFetch(True)
             except Exception as e:
-                self.logger.error("Error in Grin51::GrinHashSpeedWatcher - {}".format(e))
+                self.recordFetch(False)
+                self.logger.error("Error in Grin51::{} - {}".format(self.__class__.__name__, e))
             # sleep interval
-            time.sleep(self.interval)
+            self.wait()
+
+    # Keep rollups: [(resolution seconds, buckets kept), ...] - call before adding samples
+    def setRollups(self, tiers):
+        self.series = TieredSeries(self.max_size, tiers)
+
+    # Mean over the longest rollup tier (the whole window without rollups)
+    def getBaseline(self):
+        return self.series.getBaselineMean()
+
+    # Persist samples to an on-disk HistoryStore, first reloading whatever
+    # recent history it already holds.  Rollups are reloaded first so the
+    # raw samples only rebuild the buckets that were still open.
+    def setStore(self, store, max_age=None, rollup_stores=None):
+        for rollup, rollup_store in zip(self.series.rollups, rollup_stores or []):
+            rollup.setStore(rollup_store, rollup.resolution * rollup.capacity)
+        for ts, value in store.load(max_age):
+            self.series.append(value, ts)
+        self.store = store
+        return self.series.getSize()
+
+class GrinHashSpeedWatcher(SeriesWatcher):
+    def __init__(self, logger, max_history=1440, graph="32"):
+        super().__init__(logger, max_history)
+        self.graph = graph       # Cuckoo graph size - key into the GrinMint hashrates
 
-class GrinPriceWatcher():
-    def __init__(self, logger, max_history=1440):
-        self.interval = 60
-        self.max_size = max_history
-        self.prices = []
-        self.logger = logger
-    
-    def getSize(self):
-        return len(self.prices)
-    
+    def getCurrentSpeed(self):
+        return self.getCurrent()
+
+    def getAverageSpeed(self):
+        return self.series.getMean()
+
+    # Get grin GPS (from GrinMint Pool API)
+    url = "https://api.grinmint.com/v2/networkStats"
+
+    def parse(self, data):
+        return data["hashrates"][self.graph]
+
+class GrinPriceWatcher(SeriesWatcher):
     def getCurrentPrice(self):
-        return self.prices[-1]["price"]
+        return self.getCurrent()
 
     def getAveragePrice(self):
-        total = sum([pp["price"] for pp in self.prices])
-        return total / len(self.prices)
+        return self.series.getMean()
 
-    def run(self):
-        while True:
-            try:
-                # Get grin price
-                url = "https://api.coingecko.com/api/v3/simple/price?ids=grin&vs_currencies=btc"
-                r = requests.get(url, timeout=20)
-                pricepoint = { 
-                        "price": r.json()["grin"]["btc"],
-                        "ts": datetime.now(),
-                    }
-                self.prices.append(pricepoint)
-                if len(self.prices) > self.max_size:
-                    self.prices.pop(0)
-            except Exception as e:
-                self.logger.error("Error in Grin51::GrinPriceWatcher - {}".format(e))
-            # sleep interval
-            time.sleep(self.interval)
+    # Get grin price
+    url = "https://api.coingecko.com/api/v3/simple/price?ids=grin&vs_currencies=btc"
 
-class NiceHashPriceWatcher():
+    def parse(self, data):
+        return data["grin"]["btc"]
+
+class NiceHashPriceWatcher(SeriesWatcher):
     def __init__(self, logger, market, algo, max_history=1440):
+        super().__init__(logger, max_history)
         self.market = market
         self.algo = algo
-        self.interval = 60
-        self.max_size = max_history
-        self.prices = []
-        self.logger = logger
 
-    def getSize(self):
-        return len(self.prices)
-    
     def getCurrentPrice(self):
-        return self.prices[-1]["price"]
+        return self.getCurrent()
 
     def getAveragePrice(self):
-        total = sum([pp["price"] for pp in self.prices])
-        return total / len(self.prices)
-
-    def run(self):
-        nh_api = NiceHash()
-        while True:
-            try:
-                # Get NH price
-                price = nh_api.getCurrentPrice(self.market, self.algo)
-                pricepoint = {
-                        "price": price,
-                        "ts": datetime.now(),
-                    }
-                self.prices.append(pricepoint)
-                if len(self.prices) > self.max_size:
-                    self.prices.pop(0)
-            except Exception as e:
-                self.logger.error("Error in Grin51::NiceHashPriceWatcher - {}".format(e))
-            # sleep interval
-            time.sleep(self.interval)
-
-class NiceHashSpeedWatcher():
+        return self.series.getMean()
+
+    # Called by the OrderBookService for every new orderbook snapshot
+    def update(self, snapshot):
+        if snapshot.algo != self.algo:
+            return
+        try:
+            price = snapshot.getPrice(self.market)
+            if price is None:
+                raise Exception("No working orders on market {}".format(self.market))
+            self.addSample(price, snapshot.ts.timestamp())
+            self.recordFetch(True)
+        except Exception as e:
+            self.recordFetch(False)
+            self.logger.error("Error in Grin51::NiceHashPriceWatcher - {}".format(e))
+
+class NiceHashSpeedWatcher(SeriesWatcher):
     def __init__(self, logger, market, algo, max_history=1440):
+        super().__init__(logger, max_history)
         self.market = market
         self.algo = algo
-        self.interval = 60
-        self.max_size = max_history
-        self.speeds = []
-        self.logger = logger
-
-    def getSize(self):
-        return len(self.speeds)
 
     def getCurrentSpeed(self):
-        return self.speeds[-1]["speed"]
+        return self.getCurrent()
 
     def getAverageSpeed(self):
-        total = sum([sp["speed"] for sp in self.speeds])
-        return total / len(self.speeds)
+        return self.series.getMean()
 
-    def run(self):
-        nh_api = NiceHash()
-        while True:
-            try:
-                # Get NH speed
-                speed = nh_api.getCurrentSpeed(self.market, self.algo)
-                speedpoint = {
-                        "speed": speed,
-                        "ts": datetime.now(),
-                    }
-                self.speeds.append(speedpoint)
-                if len(self.speeds) > self.max_size:
-                    self.speeds.pop(0)
-            except Exception as e:
-                self.logger.error("Error in Grin51::NiceHashSpeedWatcher - {}".format(e))
-            # sleep interval
-            time.sleep(self.interval)
+    # Called by the OrderBookService for every new orderbook snapshot
+    def update(self, snapshot):
+        if snapshot.algo != self.algo:
+            return
+        try:
+            self.addSample(snapshot.getSpeed(self.market), snapshot.ts.timestamp())
+            self.recordFetch(True)
+        except Exception as e:
+            self.recordFetch(False)
+            self.logger.error("Error in Grin51::NiceHashSpeedWatcher - {}".format(e))
+
+
+
+# Stats / watcher name prefix for a market ("EU" -> "nh_eu", "USA" -> "nh_us")
+def marketKey(market):
+    if market == "USA":
+        return "nh_us"
+    return "nh_{}".format(market.lower())
 
+# Cuckoo graph size of a grin NiceHash algorithm ("GRINCUCKATOO32" -> "32")
+def graphSize(algo):
+    return algo[-2:]
+
+# Network graphs/s in one unit of NiceHash speed (prices are BTC/unit/day)
+# Only known for C32 - grin51 cannot score the other algorithms
+NICEHASH_SPEED_UNITS = { "GRINCUCKATOO32": 1000.0 }    # kG/s
+
+def speedUnit(algo):
+    if algo not in NICEHASH_SPEED_UNITS:
+        raise Exception("No NiceHash speed unit for {} - grin51 supports {}".format(algo, ", ".join(sorted(NICEHASH_SPEED_UNITS))))
+    return NICEHASH_SPEED_UNITS[algo]
 
 
 class Grin51():
-    def __init__(self, threashold, min_history=30, max_history=1440, logger=None):
+    def __init__(self, threashold, min_history=30, max_history=1440, logger=None, orderbook=None, history_dir=None, sampler=None, algo=DEFAULT_ALGO, markets=None, price_from=None, baseline_days=30, baseline_check=False, score_function="mean", min_zscore=0, sources=None):
         if logger is not None:
             self.logger = logger
         else:
             import logging
-            self.logger = logging.getLogger("gnd")
-        self.nh_api = NiceHash()
+            self.logger = logging.getLogger("gnd.grin51")
+        # Shared NiceHash orderbook snapshots (one fetch per interval for all markets)
+        if orderbook is not None:
+            self.orderbook = orderbook
+        else:
+            self.orderbook = OrderBookService(self.logger, [algo])
+        self.algo = algo
+        self.speed_unit = speedUnit(algo)
+        self.markets = list(markets) if markets is not None else list(DEFAULT_MARKETS)
+        # Grin51 of another algorithm to share the grin price watcher with (it polls and persists it)
+        self.price_from = price_from
         self.threashold = threashold
+        self.baseline_days = baseline_days    # Length of the long (rollup) baseline, 0 to disable
+        self.baseline_check = baseline_check  # Also require the long baseline price and speed scores over the threashold
+        self.score_function = score_function  # See scoring.SCORE_FUNCTIONS - "mean" needs no numpy
+        self.min_zscore = min_zscore          # > 0 - An attack also needs price and speed robust z-scores this high
+        self.engine = None
         self.min_history = min_history
         self.max_history = max_history
+        self.history_dir = history_dir
         self.under_attack = False
+        self.stats = None         # The stats of the last checkForAttack - read by other threads
+        self.watchers = None
+        self.sampler = sampler    # Optional AdaptiveSampler - polls faster as scores near the threashold
+        self.sources = sources or {}    # { "grin_price" / "grin_speed": sources.MultiSource } - else the watcher url
+        # Re-score as soon as a fresh set of samples is in
+        self.scheduler = DetectionScheduler(self.logger, self, ["grin_price", "grin_speed", "orderbook"], sampler=sampler, name="grin51_{}".format(algo))
+
+    # New detection settings on a config reload - applied between two scorings
+    def configure(self, threashold, baseline_check):
+        with self.scheduler.lock:
+            self.threashold = threashold
+            self.baseline_check = baseline_check
 
     # Attempt at calculating the break-eaven nicehash rental price
     def getBreakevenPrice(self):
         grin_price = self.grin_price.getCurrentPrice()
-        grin_speed = self.grin_speed.getCurrentSpeed() / 1000.0 # XXX NH specific - only valid for C32
+        grin_speed = self.grin_speed.getCurrentSpeed() / self.speed_unit
         grin_per_day = 60*60*24
         price = (grin_per_day * grin_price) / grin_speed
         return price
         
     def get_stats(self):
-        nh_eu_price = self.nh_eu_price.getCurrentPrice()
-        nh_eu_price_avg = self.nh_eu_price.getAveragePrice()
-        nh_eu_price_dev = nh_eu_price / nh_eu_price_avg
-        #
-        nh_us_price = self.nh_us_price.getCurrentPrice()
-        nh_us_price_avg = self.nh_us_price.getAveragePrice()
-        nh_us_price_dev = nh_us_price / nh_us_price_avg
-        #
-        nh_price = (nh_eu_price + nh_us_price) / 2
-        nh_price_score = (nh_eu_price_dev + nh_us_price_dev) / 2
-        #
-        nh_eu_speed = self.nh_eu_speed.getCurrentSpeed()
-        nh_eu_speed_avg = self.nh_eu_speed.getAverageSpeed()
-        nh_eu_speed_dev = nh_eu_speed / nh_eu_speed_avg
-        #
-        nh_us_speed = self.nh_us_speed.getCurrentSpeed()
-        nh_us_speed_avg = self.nh_us_speed.getAverageSpeed()
-        nh_us_speed_dev = nh_us_speed / nh_us_speed_avg
+        stats = {}
+        price_devs = []
+        speed_devs = []
+        prices = []
+        baseline_price_devs = []
+        baseline_speed_devs = []
+        price_z = []
+        speed_z = []
+        if self.engine is not None:
+            scores, batch = self.engine.score()
+        for market in self.markets:
+            key = marketKey(market)
+            price = self.nh_price[market].getCurrentPrice()
+            price_avg = self.nh_price[market].getAveragePrice()
+            speed = self.nh_speed[market].getCurrentSpeed()
+            speed_avg = self.nh_speed[market].getAverageSpeed()
+            stats[key + "_price"] = price
+            stats[key + "_price_avg"] = price_avg
+            stats[key + "_price_dev"] = price / price_avg
+            stats[key + "_speed"] = speed
+            stats[key + "_speed_avg"] = speed_avg
+            stats[key + "_speed_dev"] = speed / speed_avg
+            if self.engine is not None:
+                # Robust scores from the batched engine replace current / mean
+                i = self.engine.getIndex(self.nh_price[market])
+                j = self.engine.getIndex(self.nh_speed[market])
+                stats[key + "_price_dev"] = float(scores[i])
+                stats[key + "_speed_dev"] = float(scores[j])
+                stats[key + "_price_median"] = float(batch.median[i])
+                stats[key + "_speed_median"] = float(batch.median[j])
+                stats[key + "_price_z"] = float(batch.zscore[i])
+                stats[key + "_speed_z"] = float(batch.zscore[j])
+                stats[key + "_price_roc"] = float(batch.roc[i])
+                stats[key + "_speed_roc"] = float(batch.roc[j])
+                price_z.append(float(batch.zscore[i]))
+                speed_z.append(float(batch.zscore[j]))
+            prices.append(price)
+            price_devs.append(stats[key + "_price_dev"])
+            speed_devs.append(stats[key + "_speed_dev"])
+            if self.baseline_days:
+                price_baseline = self.nh_price[market].getBaseline()
+                speed_baseline = self.nh_speed[market].getBaseline()
+                stats[key + "_price_baseline"] = price_baseline
+                stats[key + "_speed_baseline"] = speed_baseline
+                baseline_price_devs.append(price / price_baseline)
+                baseline_speed_devs.append(speed / speed_baseline)
         #
-        nh_speed_score = (nh_eu_speed_dev + nh_us_speed_dev) / 2
+        nh_price = sum(prices) / len(prices)
+        nh_price_score = sum(price_devs) / len(price_devs)
+        nh_speed_score = sum(speed_devs) / len(speed_devs)
         #
         nh_mining_breakeven_price = self.getBreakevenPrice()
         nh_mining_profitability_score = nh_price / nh_mining_breakeven_price
         #
-       
-        stats = {
-                "nh_eu_price": nh_eu_price,
-                "nh_eu_price_avg": nh_eu_price_avg,
-                "nh_eu_price_dev": nh_eu_price_dev,
-                "nh_us_price": nh_us_price,
-                "nh_us_price_avg": nh_us_price_avg,
-                "nh_us_price_dev": nh_us_price_dev,
-                "nh_eu_speed": nh_eu_speed,
-                "nh_eu_speed_avg": nh_eu_speed_avg,
-                "nh_eu_speed_dev": nh_eu_speed_dev,
-                "nh_us_speed": nh_us_speed,
-                "nh_us_speed_avg": nh_us_speed_avg,
-                "nh_us_speed_dev": nh_us_speed_dev,
-                "nh_mining_breakeven_price": nh_mining_breakeven_price,
-                "score": {
-                        "nh_price_score": nh_price_score,
-                        "nh_speed_score": nh_speed_score,
-                        "nh_mining_profitability_score": nh_mining_profitability_score,
-                    }
+        stats["nh_mining_breakeven_price"] = nh_mining_breakeven_price
+        stats["score"] = {
+                "nh_price_score": nh_price_score,
+                "nh_speed_score": nh_speed_score,
+                "nh_mining_profitability_score": nh_mining_profitability_score,
             }
+        if self.engine is not None:
+            stats["zscore"] = {
+                    "nh_price_z": sum(price_z) / len(price_z),
+                    "nh_speed_z": sum(speed_z) / len(speed_z),
+                }
+        # Same price and speed scores against the long baseline
+        if self.baseline_days:
+            stats["baseline_score"] = {
+                    "nh_price_score": sum(baseline_price_devs) / len(baseline_price_devs),
+                    "nh_speed_score": sum(baseline_speed_devs) / len(baseline_speed_devs),
+                }
         return stats
 
     def checkForAttack(self):
@@ -251,61 +383,145 @@ class Grin51():
         # 3. NiceHash C32 price is at least XX% higher than is profitable
         #    based on current grin price and current grin network c32 graph rate
         stats = self.get_stats()
-        if stats["score"]["nh_price_score"] > self.threashold and stats["score"]["nh_speed_score"] > self.threashold and stats["score"]["nh_mining_profitability_score"] > threashold:
-            self.under_attack = True
+        if self.sampler is not None:
+            self.sampler.update(self.algo, stats["score"])
+        for name, value in stats["score"].items():
+            SCORES.set(value, algo=self.algo, score=name)
+        for name, value in stats.get("baseline_score", {}).items():
+            SCORES.set(value, algo=self.algo, score=name + "_baseline")
+        if stats["score"]["nh_price_score"] > self.threashold and stats["score"]["nh_speed_score"] > self.threashold and stats["score"]["nh_mining_profitability_score"] > self.threashold:
+            under_attack = True
         else:
-            self.under_attack = False
+            under_attack = False
+        if self.baseline_check and "baseline_score" in stats:
+            if not all(score > self.threashold for score in stats["baseline_score"].values()):
+                under_attack = False
+        if self.min_zscore and "zscore" in stats:
+            if not all(z >= self.min_zscore for z in stats["zscore"].values()):
+                under_attack = False
+        # Publish the result only once it is final
+        stats["scored"] = time.time()
+        stats["under_attack"] = under_attack
+        self.stats = stats
+        self.under_attack = under_attack
+        UNDER_ATTACK.set(1 if self.under_attack else 0, algo=self.algo)
+
+    # Reload persisted history so detection can resume right after a restart
+    def loadHistory(self, watchers):
+        max_age = self.max_history * 60
+        for name, watcher in watchers.items():
+            path = os.path.join(self.history_dir, "{}.hist".format(name))
+            try:
+                rollup_stores = []
+                for rollup in watcher.series.rollups:
+                    rollup_path = os.path.join(self.history_dir, "{}.{}.roll".format(name, rollup.resolution))
+                    rollup_stores.append(HistoryStore(rollup_path, rollup.capacity, magic=ROLLUP_MAGIC, record=ROLLUP_RECORD))
+                loaded = watcher.setStore(HistoryStore(path, self.max_history), max_age, rollup_stores)
+                self.logger.warning("Loaded {} history samples for {}".format(loaded, name))
+            except Exception as e:
+                self.logger.error("Failed to load history for {} - {}".format(name, e))
 
-    def run(self):
-        # Start grin price watcher thread
-        self.grin_price = GrinPriceWatcher(self.logger, max_history=1440)
-        grin_price_thread = Thread(target = self.grin_price.run)
-        grin_price_thread.daemon = True
-        grin_price_thread.start()
-
-        # Start the grin network gps watcher thread
-        self.grin_speed = GrinHashSpeedWatcher(self.logger, max_history=1440)
-        grin_speed_thread = Thread(target = self.grin_speed.run)
-        grin_speed_thread.daemon = True
-        grin_speed_thread.start()
-
-        # Start the EU NiceHash price watcher thread
-        self.nh_eu_price = NiceHashPriceWatcher(self.logger, "EU", "GRINCUCKATOO32")
-        nh_eu_price_thread = Thread(target = self.nh_eu_price.run)
-        nh_eu_price_thread.daemon = True
-        nh_eu_price_thread.start()
-
-        # Start the USA NiceHash price watcher thread
-        self.nh_us_price = NiceHashPriceWatcher(self.logger, "USA", "GRINCUCKATOO32", max_history=1440)
-        nh_us_price_thread = Thread(target = self.nh_us_price.run)
-        nh_us_price_thread.daemon = True
-        nh_us_price_thread.start()
-
-        # Start the EU NiceHash speed watcher thread
-        self.nh_eu_speed = NiceHashSpeedWatcher(self.logger, "EU", "GRINCUCKATOO32", max_history=1440)
-        nh_eu_speed_thread = Thread(target = self.nh_eu_speed.run)
-        nh_eu_speed_thread.daemon = True
-        nh_eu_speed_thread.start()
-
-        # Start the US NiceHash speed watcher thread
-        self.nh_us_speed = NiceHashSpeedWatcher(self.logger, "USA", "GRINCUCKATOO32", max_history=1440)
-        nh_us_speed_thread = Thread(target = self.nh_us_speed.run)
-        nh_us_speed_thread.daemon = True
-        nh_us_speed_thread.start()
-
-        sz = 0
-        while sz < self.min_history:
-            self.logger.warning("Waiting for more data history. Status: {} of {}".format(sz, self.min_history))
-            time.sleep(60)
-            sz = min(
-                     self.grin_price.getSize(),
-                     self.grin_speed.getSize(),
-                     self.nh_eu_price.getSize(),
-                     self.nh_us_price.getSize(),
-                     self.nh_eu_speed.getSize(),
-                     self.nh_us_speed.getSize()
-                )
+    def createWatchers(self):
+        # Watchers this instance polls and persists (a shared grin price is owned elsewhere)
+        owned = {}
+        if self.price_from is not None:
+            self.grin_price = self.price_from.grin_price
+        else:
+            self.grin_price = GrinPriceWatcher(self.logger, max_history=self.max_history)
+            owned["grin_price"] = self.grin_price
+        self.grin_speed = GrinHashSpeedWatcher(self.logger, max_history=self.max_history, graph=graphSize(self.algo))
+        owned["grin_speed"] = self.grin_speed
+        # NiceHash price and speed watchers for all markets are fed from the
+        # same orderbook snapshot
+        self.nh_price = {}
+        self.nh_speed = {}
+        for market in self.markets:
+            self.nh_price[market] = NiceHashPriceWatcher(self.logger, market, self.algo, max_history=self.max_history)
+            self.nh_speed[market] = NiceHashSpeedWatcher(self.logger, market, self.algo, max_history=self.max_history)
+            owned[marketKey(market) + "_price"] = self.nh_price[market]
+            owned[marketKey(market) + "_speed"] = self.nh_speed[market]
+        self.owned = owned
+        self.watchers = dict(owned, grin_price=self.grin_price)
+        for name, watcher in owned.items():
+            watcher.name = name
+            SAMPLE_AGE.setFunction(watcher.getAge, algo=self.algo, watcher=name)
+            if self.baseline_days:
+                watcher.setRollups(defaultTiers(self.baseline_days))
+
+        if self.history_dir:
+            self.loadHistory(owned)
+        for name, source in self.sources.items():
+            if name in owned:
+                owned[name].source = source
+        if self.sampler is not None:
+            for watcher in self.getPollingWatchers():
+                watcher.sampler = self.sampler
+                self.sampler.register("{}_{}".format(self.algo, watcher.name), watcher.source.getCallsPerFetch() if watcher.source is not None else 1)
+        if self.score_function != "mean" or self.min_zscore:
+            try:
+                self.engine = ScoringEngine(self.getMarketWatchers(), self.max_history, self.score_function)
+            except Exception as e:
+                self.logger.error("Grin51 scoring engine not available, using mean scores - {}".format(e))
+        self.grin_price.addListener(lambda ts: self.scheduler.publish("grin_price", ts))
+        self.grin_speed.addListener(lambda ts: self.scheduler.publish("grin_speed", ts))
+        self.orderbook.subscribe(self.onSnapshot)
+
+    # Feed a new orderbook snapshot to all NiceHash watchers, then publish it
+    # once so scoring sees all markets from the same point in time
+    def onSnapshot(self, snapshot):
+        if snapshot.algo != self.algo:
+            return
+        for market in self.markets:
+            self.nh_price[market].update(snapshot)
+            self.nh_speed[market].update(snapshot)
+        self.scheduler.publish("orderbook", snapshot.ts.timestamp())
+
+    # NiceHash price and speed watchers of every market
+    def getMarketWatchers(self):
+        return [self.nh_price[m] for m in self.markets] + [self.nh_speed[m] for m in self.markets]
+
+    # Watchers that poll a remote api themselves (the rest are fed orderbook snapshots)
+    def getPollingWatchers(self):
+        return [w for w in [self.grin_price, self.grin_speed] if w in self.owned.values()]
+
+    def close(self):
+        for watcher in self.owned.values():
+            if watcher.store is not None:
+                watcher.store.close()
+
+    def getHistorySize(self):
+        return min(watcher.getSize() for watcher in self.watchers.values())
 
+    def run(self):
+        self.start()
+        self.waitForHistory()
+
+    def start(self):
+        if self.watchers is None:
+            self.createWatchers()
+
+        # Start a thread for each polling watcher (grin price, grin network gps)
+        for watcher in self.getPollingWatchers():
+            thread = Thread(target = watcher.run, name = watcher.name)
+            thread.daemon = True
+            thread.start()
+
+        # Start the NiceHash orderbook fetcher thread
+        self.orderbook.start()
+
+    def waitForHistory(self):
+        # Wait until there is enough history - with reloaded history this
+        # only waits for the first fresh samples
+        last_sz = None
+        while True:
+            sz = self.getHistorySize()
+            if sz >= self.min_history:
+                break
+            if sz != last_sz:
+                self.logger.warning("Waiting for more {} data history. Status: {} of {}".format(self.algo, sz, self.min_history))
+                last_sz = sz
+            time.sleep(5)
+        self.scheduler.enable()
 
 
 def main():
@@ -19,40 +19,117 @@ import sys
 import uuid
 import time
 import json
-import yaml
-import requests
 import traceback
 from datetime import datetime, timedelta
-from threading import Thread
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
 
-from nicehash_api import NiceHash
+import http_transport
+import metrics
+import ratelimit
+from nicehash_api import NiceHash, DEFAULT_ALGO, DEFAULT_MARKETS
+from nicehash_orderbook import OrderBookService
+from scheduler import AdaptiveSampler
+from order_state import OrderStateCache
+import detectors
+import sources
+import journal
+import config_reload
 import gnd_logging
 logger = gnd_logging.get_logger()
+order_logger = gnd_logging.get_logger("orders")
+
+## Metrics
+LOOP_DURATION = metrics.histogram("gnd_control_loop_seconds", "Control loop duration")
+ORDER_PRICE = metrics.gauge("gnd_order_price", "Active order price (BTC/kG/day)", ["algo", "market"])
+ORDER_SPEED = metrics.gauge("gnd_order_accepted_speed", "Active order accepted speed (kG/s)", ["algo", "market"])
+ORDER_REMAINING = metrics.gauge("gnd_order_remaining_btc", "Active order remaining amount (BTC)", ["algo", "market"])
+UNDER_ATTACK = metrics.gauge("gnd_under_attack", "Defender attack state (1 = attack)", ["algo"])
+
+# Can also be set as environment variables (see getConfig)
+CREDENTIALS = ["NICEHASH_API_ID", "NICEHASH_API_KEY", "NICEHASH_ORG_ID"]
+
+
+# Algorithms to defend from config.yml ALGORITHMS: { algo: [markets] }
+def getAlgorithms(config):
+    algos = config.get("ALGORITHMS") or { DEFAULT_ALGO: {} }
+    return dict((algo, list((settings or {}).get("MARKETS", DEFAULT_MARKETS))) for algo, settings in algos.items())
 
 
 class GrinNiceHashDefender():
-    def __init__(self):
-        self.nh_api = NiceHash()
+    def __init__(self, nh_api=None, clock=datetime.now, algos=None):
+        self.nh_api = nh_api if nh_api is not None else NiceHash()
+        self.clock = clock    # Replaced by the replay engine to run on recorded time
+        self.orderbook = None
         self.config = None
-        self.under_attack = False
-        self.attack_start = None
-        self.nh_pool_id = None
-        self.nh_orders = { "EU": None, "USA": None }
+        self.config_path = "config.yml"
+        self.config_lock = Lock()     # A config reload waits for the running control loop
+        self.sampler = None
+        self.grin51 = {}         # { algo: Grin51 }
+        self.order_executor = None
         self.nh_order_add_duration = None
         self.attack_stats = {}
+        self.journal = None      # Audit journal (config.yml JOURNAL_DIR)
+        self.order_states = OrderStateCache()
+        self.detectors = None    # DetectorSet, built from the config on first use
+        self.wake = Event()      # Set to run the control loop right away (see wakeUp)
+        self.wake_listeners = [] # Called by wakeUp - for runtimes that wait on something else
+        self.setAlgorithms(algos if algos is not None else { DEFAULT_ALGO: DEFAULT_MARKETS })
+
+    # algos: { algo: [markets] }
+    # Attack state is kept per algo, orders in a table keyed by (algo, market)
+    def setAlgorithms(self, algos):
+        self.algos = dict((algo, list(markets)) for algo, markets in algos.items())
+        self.under_attack = dict((algo, False) for algo in self.algos)
+        self.attack_start = dict((algo, None) for algo in self.algos)
+        self.incidents = dict((algo, 0) for algo in self.algos)     # Journal incident id, 0 when not defending
+        self.nh_pool_ids = dict((algo, None) for algo in self.algos)
+        self.nh_orders = dict(((algo, market), None) for algo, markets in self.algos.items() for market in markets)
+        if self.order_executor is not None:
+            self.order_executor.shutdown(wait=False)
+        self.order_executor = ThreadPoolExecutor(max_workers=len(self.nh_orders), thread_name_prefix="orders")
+
+    # Order setting for one algo: its ALGORITHMS entry overrides the global value
+    def getSetting(self, algo, key):
+        overrides = (self.config.get("ALGORITHMS") or {}).get(algo) or {}
+        return overrides.get(key, self.config[key])
+
+    # Append to the audit journal - a journal problem never stops the defense
+    def writeJournal(self, kind, payload, incident=0, value=0.0, btc=0.0, order_id=None, ok=True):
+        if self.journal is None:
+            return
+        try:
+            self.journal.record(self.clock().timestamp(), kind, payload, incident, value, btc, order_id, ok)
+        except Exception as e:
+            logger.error("Error writing audit journal: {}".format(e))
+
+    def isUnderAttack(self):
+        return any(self.under_attack.values())
 
     def getConfig(self):
-        if not os.path.exists('config.yml'):
+        if not os.path.exists(self.config_path):
             print("Failed to find configuration file")
             sys.exit(1)
-        with open('config.yml', 'r') as c:
-            cfg = c.read()
-            try:
-                self.config = yaml.safe_load(cfg)[0]
-            except Exception as e:
-                logger.error("Failed to load configuration.  Check syntax.\n{}".format(e))
-                sys.exit(1)
+        try:
+            self.config = config_reload.load(self.config_path)
+        except Exception as e:
+            logger.error("Failed to load configuration.  Check syntax.\n{}".format(e))
+            sys.exit(1)
+        gnd_logging.configure(self.config)
+        unknown = config_reload.getUnknownKeys(self.config)
+        if len(unknown) > 0:
+            logger.warning("Unknown settings in {}: {}".format(self.config_path, ", ".join(unknown)))
         self.nh_order_add_duration = timedelta(minutes=int(self.config["ADD_ORDER_DURATION"]))
+        self.order_states = OrderStateCache(self.config.get("ORDER_STATUS_INTERVAL", 300))
+        self.setAlgorithms(getAlgorithms(self.config))
+        # Shared keep-alive HTTP connection pools for all modules
+        http_transport.configure(self.config)
+        ratelimit.configure(self.config)
+        if self.config.get("JOURNAL_DIR"):
+            self.journal = journal.Journal(self.config["JOURNAL_DIR"])
+        if self.config.get("METRICS_PORT"):
+            metrics.startServer(self.config["METRICS_PORT"], self.config.get("METRICS_HOST", "127.0.0.1"))
+            logger.warning("Serving metrics on port {}".format(self.config["METRICS_PORT"]))
         try:
             if self.config["NICEHASH_API_ID"] == "":
                 self.config["NICEHASH_API_ID"] = os.environ["NICEHASH_API_ID"]
@@ -64,164 +141,424 @@ class GrinNiceHashDefender():
         except Exception as e:
             logger.error("Failed to find NICEHASH_API_ID and/or NICEHASH_API_KEY and/or NICEHASH_ORG_ID: {}".format(e))
             sys.exit(1)
+        # Poll faster as the grin51 scores get close to the attack threashold
+        self.sampler = AdaptiveSampler(
+                self.config["GRIN51_SCORE_THREASHOLD"],
+                min_interval = self.config.get("POLL_MIN_INTERVAL", 60),
+                max_interval = self.config.get("POLL_MAX_INTERVAL", 60),
+                approach = self.config.get("POLL_APPROACH", 0.85),
+                api_budget = self.config.get("POLL_API_BUDGET"),
+            )
+        # One shared orderbook fetch per algo feeds both grin51 and order management
+        self.orderbook = OrderBookService(gnd_logging.get_logger("orderbook"), list(self.algos), nh_api=self.nh_api, sampler=self.sampler)
+        self.grin51 = {}
+        if "grin51" in detectors.getNames(self.config):
+            logger.warning("Loading Grin51 detection module")
+            from grin51 import Grin51, graphSize, NICEHASH_SPEED_UNITS
+            price_from = None
+            for algo, markets in self.algos.items():
+                if algo not in NICEHASH_SPEED_UNITS:
+                    logger.error("Grin51 detection does not support {} (unknown NiceHash speed unit) - only the other detectors watch it".format(algo))
+                    continue
+                history_dir = self.config.get("GRIN51_HISTORY_DIR")
+                if history_dir:
+                    history_dir = os.path.join(history_dir, algo)
+                grin_sources = { "grin_speed": sources.build("grin_speed", self.config, graphSize(algo)) }
+                if price_from is None:
+                    grin_sources["grin_price"] = sources.build("grin_price", self.config)
+                self.grin51[algo] = Grin51(self.config["GRIN51_SCORE_THREASHOLD"], self.config["GRIN51_MIN_HISTORY"], self.config["GRIN51_MAX_HISTORY"], orderbook=self.orderbook, history_dir=history_dir, sampler=self.sampler, algo=algo, markets=markets, price_from=price_from, baseline_days=self.config.get("GRIN51_BASELINE_DAYS", 30), baseline_check=self.config.get("GRIN51_BASELINE_CHECK", False), score_function=self.config.get("GRIN51_SCORE_FUNCTION", "mean"), min_zscore=self.config.get("GRIN51_MIN_ZSCORE", 0), sources=grin_sources)
+                self.grin51[algo].scheduler.addListener(self.onDetectionChange)
+                # Every algo scores against the same grin price - poll it once
+                if price_from is None:
+                    price_from = self.grin51[algo]
+
+    # Watch config.yml for changes (config.yml CONFIG_POLL_INTERVAL, 0 to disable)
+    def startConfigWatcher(self):
+        interval = self.config.get("CONFIG_POLL_INTERVAL", 5)
+        if interval:
+            config_reload.ConfigWatcher(logger, self.config_path, self.reloadConfig, interval).start()
+
+    # A changed config.yml that validated - the live settings are applied
+    # together, between two control loops.  Settings that need a restart
+    # keep their running value.
+    def reloadConfig(self, config):
+        for key in CREDENTIALS:
+            if config.get(key) == "":
+                config[key] = self.config[key]
+        with self.config_lock:
+            config, live, restart = config_reload.split(self.config, config)
+            for change in restart:
+                logger.warning("Config change needs a restart, keeping the running value - {}".format(config_reload.formatChange(change)))
+            if len(live) == 0:
+                return
+            self.applyConfig(config, live)
+            for change in live:
+                logger.warning("Config changed - {}".format(config_reload.formatChange(change)))
+            self.writeJournal(journal.CONFIG, {
+                    "changes": [config_reload.formatChange(change) for change in live],
+                    "restart": [config_reload.formatChange(change) for change in restart],
+                }, max(self.incidents.values() or [0]), len(live))
+        # Run the control loop now with the new settings
+        self.wakeUp()
+
+    # Run the control loop right away, in either runtime (may be called from any thread)
+    def wakeUp(self):
+        self.wake.set()
+        for callback in self.wake_listeners:
+            callback()
+
+    # Point everything that copied a setting at startup at the new values
+    def applyConfig(self, config, changes):
+        self.config = config
+        self.nh_order_add_duration = timedelta(minutes=int(config["ADD_ORDER_DURATION"]))
+        self.order_states.status_interval = config.get("ORDER_STATUS_INTERVAL", 300)
+        gnd_logging.configure(config)
+        if self.sampler is not None:
+            self.sampler.configure(
+                    config["GRIN51_SCORE_THREASHOLD"],
+                    min_interval = config.get("POLL_MIN_INTERVAL", 60),
+                    max_interval = config.get("POLL_MAX_INTERVAL", 60),
+                    approach = config.get("POLL_APPROACH", 0.85),
+                    api_budget = config.get("POLL_API_BUDGET"),
+                )
+        for grin51 in self.grin51.values():
+            grin51.configure(config["GRIN51_SCORE_THREASHOLD"], config.get("GRIN51_BASELINE_CHECK", False))
+            for source in grin51.sources.values():
+                source.configure(config.get("SOURCE_HEDGE_DELAY", 1.0), config.get("SOURCE_TIMEOUT", 10))
+        # Detectors read their settings when built - rebuild them, keeping their cached answers
+        if self.detectors is not None and any(path[0] in config_reload.DETECTION_SETTINGS for path, old, new in changes):
+            previous = self.detectors
+            self.detectors = detectors.build(config, logger, self.grin51)
+            self.detectors.adopt(previous)
+            previous.close()
+
+    def timeStep(self, fn):
+        started = time.time()
         try:
-            self.nh_pool_id = self.nh_api.getPoolId(self.config["POOL_NAME"])
+            result = fn()
+            return time.time() - started, result, None
         except Exception as e:
-            logger.error("Failed to connect to your nicehash account: {}".format(e))
-            sys.exit(1)
-        if self.nh_pool_id is None:
-            logger.error("Failed to find pool {} in your NiceHash account".format(self.config["POOL_NAME"]))
-            sys.exit(1)
-        if self.config["CHECK_TYPE"] in ["grin51", "all"]:
-            logger.warning("Loading Grin51 detection module")
-            from grin51 import Grin51
-            self.grin51 = Grin51(self.config["GRIN51_SCORE_THREASHOLD"], self.config["GRIN51_MIN_HISTORY"], self.config["GRIN51_MAX_HISTORY"])
-            self.grin51.run()
-            logger.warning("Grin51 detection module is running")
+            return time.time() - started, None, e
+
+    # Run independent startup steps at the same time, reporting how long each took
+    # Returns { name: (duration, result, exception) }
+    def runStartupSteps(self, steps):
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix="startup") as executor:
+            futures = dict((name, executor.submit(self.timeStep, fn)) for name, fn in steps.items())
+            for name, future in futures.items():
+                results[name] = future.result()
+                duration, result, error = results[name]
+                if error is None:
+                    logger.warning("Startup step {} done in {:.3f}s".format(name, duration))
+                else:
+                    logger.error("Startup step {} failed in {:.3f}s: {}".format(name, duration, error))
+        return results
+
+    def startup(self):
+        started = time.time()
+        for algo, grin51 in self.grin51.items():
+            # Local history first so the watchers exist to receive fresh samples
+            duration, result, error = self.timeStep(grin51.createWatchers)
+            if error is not None:
+                logger.error("Startup step grin51_history_{} failed in {:.3f}s: {}".format(algo, duration, error))
+                sys.exit(1)
+            logger.warning("Startup step grin51_history_{} done in {:.3f}s".format(algo, duration))
+        steps = {}
+        for algo, markets in self.algos.items():
+            steps["pool_{}".format(algo)] = (lambda a: lambda: self.nh_api.getPoolId(self.getSetting(a, "POOL_NAME")))(algo)
+            steps["market_factor_{}".format(algo)] = (lambda a: lambda: self.nh_api.getMarketFactorData(a))(algo)
+            steps["orderbook_{}".format(algo)] = (lambda a: lambda: self.orderbook.refresh(a))(algo)
+            for market in markets:
+                steps["orders_{}_{}".format(algo, market)] = (lambda a, m: lambda: self.nh_api.getMyOrders(m, a))(algo, market)
+        for algo, grin51 in self.grin51.items():
+            for watcher in grin51.getPollingWatchers():
+                steps["{}_{}".format(watcher.name, algo)] = watcher.fetch
+        results = self.runStartupSteps(steps)
+
+        for algo, markets in self.algos.items():
+            duration, self.nh_pool_ids[algo], error = results["pool_{}".format(algo)]
+            if error is not None:
+                logger.error("Failed to connect to your nicehash account: {}".format(error))
+                sys.exit(1)
+            if self.nh_pool_ids[algo] is None:
+                logger.error("Failed to find pool {} for {} in your NiceHash account".format(self.getSetting(algo, "POOL_NAME"), algo))
+                sys.exit(1)
+            for market in markets:
+                duration, orders, error = results["orders_{}_{}".format(algo, market)]
+                if error is None:
+                    self.adoptOrders(algo, market, orders)
+        logger.warning("Startup completed in {:.3f}s".format(time.time() - started))
+
+    # Take over active orders left on our pool by a previous run, so they are
+    # managed (and cleaned up) instead of running unattended
+    def adoptOrders(self, algo, market, orders):
+        ours = [o for o in orders if o.get("alive", True) and o.get("pool", {}).get("id") == self.nh_pool_ids[algo]]
+        if len(ours) == 0:
+            return
+        self.nh_orders[(algo, market)] = ours[0]["id"]
+        self.order_states.update((algo, market), ours[0], self.clock().timestamp())
+        logger.warning("Adopted existing {} {} order: {}".format(algo, market, ours[0]["id"]))
+        # Without an attack the normal cleanup cancels it after ADD_ORDER_DURATION
+        if self.attack_start[algo] is None:
+            self.attack_start[algo] = self.clock()
+        for extra in ours[1:]:
+            try:
+                self.nh_api.cancelOrder(extra["id"])
+                logger.warning("Canceled duplicate {} {} order: {}".format(algo, market, extra["id"]))
+            except Exception as e:
+                logger.error("Error canceling duplicate {} {} order: {}".format(algo, market, e))
+
+    # Grin51 detection state changed - dont wait for the next loop interval
+    def onDetectionChange(self, under_attack):
+        self.wakeUp()
 
     def checkForAttack(self):
-        attack = False
-        if self.config["CHECK_TYPE"] in ["file", "all"]:
-            file_stats = {"exists": False}
-            if os.path.exists('attack'):
-                attack = True
-                file_stats["exists"] = True
-            self.attack_stats["file"] = file_stats
-        if self.config["CHECK_TYPE"] in ["grin51", "all"]:
-            if self.grin51.under_attack:
-                attack = True
-            self.attack_stats["grin51"] = self.grin51.get_stats()
-        if self.config["CHECK_TYPE"] in ["grin-health", "all"]:
-            status_url = self.config["GRINHEALTH_URL"]
+        # Detectors run concurrently, each within its own deadline
+        if self.detectors is None:
+            self.detectors = detectors.build(self.config, logger, self.grin51)
+        algo_attack, self.attack_stats = self.detectors.evaluate(list(self.algos))
+        if self.journal is not None:
+            # Closest any algo is to detection: the lowest of its scores
+            scores = [min(stats["score"].values()) for stats in self.attack_stats.get("grin51", {}).values()]
+            self.writeJournal(journal.SNAPSHOT, self.attack_stats, value=max(scores or [0.0]))
+        for algo in self.algos:
+            # Set some values for attack state
+            if algo_attack[algo]:
+                if not self.under_attack[algo]:
+                    if self.attack_start[algo] is None and self.journal is not None:
+                        self.incidents[algo] = self.journal.newIncident()
+                    self.writeJournal(journal.STATE, {"algo": algo, "state": "attack"}, self.incidents[algo], journal.STATE_ATTACK)
+                self.under_attack[algo] = True
+                self.attack_start[algo] = self.clock()
+            else:
+                if self.under_attack[algo]:
+                    self.writeJournal(journal.STATE, {"algo": algo, "state": "clear"}, self.incidents[algo], journal.STATE_CLEAR)
+                self.under_attack[algo] = False
+                # Dont reset start time since we still use that for a bit
+            UNDER_ATTACK.set(1 if self.under_attack[algo] else 0, algo=algo)
+
+    # Price to bid on market
+    #  "depth":  outbid enough of the orderbook to secure MAX_SPEED of hashpower
+    #  "lowest": just outbid the lowest priced working order
+    # Both add ORDER_PRICE_ADD and never go over MAX_PRICE
+    # None when the market has no working orders to price against
+    def getBidPrice(self, snapshot, algo, market):
+        price = None
+        depth = snapshot.getDepth(market)
+        max_speed = self.getSetting(algo, "MAX_SPEED")
+        max_price = self.getSetting(algo, "MAX_PRICE")
+        price_add = self.getSetting(algo, "ORDER_PRICE_ADD")
+        if self.config.get("ORDER_PRICING", "depth") == "depth" and depth is not None:
+            own_orders = [order_id for order_id in self.nh_orders.values() if order_id is not None]
             try:
-                r = requests.get(status_url)
-                self.attack_stats["grin-health"] = r.json()
-                if int(self.attack_stats["grin-health"]["overall_score"]) <= int(self.config["GRINHEALTH_SCORE_THREASHOLD"]):
-                    attack = True
+                price = depth.getPriceForSpeed(float(max_speed), exclude=own_orders) + price_add
+            except IndexError:
+                # Nothing but our own orders working - fall back to the lowest price
+                pass
+            if price is not None and price > max_price:
+                logger.warning("{} {}: {} needed to secure {} speed, capped at MAX_PRICE which secures {}".format(
+                        algo, market, price, max_speed, depth.getSpeedBelow(max_price)))
+        if price is None:
+            price = snapshot.getPrice(market)
+            if price is None:
+                return None
+            price += price_add
+        return min(price, max_price)
+
+    def recordOrder(self, algo, market, state):
+        if state is None:
+            for gauge in [ORDER_PRICE, ORDER_SPEED, ORDER_REMAINING]:
+                gauge.set(0, algo=algo, market=market)
+            return
+        ORDER_PRICE.set(state.price, algo=algo, market=market)
+        ORDER_SPEED.set(state.accepted_speed, algo=algo, market=market)
+        ORDER_REMAINING.set(state.available, algo=algo, market=market)
+
+    # Create / update / cancel the order on one market
+    # Runs concurrently for each market, so errors are handled per market
+    def manageMarketOrder(self, algo, market, price, cancel):
+        started = time.time()
+        key = (algo, market)
+        if self.under_attack[algo] and self.nh_orders[key] is None and price is not None:
+            # Create the order
+            request = {
+                    "algo": algo,
+                    "market": market,
+                    "pool_id": self.nh_pool_ids[algo],
+                    "price": price,
+                    "speed": self.getSetting(algo, "MAX_SPEED"),
+                    "amount": self.getSetting(algo, "ORDER_AMOUNT"),
+                }
+            call_started = time.time()
+            try:
+                new_order = self.nh_api.createOrder(**request)
+                self.journalOrderCall(journal.CREATE, algo, market, request, call_started, new_order)
+                self.nh_orders[key] = new_order["id"]
+                self.order_states.update(key, new_order, self.clock().timestamp())
+                order_logger.warning("Created {} {} Order: {}".format(algo, market, self.nh_orders[key]))
             except Exception as e:
-                logger.warning("Error: Failed to call grin-health status api: {}".format(e))
-        # Set some values for attack state
-        if attack:
-            self.under_attack = True
-            self.attack_start = datetime.now()
-        else:
-            self.under_attack = False
-            # Dont reset start time since we still use that for a bit
+                self.journalOrderCall(journal.CREATE, algo, market, request, call_started, error=e)
+                order_logger.error("Error creating {} {} order: {}".format(algo, market, e))
 
-    def manageOrders(self):
-        if self.attack_start is not None:
+        # Update order price limits if needed - only when the bid changed
+        if self.nh_orders[key] is not None and price is not None:
+            request = None
             try:
-                eu_price = min(self.nh_api.getCurrentPrice("EU", "GRINCUCKATOO32") + self.config["ORDER_PRICE_ADD"], self.config["MAX_PRICE"])
-                us_price = min(self.nh_api.getCurrentPrice("USA", "GRINCUCKATOO32") + self.config["ORDER_PRICE_ADD"], self.config["MAX_PRICE"])
-                logger.warn("nh eu_price: {}, nh us_price: {}".format(eu_price, us_price))
+                now = self.clock().timestamp()
+                if self.order_states.isStale(key, now):
+                    request = { "order_id": self.nh_orders[key] }
+                    call_started = time.time()
+                    order = self.nh_api.getOrder(self.nh_orders[key])
+                    self.journalOrderCall(journal.STATUS, algo, market, request, call_started, order)
+                    self.order_states.update(key, order, now)
+                state = self.order_states.get(key)
+                new_price = max(state.price, float(price))
+                speed = self.getSetting(algo, "MAX_SPEED")
+                order_logger.info("order price: {}, {} {} price: {}, new price: {}".format(state.price, algo, market, price, new_price))
+                if state.differs(new_price, speed):
+                    request = {
+                            "algo": algo,
+                            "order_id": self.nh_orders[key],
+                            "speed": speed,
+                            "price": new_price,
+                        }
+                    call_started = time.time()
+                    order = self.nh_api.updateOrder(**request)
+                    self.journalOrderCall(journal.UPDATE, algo, market, request, call_started, order)
+                    state = self.order_states.update(key, order, now)
+                self.recordOrder(algo, market, state)
+                order_logger.warning("{} {} order status: Speed: {}, Price: {}, BTC_Remaining: {}".format(
+                        algo, market, state.accepted_speed, state.price, state.available))
             except Exception as e:
-                logger.error("Error getting NH price data: {}".format(e))
-                return
-        if self.under_attack:
-            # Create orders if needed
-            if self.nh_orders["EU"] is None:
-                # Create the order
-                try:
-                    new_order = self.nh_api.createOrder(
-                                    algo = "GRINCUCKATOO32",
-                                    market = "EU",
-                                    pool_id = self.nh_pool_id,
-                                    price = eu_price,
-                                    speed = self.config["MAX_SPEED"],
-                                    amount = self.config["ORDER_AMOUNT"],
-                                )
-                    self.nh_orders["EU"] = new_order["id"] 
-                    logger.warning("Created EU Order: {}".format(self.nh_orders["EU"]))
-# XXX DEBUGGING XXX
-#                    self.nh_orders["EU"] = "0e69ab28-b9c0-40eb-bda7-3a0a975440c7"
-# XXX DEBUGGING XXX
-                except Exception as e:
-                    logger.error("Error creating EU order: {}".format(e))
-            if self.nh_orders["USA"] is None:
-                try:
-                    new_order = self.nh_api.createOrder(
-                                    algo = "GRINCUCKATOO32",
-                                    market = "USA",
-                                    pool_id = self.nh_pool_id,
-                                    price = us_price,
-                                    speed = self.config["MAX_SPEED"],
-                                    amount = self.config["ORDER_AMOUNT"],
-                                )
-                    self.nh_orders["USA"] = new_order["id"] 
-                    logger.warning("Created USA Order: {}".format(self.nh_orders["USA"]))
-# XXX DEBUGGING XXX
-#                    self.nh_orders["USA"] = "a1bd4612-1279-4fd6-be79-137384b54c7f"
-# XXX DEBUGGING XXX
-                except Exception as e:
-                    logger.error("Error creating USA order: {}".format(e))
-
-
-
-
-        # Update order price limits if needed
-        if self.nh_orders["EU"] is not None:
-            # Update the EU order
+                # Not sure what NiceHash has now - re-read the order next time
+                self.order_states.invalidate(key)
+                if request is not None:
+                    self.journalOrderCall(journal.UPDATE if "price" in request else journal.STATUS, algo, market, request, call_started, error=e)
+                order_logger.error("Error updating {} {} order: {}".format(algo, market, e))
+
+        # Following an attack ensure no orders are active after minimum run duration
+        if cancel and self.nh_orders[key] is not None:
+            request = { "order_id": self.nh_orders[key] }
+            call_started = time.time()
             try:
-                order = self.nh_api.getOrder(self.nh_orders["EU"])
-                new_eu_price = max(float(order["price"]), float(eu_price))
-                logger.info("order price: {}, eu_price: {}, new_eu_price: {}".format(order["price"], eu_price, new_eu_price))
-                order = self.nh_api.updateOrder(
-                                algo = "GRINCUCKATOO32",
-                                order_id = self.nh_orders["EU"],
-                                speed = self.config["MAX_SPEED"],
-                                price = new_eu_price,
-                            )
-                logger.warning("EU order status:")
-                if self.config["VERBOSE"]:
-                    logger.warning(order)
-                else:
-                    logger.error("Speed: {}, Price: {}, BTC_Remaining: {}".format(order["acceptedCurrentSpeed"], order["price"], order["availableAmount"]))
+                result = self.nh_api.cancelOrder(self.nh_orders[key])
+                self.journalOrderCall(journal.CANCEL, algo, market, request, call_started, result)
+                if self.journal is not None:
+                    self.journalFinalStatus(algo, market, self.nh_orders[key])
+                order_logger.warning("Deleted {} {} order: {}".format(algo, market, self.nh_orders[key]))
+                self.nh_orders[key] = None
+                self.order_states.invalidate(key)
+                self.recordOrder(algo, market, None)
             except Exception as e:
-                logger.error("Error updating EU order: {}".format(e))
-        if self.nh_orders["USA"] is not None:
-            # Update the order
+                self.journalOrderCall(journal.CANCEL, algo, market, request, call_started, error=e)
+                order_logger.error("Error canceling {} {} order: {}".format(algo, market, e))
+        return time.time() - started
+
+    # Journal what the canceled order paid in the end - the cached order
+    # state can be ORDER_STATUS_INTERVAL old, so the journal would under-report
+    def journalFinalStatus(self, algo, market, order_id):
+        request = { "order_id": order_id }
+        call_started = time.time()
+        try:
+            order = self.nh_api.getOrder(order_id)
+            self.journalOrderCall(journal.STATUS, algo, market, request, call_started, order)
+        except Exception as e:
+            self.journalOrderCall(journal.STATUS, algo, market, request, call_started, error=e)
+            order_logger.error("Error reading canceled {} {} order {}: {}".format(algo, market, order_id, e))
+
+    # Journal one order api call - the order payedAmount is what the incident has spent on it so far
+    def journalOrderCall(self, kind, algo, market, request, call_started, response=None, error=None):
+        if self.journal is None:
+            return
+        latency = time.time() - call_started
+        order_id = request.get("order_id")
+        paid = 0.0
+        if isinstance(response, dict):
+            order_id = response.get("id", order_id)
             try:
-                order = self.nh_api.getOrder(self.nh_orders["USA"])
-                new_us_price = max(float(order["price"]), float(us_price))
-                logger.info("order price: {}, us_price: {}, new_us_price: {}".format(order["price"], us_price, new_us_price))
-                order = self.nh_api.updateOrder(
-                                algo = "GRINCUCKATOO32",
-                                order_id = self.nh_orders["USA"],
-                                speed = self.config["MAX_SPEED"],
-                                price = new_us_price,
-                            )
-                logger.warning("USA order status:")
-                if self.config["VERBOSE"]:
-                    logger.warning(order)
-                else:
-                    logger.error("Speed: {}, Price: {}, BTC_Remaining: {}".format(order["acceptedCurrentSpeed"], order["price"], order["availableAmount"] ))
+                paid = float(response.get("payedAmount", 0.0))
+            except (TypeError, ValueError):
+                pass
+        payload = {
+                "algo": algo,
+                "market": market,
+                "request": request,
+                "response": response,
+                "error": None if error is None else str(error),
+                "latency": latency,
+            }
+        self.writeJournal(kind, payload, self.incidents[algo], latency, paid, order_id, error is None)
+
+    def manageOrders(self):
+        started = time.time()
+        prices = dict((key, None) for key in self.nh_orders)
+        skip = []       # Algos without price data this loop
+        for algo, markets in self.algos.items():
+            if self.attack_start[algo] is None:
+                continue
+            try:
+                # Use the shared snapshot unless it is older than one loop interval
+                snapshot = self.orderbook.getSnapshot(algo, max_age=self.config["LOOP_INTERVAL"])
+                for market in markets:
+                    prices[(algo, market)] = self.getBidPrice(snapshot, algo, market)
+                    if prices[(algo, market)] is None:
+                        # Only this market waits for the next loop
+                        order_logger.warning("No working {} {} orders to price a bid against - not bidding there this loop".format(algo, market))
+                order_logger.info("nh {} prices: {}".format(algo, dict((m, prices[(algo, m)]) for m in markets)))
             except Exception as e:
-                logger.error("Error updating USA order: {}".format(e))
-            
-        
-        # Following an attack ensure no orders are active after minimum run duration
-        if not self.under_attack and self.attack_start is not None:
-            logger.error("Attack start: {}".format(self.attack_start))
-            logger.error("Time remaining: {}".format(self.nh_order_add_duration-(datetime.now() - self.attack_start)))
-            if datetime.now() - self.attack_start > self.nh_order_add_duration:
-                if self.nh_orders["EU"] is not None:
-                    try:
-                        self.nh_api.cancelOrder(self.nh_orders["EU"])
-                        logger.error("Deleted EU order: {}".format(self.nh_orders["EU"]))
-                        self.nh_orders["EU"] = None
-                    except Exception as e:
-                        logger.error("Error canceling EU order: {}".format(e))
-                if self.nh_orders["USA"] is not None:
-                    try:
-                        self.nh_api.cancelOrder(self.nh_orders["USA"])
-                        logger.error("Deleted USA order: {}".format(self.nh_orders["USA"]))
-                        self.nh_orders["USA"] = None
-                    except Exception as e:
-                        logger.error("Error canceling USA order: {}".format(e))
-            if self.nh_orders["EU"] is None and self.nh_orders["USA"] is None:
-                # The attack is over, we are done defending, all is cleaned up
-                self.attack_start = None
-            
+                order_logger.error("Error getting NH {} price data: {}".format(algo, e))
+                skip.append(algo)
+
+        cancel = dict((algo, False) for algo in self.algos)
+        for algo in self.algos:
+            if not self.under_attack[algo] and self.attack_start[algo] is not None and algo not in skip:
+                order_logger.info("{} attack start: {}".format(algo, self.attack_start[algo]))
+                order_logger.info("{} time remaining: {}".format(algo, self.nh_order_add_duration-(self.clock() - self.attack_start[algo])))
+                cancel[algo] = self.clock() - self.attack_start[algo] > self.nh_order_add_duration
+
+        # Work all markets at the same time - each market costs up to four
+        # round trips to NiceHash and they dont depend on each other
+        keys = [key for key in self.nh_orders if key[0] not in skip and (self.under_attack[key[0]] or self.nh_orders[key] is not None)]
+        if len(keys) == 1:
+            durations = [self.manageMarketOrder(keys[0][0], keys[0][1], prices[keys[0]], cancel[keys[0][0]])]
+        else:
+            durations = list(self.order_executor.map(lambda key: self.manageMarketOrder(key[0], key[1], prices[key], cancel[key[0]]), keys))
+        if len(keys) > 0:
+            order_logger.warning("Managed orders in {:.3f}s ({})".format(
+                    time.time() - started,
+                    ", ".join("{} {}: {:.3f}s".format(a, m, d) for (a, m), d in zip(keys, durations)),
+                ))
+
+        for algo, markets in self.algos.items():
+            if not self.under_attack[algo] and self.attack_start[algo] is not None:
+                if all(self.nh_orders[(algo, market)] is None for market in markets):
+                    # The attack is over, we are done defending, all is cleaned up
+                    self.attack_start[algo] = None
+                    self.writeJournal(journal.STATE, {"algo": algo, "state": "closed"}, self.incidents[algo], journal.STATE_CLOSED)
+                    self.incidents[algo] = 0
+
+
+    # One pass of the control loop - shared by the threads and asyncio runtimes
+    def controlStep(self):
+        logger.warning("---> Starting control loop: {}".format(datetime.now()))
+        loop_start = time.time()
+        with self.config_lock:
+            try:
+                self.checkForAttack()
+                logger.warning("Under Attack: {}".format(self.under_attack))
+                logger.info("Attack Analysis Stats: {}".format(json.dumps(self.attack_stats)))
+                self.manageOrders()
+                for (algo, market), order_id in self.nh_orders.items():
+                    if order_id is not None:
+                        logger.warning("Managing {} {} NiceHash order: {}".format(algo, market, order_id))
+            except Exception as e:
+                logger.error("Unexpected Error: {}".format(e))
+                logger.warning("Attemping to continue...")
+        LOOP_DURATION.observe(time.time() - loop_start)
+        logger.warning("Control loop took {:.3f}s".format(time.time() - loop_start))
+        logger.warning("HTTP Connection Stats: {}".format(http_transport.get_transport().getStats()))
+        logger.warning("<--- Completed control loop\n\n")
 
     def run(self):
         # Load Tool Configuration
@@ -234,25 +571,25 @@ class GrinNiceHashDefender():
         except Exception as e:
             logger.error("Failed to load configuration: {}".format(e))
             sys.exit(1)
+        self.startConfigWatcher()
+        # Watchers, detection and order management as coroutines on one event loop
+        if self.config.get("RUNTIME", "threads") == "asyncio":
+            from async_runtime import AsyncRuntime
+            AsyncRuntime(self, logger).run()
+            return
+        self.startup()
+        if len(self.grin51) > 0:
+            for grin51 in self.grin51.values():
+                grin51.start()
+            for grin51 in self.grin51.values():
+                grin51.waitForHistory()
+            logger.warning("Grin51 detection module is running")
         # Run the Tool
         logger.warning("Running {}: {}".format(self.config["NAME"], datetime.now()))
         while True:
-            logger.warning("---> Starting control loop: {}".format(datetime.now()))
-            try:
-                self.checkForAttack()
-                logger.warning("Under Attack: {}".format(self.under_attack))
-                logger.warning("Attack Analysis Stats:")
-                logger.warning(json.loads(json.dumps(self.attack_stats)))
-                self.manageOrders()
-                if self.nh_orders["EU"] is not None:
-                    logger.warning("Managing EU NiceHash order: {}".format(self.nh_orders["EU"]))
-                if self.nh_orders["USA"] is not None:
-                    logger.warning("Managing US NiceHash order: {}".format(self.nh_orders["USA"]))
-            except Exception as e:
-                logger.error("Unexpected Error: {}".format(e))
-                logger.warning("Attemping to continue...")
-            logger.warning("<--- Completed control loop\n\n")
-            time.sleep(self.config["LOOP_INTERVAL"])
+            self.controlStep()
+            self.wake.wait(self.config["LOOP_INTERVAL"])
+            self.wake.clear()
 
 
 def main():
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import time
+import struct
+from threading import Lock
+
+
+##
+# Append-only on-disk sample history
+#
+# File layout: 8 byte magic header followed by fixed size little-endian
+# records of (float64 epoch timestamp, float64 value) - or another record
+# struct that starts with the timestamp (ex: rollup buckets).  Fixed records mean
+# the newest N samples can be read with a single seek from the end, and a
+# partially written record (crash mid-write) is simply ignored.  A read-only
+# store (ex: a query while the writer runs) never repairs the file.
+
+MAGIC = b"GNDHIST1"
+RECORD = struct.Struct("<dd")
+
+
+class HistoryStore():
+    def __init__(self, path, capacity, magic=MAGIC, record=RECORD, readonly=False):
+        self.path = path
+        self.capacity = int(capacity)
+        self.magic = magic
+        self.record = record
+        self.readonly = readonly
+        self.lock = Lock()
+        self.records = 0
+        self.fd = None
+        self.open()
+
+    def open(self):
+        if self.readonly:
+            fd = os.open(self.path, os.O_RDONLY)
+        else:
+            directory = os.path.dirname(self.path)
+            if directory != "":
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(fd).st_size
+        if size == 0 and not self.readonly:
+            os.write(fd, self.magic)
+            size = len(self.magic)
+        else:
+            header = os.pread(fd, len(self.magic), 0)
+            if header != self.magic:
+                os.close(fd)
+                raise Exception("{} is not a history file".format(self.path))
+        # Drop a torn trailing record so new appends stay aligned - a reader
+        # only skips it, it may be a record the writer is appending right now
+        extra = (size - len(self.magic)) % self.record.size
+        if extra != 0 and not self.readonly:
+            os.truncate(fd, size - extra)
+            size -= extra
+        self.records = max(0, (size - len(self.magic)) // self.record.size)
+        self.fd = fd
+
+    def append(self, value, ts):
+        self.appendRecord((ts, value))
+
+    def appendRecord(self, fields):
+        if self.readonly:
+            raise Exception("{} is open read-only".format(self.path))
+        with self.lock:
+            os.write(self.fd, self.record.pack(*fields))
+            self.records += 1
+            # Keep the file bounded: once it holds twice the window, rewrite
+            # it with just the newest window of samples
+            if self.records >= 2 * self.capacity:
+                self.compact()
+
+    # Return [(ts, value), ...] oldest to newest, at most capacity samples,
+    # optionally only those newer than max_age seconds
+    def load(self, max_age=None):
+        with self.lock:
+            count = min(self.records, self.capacity)
+            offset = len(self.magic) + (self.records - count) * self.record.size
+            data = os.pread(self.fd, count * self.record.size, offset)
+        samples = list(self.record.iter_unpack(data))
+        if max_age is not None:
+            oldest = time.time() - max_age
+            samples = [s for s in samples if s[0] >= oldest]
+        return samples
+
+    # count records starting at record number first
+    def read(self, first, count):
+        with self.lock:
+            first = max(0, min(first, self.records))
+            count = max(0, min(count, self.records - first))
+            data = os.pread(self.fd, count * self.record.size, len(self.magic) + first * self.record.size)
+        return list(self.record.iter_unpack(data))
+
+    # Number of the first record with a timestamp >= ts (records are in time order)
+    def find(self, ts):
+        low, high = 0, self.records
+        while low < high:
+            middle = (low + high) // 2
+            if self.read(middle, 1)[0][0] < ts:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def compact(self):
+        count = min(self.records, self.capacity)
+        offset = len(self.magic) + (self.records - count) * self.record.size
+        data = os.pread(self.fd, count * self.record.size, offset)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.magic)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+        self.records = count
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+
+def main():
+    # A few tests
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "test.hist")
+    store = HistoryStore(path, 100)
+    now = time.time()
+    for i in range(250):
+        store.append(float(i), now - 250 + i)
+    print("Records on disk: {}".format(store.records))
+    store.close()
+    store = HistoryStore(path, 100)
+    samples = store.load()
+    print("Reloaded {} samples: first={} last={}".format(len(samples), samples[0][1], samples[-1][1]))
+    print("Newer than 10s: {}".format(len(store.load(max_age=10))))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+
+##
+# Shared HTTP transport
+#
+# All outbound calls (NiceHash, GrinMint, CoinGecko, grin-health) go through
+# one requests.Session so connections to the same host are kept alive and
+# reused instead of paying a new TCP+TLS handshake every call.
+
+DEFAULT_POOL_SIZE = 4     # Connections kept open per host
+DEFAULT_TIMEOUT = 20      # Seconds
+
+
+class HttpTransport():
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, hosts=None):
+        # hosts: { "hostname": {"pool_size": int, "timeout": float} } per-host overrides
+        self.pool_size = int(pool_size)
+        self.timeout = float(timeout)
+        self.hosts = hosts if hosts is not None else {}
+        self.adapters = []
+        self.session = requests.Session()
+        self.mountAdapter("https://", self.pool_size)
+        self.mountAdapter("http://", self.pool_size)
+        for host, host_cfg in self.hosts.items():
+            if "pool_size" in host_cfg:
+                self.mountAdapter("https://{}/".format(host), host_cfg["pool_size"])
+
+    def mountAdapter(self, prefix, pool_size):
+        adapter = HTTPAdapter(pool_connections=max(len(self.hosts), 10), pool_maxsize=int(pool_size))
+        self.session.mount(prefix, adapter)
+        self.adapters.append(adapter)
+
+    def getTimeout(self, url):
+        host = urlsplit(url).hostname
+        host_cfg = self.hosts.get(host, {})
+        return float(host_cfg.get("timeout", self.timeout))
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.getTimeout(url)
+        return self.session.request(method, url, timeout=timeout, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    # Connection reuse counters, summed over every host pool
+    def getStats(self):
+        opened = 0
+        requests_sent = 0
+        for adapter in self.adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                requests_sent += pool.num_requests
+        return {
+                "requests": requests_sent,
+                "connections_opened": opened,
+                "connections_reused": max(requests_sent - opened, 0),
+            }
+
+    def close(self):
+        self.session.close()
+
+
+##
+# Process-wide transport
+
+_transport = None
+_transport_lock = Lock()
+
+def configure(config):
+    # Build the shared transport from the defender config.yml settings
+    global _transport
+    with _transport_lock:
+        if _transport is not None:
+            _transport.close()
+        _transport = HttpTransport(
+                pool_size = config.get("HTTP_POOL_SIZE", DEFAULT_POOL_SIZE),
+                timeout = config.get("HTTP_TIMEOUT", DEFAULT_TIMEOUT),
+                hosts = config.get("HTTP_HOSTS") or {},
+            )
+    return _transport
+
+def get_transport():
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HttpTransport()
+        return _transport
+
+CONNECTIONS = metrics.gauge("gnd_http_connections", "HTTP connections opened and reused by the shared transport", ["state"])
+CONNECTIONS.setFunction(lambda: get_transport().getStats()["connections_opened"], state="opened")
+CONNECTIONS.setFunction(lambda: get_transport().getStats()["connections_reused"], state="reused")
+
+
+
+def main():
+    # A few tests
+    transport = get_transport()
+    for i in range(3):
+        r = transport.get("https://api.grinmint.com/v2/networkStats")
+        print("Status: {}".format(r.status_code))
+    print("Stats: {}".format(transport.getStats()))
+
+if __name__ == "__main__":
+    main()
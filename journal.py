@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import sys
+import json
+import zlib
+import struct
+import hashlib
+import argparse
+from datetime import datetime
+from threading import Lock
+
+from history_store import HistoryStore
+
+
+##
+# Append-only audit journal
+#
+# Every attack_stats snapshot, attack state transition, order
+# create / update / cancel / status call (request, response, latency) and
+# applied config change is appended to JOURNAL_DIR:
+#   journal.dat   - zlib compressed json payloads, back to back
+#   events.idx    - HistoryStores of fixed size index records
+#   snapshots.idx   (ts, kind, ok, incident, value, btc, order key, payload offset, payload length)
+# State transitions, order calls and config changes go to events.idx, the
+# once-a-loop attack_stats snapshots to snapshots.idx.  Questions like "BTC spent per
+# attack" are answered from the small events index alone, and snapshots
+# around an incident are found by binary search on time, so months of
+# journal never need a full read.  Payloads are only read for the records
+# being shown.
+#
+# An incident starts when an algo is first detected under attack and is
+# closed once its orders are cleaned up after ADD_ORDER_DURATION.
+#
+# Query it with:  python journal.py [--dir journal] incidents | incident ID | spend
+
+INDEX_MAGIC = b"GNDJIDX1"
+INDEX_RECORD = struct.Struct("<dBBxxIddQQI")
+DATA_MAGIC = b"GNDJDAT1"
+
+# Record kinds
+SNAPSHOT = 1      # attack_stats, value = highest detection score (lowest of an algos scores)
+STATE = 2         # value = STATE_CLEAR / STATE_ATTACK / STATE_CLOSED
+CREATE = 3        # Order calls: value = call latency seconds, btc = order payedAmount
+UPDATE = 4
+CANCEL = 5
+STATUS = 6        # getOrder status refresh
+CONFIG = 7        # Applied config.yml change, value = settings changed
+
+KIND_NAMES = { SNAPSHOT: "snapshot", STATE: "state", CREATE: "createOrder", UPDATE: "updateOrder", CANCEL: "cancelOrder", STATUS: "getOrder", CONFIG: "config" }
+ORDER_KINDS = (CREATE, UPDATE, CANCEL, STATUS)
+
+STATE_CLEAR = 0
+STATE_ATTACK = 1
+STATE_CLOSED = 2
+
+UNLIMITED = 2 ** 62     # The indexes are never compacted
+ONSET_LOOKBACK = 6 * 60 * 60     # Seconds of snapshots before a detection searched for the score run-up
+
+
+# Stable 64 bit key for a NiceHash order id
+def orderKey(order_id):
+    if order_id is None:
+        return 0
+    return int.from_bytes(hashlib.blake2b(str(order_id).encode(), digest_size=8).digest(), "little")
+
+
+class IndexEntry():
+    __slots__ = ["ts", "kind", "ok", "incident", "value", "btc", "order", "offset", "length"]
+
+    def __init__(self, ts, kind, ok, incident, value, btc, order, offset, length):
+        self.ts = ts
+        self.kind = kind
+        self.ok = ok
+        self.incident = incident
+        self.value = value
+        self.btc = btc
+        self.order = order
+        self.offset = offset
+        self.length = length
+
+
+class Journal():
+    # readonly: for queries - the live journal of a running defender is never modified
+    def __init__(self, directory, readonly=False):
+        self.directory = directory
+        self.readonly = readonly
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = Lock()
+        self.events = HistoryStore(os.path.join(directory, "events.idx"), UNLIMITED, magic=INDEX_MAGIC, record=INDEX_RECORD, readonly=readonly)
+        self.snapshots = HistoryStore(os.path.join(directory, "snapshots.idx"), UNLIMITED, magic=INDEX_MAGIC, record=INDEX_RECORD, readonly=readonly)
+        self.data_path = os.path.join(directory, "journal.dat")
+        if readonly:
+            self.data = os.open(self.data_path, os.O_RDONLY)
+        else:
+            self.data = os.open(self.data_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self.data).st_size
+        if size == 0 and not readonly:
+            os.write(self.data, DATA_MAGIC)
+            size = len(DATA_MAGIC)
+        elif os.pread(self.data, len(DATA_MAGIC), 0) != DATA_MAGIC:
+            os.close(self.data)
+            raise Exception("{} is not a journal file".format(self.data_path))
+        events = self.entries()
+        self.last_incident = max([e.incident for e in events] or [0])
+        # Drop a payload written without its index record (crash between the two)
+        end = len(DATA_MAGIC)
+        for store in [self.events, self.snapshots]:
+            last = store.read(store.records - 1, 1)
+            if len(last) > 0:
+                end = max(end, last[0][7] + last[0][8])
+        if size > end and not readonly:
+            os.truncate(self.data, end)
+            size = end
+        self.size = size
+
+    def newIncident(self):
+        with self.lock:
+            self.last_incident += 1
+            return self.last_incident
+
+    def record(self, ts, kind, payload, incident=0, value=0.0, btc=0.0, order_id=None, ok=True):
+        if self.readonly:
+            raise Exception("Journal {} is open read-only".format(self.directory))
+        data = zlib.compress(json.dumps(payload, separators=(",", ":"), default=str).encode(), 1)
+        with self.lock:
+            offset = self.size
+            os.write(self.data, data)
+            self.size += len(data)
+            store = self.snapshots if kind == SNAPSHOT else self.events
+            store.appendRecord((ts, kind, 1 if ok else 0, incident, float(value), float(btc or 0.0), orderKey(order_id), offset, len(data)))
+
+    # State and order call index entries oldest first, optionally only some kinds
+    def entries(self, kinds=None):
+        found = []
+        for fields in self.events.load():
+            entry = IndexEntry(*fields)
+            if kinds is None or entry.kind in kinds:
+                found.append(entry)
+        return found
+
+    # Snapshot index entries from since to until
+    def snapshotEntries(self, since, until):
+        first = self.snapshots.find(since)
+        found = []
+        for fields in self.snapshots.read(first, self.snapshots.find(until + 1e-6) - first):
+            found.append(IndexEntry(*fields))
+        return found
+
+    def payload(self, entry):
+        return json.loads(zlib.decompress(os.pread(self.data, entry.length, entry.offset)))
+
+    def close(self):
+        with self.lock:
+            self.events.close()
+            self.snapshots.close()
+            if self.data is not None:
+                os.close(self.data)
+                self.data = None
+
+
+##
+# Queries
+
+# Start of the run of above normal (> 1.0) scores that led up to a detection
+def getOnset(journal, detected):
+    onset = detected
+    for entry in reversed(journal.snapshotEntries(detected - ONSET_LOOKBACK, detected)):
+        if entry.value <= 1.0:
+            break
+        onset = entry.ts
+    return onset
+
+# Summaries of every incident from the index
+def incidentReport(journal):
+    incidents = {}
+    for entry in journal.entries():
+        if entry.incident == 0:
+            continue
+        incident = incidents.get(entry.incident)
+        if incident is None:
+            incident = incidents[entry.incident] = {
+                    "incident": entry.incident,
+                    "detected": None,
+                    "onset": None,
+                    "first_order": None,
+                    "closed": None,
+                    "orders": set(),
+                    "paid": {},
+                    "calls": 0,
+                    "errors": 0,
+                    "latency": [],
+                }
+        if entry.kind == STATE:
+            if entry.value == STATE_ATTACK and incident["detected"] is None:
+                incident["detected"] = entry.ts
+                incident["onset"] = getOnset(journal, entry.ts)
+            elif entry.value == STATE_CLOSED:
+                incident["closed"] = entry.ts
+        elif entry.kind in ORDER_KINDS:
+            incident["calls"] += 1
+            incident["latency"].append(entry.value)
+            if not entry.ok:
+                incident["errors"] += 1
+                continue
+            if entry.order != 0:
+                incident["orders"].add(entry.order)
+                # payedAmount only grows - the getOrder journaled right after a cancel has the final spend
+                incident["paid"][entry.order] = max(incident["paid"].get(entry.order, 0.0), entry.btc)
+            if entry.kind == CREATE and incident["first_order"] is None:
+                incident["first_order"] = entry.ts
+
+    report = []
+    for incident in sorted(incidents.values(), key=lambda i: i["incident"]):
+        detected = incident["detected"]
+        report.append({
+                "incident": incident["incident"],
+                "detected": detected,
+                "closed": incident["closed"],
+                "duration_minutes": None if detected is None or incident["closed"] is None else round((incident["closed"] - detected) / 60.0, 1),
+                "detection_latency_seconds": None if detected is None else round(detected - incident["onset"], 1),
+                "order_latency_seconds": None if detected is None or incident["first_order"] is None else round(incident["first_order"] - detected, 3),
+                "orders": len(incident["orders"]),
+                "btc_spent": round(sum(incident["paid"].values()), 8),
+                "order_calls": incident["calls"],
+                "order_errors": incident["errors"],
+                "max_call_latency_seconds": round(max(incident["latency"] or [0.0]), 3),
+            })
+    return report
+
+# Every record of one incident, with payloads
+def incidentDetail(journal, incident_id):
+    entries = [e for e in journal.entries() if e.incident == incident_id]
+    if len(entries) == 0:
+        return []
+    # Snapshots are not tied to an incident - show those inside its time span
+    entries += journal.snapshotEntries(entries[0].ts, entries[-1].ts)
+    entries.sort(key=lambda e: e.ts)
+    return [{
+            "ts": e.ts,
+            "kind": KIND_NAMES.get(e.kind, e.kind),
+            "ok": bool(e.ok),
+            "value": e.value,
+            "btc": e.btc,
+            "payload": journal.payload(e),
+        } for e in entries]
+
+
+def formatTime(ts):
+    if ts is None:
+        return "-"
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def formatValue(value):
+    return "-" if value is None else value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the Grin NiceHash Defender audit journal")
+    parser.add_argument("--dir", default="journal", help="JOURNAL_DIR (default: journal)")
+    parser.add_argument("--json", action="store_true", help="Print results as json lines")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("incidents", help="Summary of every incident")
+    commands.add_parser("spend", help="BTC spent per incident")
+    detail = commands.add_parser("incident", help="Every journal record of one incident")
+    detail.add_argument("id", type=int)
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.dir, "events.idx")):
+        print("No journal in {}".format(args.dir))
+        sys.exit(1)
+    journal = Journal(args.dir, readonly=True)
+    command = args.command or "incidents"
+    if command == "incident":
+        records = incidentDetail(journal, args.id)
+        if len(records) == 0:
+            print("No incident {}".format(args.id))
+            sys.exit(1)
+        for r in records:
+            if args.json:
+                print(json.dumps(r))
+            else:
+                print("{} {:<12} {:<5} value={:.3f} btc={:.8f} {}".format(
+                        formatTime(r["ts"]), r["kind"], "ok" if r["ok"] else "ERROR", r["value"], r["btc"], json.dumps(r["payload"])))
+    else:
+        report = incidentReport(journal)
+        for r in report:
+            if args.json:
+                print(json.dumps(r))
+            elif command == "spend":
+                print("incident {:<5} {}  orders={:<3} btc_spent={:.8f}".format(r["incident"], formatTime(r["detected"]), r["orders"], r["btc_spent"]))
+            else:
+                print("incident {:<5} detected {}  closed {}  duration={}m  detection_latency={}s  order_latency={}s  orders={}  btc_spent={:.8f}  calls={} errors={} max_call={}s".format(
+                        r["incident"], formatTime(r["detected"]), formatTime(r["closed"]), formatValue(r["duration_minutes"]),
+                        formatValue(r["detection_latency_seconds"]), formatValue(r["order_latency_seconds"]), r["orders"], r["btc_spent"],
+                        r["order_calls"], r["order_errors"], r["max_call_latency_seconds"]))
+        if command == "spend" and not args.json:
+            print("total btc_spent={:.8f}".format(sum(r["btc_spent"] for r in report)))
+    journal.close()
+
+if __name__ == "__main__":
+    main()
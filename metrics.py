@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+import math
+import time
+from collections import deque
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+##
+# Minimal Prometheus style metrics
+#
+# Counters, gauges and histograms with labels, rendered in the Prometheus
+# text exposition format by a small built-in HTTP server.  Metrics are
+# created once at import time by the modules that update them:
+#
+#   API_LATENCY = metrics.histogram("gnd_nicehash_api_latency_seconds", "...", ["endpoint"])
+#   API_LATENCY.observe(0.12, endpoint="orderBook")
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0]
+
+
+def formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    return repr(float(value))
+
+def formatLabels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metric():
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = list(labels) if labels is not None else []
+        self.values = {}     # { label values tuple: value }
+        self.lock = Lock()
+
+    def key(self, labels):
+        if set(labels.keys()) != set(self.labels):
+            raise Exception("Metric {} expects labels {}".format(self.name, self.labels))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+                if value is None:
+                    continue
+            yield self.name, key, None, value
+
+    def render(self):
+        lines = [
+                "# HELP {} {}".format(self.name, self.help_text),
+                "# TYPE {} {}".format(self.name, self.kind),
+            ]
+        for name, key, extra, value in self.samples():
+            lines.append("{}{} {}".format(name, formatLabels(self.labels, key, extra), formatValue(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    # Evaluate fn() at scrape time (returning None skips the sample)
+    def setFunction(self, fn, **labels):
+        self.set(fn, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=None, buckets=None):
+        super().__init__(name, help_text, labels)
+        self.buckets = sorted(buckets if buckets is not None else DEFAULT_BUCKETS) + [math.inf]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self.values[key] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    # Time a block: with HISTOGRAM.time(label=...): ...
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(key, dict(state, counts=list(state["counts"]))) for key, state in self.values.items()]
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state["counts"]):
+                cumulative += count
+                yield self.name + "_bucket", key, ("le", formatValue(bound)), cumulative
+            yield self.name + "_sum", key, None, state["sum"]
+            yield self.name + "_count", key, None, state["count"]
+
+class Timer():
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.time() - self.started, **self.labels)
+        return False
+
+
+# Events per minute over a sliding 60 second window
+class RateMeter():
+    def __init__(self, window=60):
+        self.window = window
+        self.events = deque()
+        self.lock = Lock()
+
+    def mark(self):
+        now = time.time()
+        with self.lock:
+            self.events.append(now)
+            self.trim(now)
+
+    def trim(self, now):
+        while self.events and self.events[0] < now - self.window:
+            self.events.popleft()
+
+    def getRate(self):
+        with self.lock:
+            self.trim(time.time())
+            return len(self.events) * 60.0 / self.window
+
+
+##
+# Process-wide registry
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, help_text, labels=None):
+    return REGISTRY.register(Counter(name, help_text, labels))
+
+def gauge(name, help_text, labels=None):
+    return REGISTRY.register(Gauge(name, help_text, labels))
+
+def histogram(name, help_text, labels=None, buckets=None):
+    return REGISTRY.register(Histogram(name, help_text, labels, buckets))
+
+
+# Group NiceHash api paths by endpoint (order ids replaced by {id})
+ID_PATTERN = re.compile(r"/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+def endpointName(path):
+    return ID_PATTERN.sub("/{id}", path)
+
+
+##
+# Text exposition endpoint
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/metrics", "/"]:
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def startServer(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    server.daemon_threads = True
+    thread = Thread(target = server.serve_forever, name = "metrics")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+
+def main():
+    # A few tests
+    requests_total = counter("test_requests_total", "Test requests", ["endpoint"])
+    latency = histogram("test_latency_seconds", "Test latency", ["endpoint"])
+    temperature = gauge("test_temperature", "Test gauge")
+    requests_total.inc(endpoint="/a")
+    latency.observe(0.03, endpoint="/a")
+    temperature.setFunction(lambda: 21.5)
+    print(REGISTRY.render())
+
+if __name__ == "__main__":
+    main()
@@ -19,122 +19,233 @@ import sys
 import uuid
 import time
 import json
-import requests
 import traceback
 from datetime import datetime, timedelta
+from threading import Lock
 
 import hashlib
 import hmac
 import base64
 
+import http_transport
+import metrics
+import ratelimit
+from ratelimit import PRIORITY_ORDER, PRIORITY_TELEMETRY
+
 
 ## NiceHash settings - https://docs.nicehash.com/main/index.html
+NICEHASH_URL = "https://api2.nicehash.com"
 UPDATE_INTERVAL = timedelta(minutes = 10)
 MAX_DECREASE = 0.0001
+DEFAULT_ALGO = "GRINCUCKATOO32"    # Defended when config.yml has no ALGORITHMS
+DEFAULT_MARKETS = ["EU", "USA"]
+
+## Metrics
+API_LATENCY = metrics.histogram("gnd_nicehash_api_latency_seconds", "NiceHash api call latency", ["endpoint", "method"])
+API_CALLS = metrics.counter("gnd_nicehash_api_calls_total", "NiceHash api calls", ["endpoint", "method", "result"])
+API_RATE = metrics.RateMeter()
+metrics.gauge("gnd_nicehash_api_calls_per_minute", "NiceHash api calls over the last minute").setFunction(API_RATE.getRate)
 
 
 ## --
 
+class NiceHashApiError(Exception):
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    # 429 is always safe to retry (nothing was done), 5xx only when repeating
+    # the request can not do something twice
+    def isRetryable(self, method):
+        if self.status_code == 429:
+            return True
+        return self.status_code is not None and self.status_code >= 500 and method in ["GET", "DELETE"]
+
+    def isServerError(self):
+        return self.status_code is not None and (self.status_code == 429 or self.status_code >= 500)
+
+
+##
+# Request signing - https://docs.nicehash.com/main/index.html (Authentication)
+#
+# The X-Auth HMAC-SHA256 is over:
+#   API_ID \0 time \0 nonce \0 \0 ORG_ID \0 \0 method \0 path \0 query [\0 body]
+# signRequest() computes it from scratch and has no state, RequestBuilder
+# gives the same signatures cheaper: the key is prepared once (an HMAC
+# already fed API_ID), and the method / path part of the message, the url
+# prefix and the static headers are built once per endpoint.
+
+SIGN_ENCODING = "ISO-8859-1"
+ENDPOINT_CACHE_SIZE = 256      # Order paths include the order id - dont grow forever
+
+def signRequest(api_key, api_id, org_id, timestamp, nonce, method, path, query, body_str=None):
+    fields = [api_id, timestamp, nonce, "", org_id, "", method, path, query]
+    if body_str is not None:
+        fields.append(body_str)
+    message = "\x00".join(fields).encode(SIGN_ENCODING)
+    return hmac.new(api_key.encode(SIGN_ENCODING), msg=message, digestmod=hashlib.sha256).hexdigest()
+
+# "ts=<timestamp>&arg=value..." - the query string, which is also signed
+def buildQuery(timestamp, params):
+    return "ts=" + timestamp + "".join(["&{}={}".format(arg, val) for arg, val in params.items()])
+
+
+class RequestBuilder():
+    def __init__(self, url, api_id, api_key, org_id):
+        self.url = url
+        self.api_id = api_id
+        self.org_id = org_id
+        self.auth = api_id != "" and api_key != ""
+        self.key = hmac.new(api_key.encode(SIGN_ENCODING), msg=(api_id + "\x00").encode(SIGN_ENCODING), digestmod=hashlib.sha256)
+        self.middle = "\x00\x00" + org_id + "\x00\x00"
+        self.headers = {
+                "Content-type": "application/json",
+                "X-Organization-ID": org_id,
+            }
+        self.endpoints = {}
+        self.lock = Lock()
+
+    # Static parts of one endpoint: (signed "ORG_ID ... method path" part, url prefix)
+    def getEndpoint(self, method, path):
+        endpoint = self.endpoints.get((method, path))
+        if endpoint is None:
+            endpoint = (self.middle + method + "\x00" + path + "\x00", self.url + path + "?")
+            with self.lock:
+                if len(self.endpoints) >= ENDPOINT_CACHE_SIZE:
+                    self.endpoints.clear()
+                self.endpoints[(method, path)] = endpoint
+        return endpoint
+
+    def sign(self, timestamp, nonce, method, path, query, body_str=None):
+        signed, prefix = self.getEndpoint(method, path)
+        if body_str is not None:
+            message = "".join([timestamp, "\x00", nonce, signed, query, "\x00", body_str])
+        else:
+            message = "".join([timestamp, "\x00", nonce, signed, query])
+        # One update on a copy of the prepared key is the cheapest HMAC here
+        mac = self.key.copy()
+        mac.update(message.encode(SIGN_ENCODING))
+        return mac.hexdigest()
+
+    # Returns (url, headers, body json or None)
+    def build(self, method, path, args, body, timestamp, nonce):
+        if args is not None:
+            query = buildQuery(timestamp, args)
+        elif body is not None:
+            query = buildQuery(timestamp, body)
+        else:
+            raise Exception("Must specify either args or body")
+        body_str = json.dumps(body) if body is not None else None
+        signed, prefix = self.getEndpoint(method, path)
+        headers = dict(self.headers)
+        headers["X-Time"] = timestamp
+        headers["X-Nonce"] = nonce
+        if self.auth:
+            headers["X-Auth"] = self.api_id + ":" + self.sign(timestamp, nonce, method, path, query, body_str)
+        return prefix + query, headers, body_str
+
+
 class NiceHash():
-    def __init__(self, API_ID="", API_KEY="", ORG_ID="", logger=None):
+    def __init__(self, API_ID="", API_KEY="", ORG_ID="", logger=None, url=NICEHASH_URL):
+        self.url = url
         self.API_ID = API_ID
         self.API_KEY = API_KEY
         self.ORG_ID = ORG_ID
+        self.builder = RequestBuilder(url, API_ID, API_KEY, ORG_ID)
         self.mfd = {}
+        self.mfd_lock = Lock()
         if logger is not None:
             self.logger = logger
         else:
             import logging
-            self.logger = logging.getLogger("gnd")
+            self.logger = logging.getLogger("gnd.nicehash")
 
 
     def setAuth(self, nhid, nhkey, nhorg):
         self.API_ID = nhid
         self.API_KEY = nhkey
         self.ORG_ID = nhorg
-
-    def call_nicehash_api(self, path, method, args=None, body=None):
-        url = "https://api2.nicehash.com"
-        zero_byte_field = "\x00"
-
+        self.builder = RequestBuilder(self.url, nhid, nhkey, nhorg)
+
+    def call_nicehash_api(self, path, method, args=None, body=None, priority=PRIORITY_TELEMETRY):
+        endpoint = metrics.endpointName(path)
+        limiter = ratelimit.get_limiter()
+        breaker = limiter.getBreaker("{} {}".format(method, endpoint))
+        attempt = 0
+        while True:
+            breaker.before()
+            try:
+                limiter.acquire(priority)
+            except Exception:
+                breaker.abort()
+                raise
+            started = time.time()
+            result = "error"
+            try:
+                r_json = self.send_nicehash_api(path, method, args, body)
+                result = "ok"
+                breaker.success()
+                return r_json
+            except NiceHashApiError as e:
+                if e.isServerError():
+                    breaker.failure()
+                else:
+                    breaker.success()
+                # A failure that (re)opened the breaker ends here with its own
+                # error - retrying would only be short-circuited
+                if not e.isRetryable(method) or attempt >= limiter.max_retries or breaker.isOpen():
+                    raise
+                delay = ratelimit.backoffDelay(attempt)
+                if e.retry_after is not None:
+                    delay = max(delay, float(e.retry_after))
+                self.logger.warning("NiceHash {} {} returned {}, retry {} in {:.1f}s".format(method, endpoint, e.status_code, attempt + 1, delay))
+                ratelimit.RETRIES.inc(endpoint=endpoint)
+            except Exception:
+                # Network errors and timeouts
+                breaker.failure()
+                raise
+            finally:
+                API_LATENCY.observe(time.time() - started, endpoint=endpoint, method=method)
+                API_CALLS.inc(endpoint=endpoint, method=method, result=result)
+                API_RATE.mark()
+            time.sleep(delay)
+            attempt += 1
+
+    def send_nicehash_api(self, path, method, args=None, body=None):
         timestamp = str(int(time.time() * 1000 ))
         nonce = str(uuid.uuid4())
-        request_query_str = url + path
-        body_str = json.dumps(body)
-
-        req = "ts=" + str(timestamp)
-        if args is not None:
-            for arg, val in args.items():
-                req += "&{}={}".format(arg, val)
-        elif body is not None:
-            for arg, val in body.items():
-                req += "&{}={}".format(arg, val)
-        else:
-            raise Exception("Must specify either args or body")
-        request_query_str += "?" + req
-        
-        secret_bytes = bytearray(self.API_KEY, 'ISO-8859-1')
-
-        message = self.API_ID + \
-                  zero_byte_field + \
-                  timestamp + \
-                  zero_byte_field + \
-                  nonce + \
-                  zero_byte_field + \
-                  zero_byte_field + \
-                  self.ORG_ID + \
-                  zero_byte_field + \
-                  zero_byte_field + \
-                  method + \
-                  zero_byte_field + \
-                  path + \
-                  zero_byte_field + \
-                  req
-        if body is not None:
-            message += \
-                  zero_byte_field + \
-                  body_str
-
-        message_bytes = bytearray(message, 'ISO-8859-1')
-        signature = hmac.new(secret_bytes, msg = message_bytes, digestmod = hashlib.sha256).hexdigest()
-        headers = {
-            'Content-type': 'application/json',
-            "X-Time": timestamp,
-            "X-Nonce": nonce,
-            "X-Organization-ID": self.ORG_ID,
-        }
-        if self.API_ID != "" and self.API_KEY != "":
-            headers["X-Auth"] = self.API_ID + ":" + signature
+        url, headers, body_str = self.builder.build(method, path, args, body, timestamp, nonce)
 
         if method == "GET":
-            r = requests.get(
-                    url=request_query_str,
+            r = http_transport.get_transport().get(
+                    url=url,
                     headers=headers,
-                    timeout=20,
                 )
         elif method == "POST":
-            #print("xxx: {}".format(request_query_str))
+            #print("xxx: {}".format(url))
             #print("yyy: {}".format(body_str))
-            r = requests.post(
-                    url=request_query_str,
+            r = http_transport.get_transport().post(
+                    url=url,
                     headers=headers,
                     data=body_str,
-                    timeout=20,
                 )
         elif method == "DELETE":
-            #print("xxx: {}".format(request_query_str))
+            #print("xxx: {}".format(url))
             #print("yyy: {}".format(body_str))
-            r = requests.delete(
-                    url=request_query_str,
+            r = http_transport.get_transport().delete(
+                    url=url,
                     headers=headers,
-                    timeout=20,
                 )
         else:
             raise Exception("Unsupported method: {}".format(method))
         
         if r.status_code >= 300 or r.status_code < 200:
-            error_msg = "Error calling {}.  Code: {} Reason: {} content: {}".format(url, r.status_code, r.reason, r.content)
-            raise Exception(error_msg)
+            error_msg = "Error calling {}.  Code: {} Reason: {} content: {}".format(self.url, r.status_code, r.reason, r.content)
+            retry_after = r.headers.get("Retry-After")
+            if retry_after is not None and not retry_after.isdigit():
+                retry_after = None
+            raise NiceHashApiError(error_msg, r.status_code, retry_after)
 
         r_json = r.json()
         if "error_id" in r_json:
@@ -153,6 +264,13 @@ class NiceHash():
         # Its ok to cache this, it does not change
         if algo in self.mfd:
             return self.mfd[algo]
+        # Concurrent order calls would otherwise all fetch it at once
+        with self.mfd_lock:
+            if algo in self.mfd:
+                return self.mfd[algo]
+            return self.fetchMarketFactorData(algo)
+
+    def fetchMarketFactorData(self, algo):
         getAlgorithms_path = "/main/api/v2/mining/algorithms/"
         getAlgorithms_args = {}
         try:
@@ -160,6 +278,7 @@ class NiceHash():
                     path = getAlgorithms_path,
                     args = getAlgorithms_args,
                     method = "GET",
+                    priority = PRIORITY_ORDER,
                 )
             algorithms = result["miningAlgorithms"]
             for a in algorithms:
@@ -173,8 +292,10 @@ class NiceHash():
 
     ##
 
-    # Get NiceHash orderbook for algo on market
-    def getOrderBook(self, market, algo):
+    # Get NiceHash orderbooks for algo on all markets
+    # One response holds every market, so callers that need more than one
+    # market should use this (or nicehash_orderbook.OrderBookService)
+    def getOrderBooks(self, algo):
         getOrderBook_path = "/main/api/v2/hashpower/orderBook/"
         getOrderBook_args = {
                 "algorithm": algo,
@@ -187,7 +308,16 @@ class NiceHash():
                     args = getOrderBook_args,
                     method = "GET",
                 )
-            orderbook = result["stats"][market]
+            orderbooks = result["stats"]
+        except Exception as e:
+            self.logger.error("failed getOrderBooks(): {}".format(e))
+            raise
+        return orderbooks
+
+    # Get NiceHash orderbook for algo on market
+    def getOrderBook(self, market, algo):
+        try:
+            orderbook = self.getOrderBooks(algo)[market]
         except Exception as e:
             self.logger.error("failed getOrderBook(): {}".format(e))
             raise
@@ -216,8 +346,9 @@ class NiceHash():
         return None
 
     def createOrder(self, algo, market, pool_id, price, speed, amount):
-        marketFactor = int(self.getMarketFactorData(algo)["marketFactor"])
-        displayMarketFactor = self.getMarketFactorData(algo)["displayMarketFactor"]
+        mfd = self.getMarketFactorData(algo)
+        marketFactor = int(mfd["marketFactor"])
+        displayMarketFactor = mfd["displayMarketFactor"]
         # Create an order
         createOrder_path = "/main/api/v2/hashpower/order"
         createOrder_body = {
@@ -229,17 +360,18 @@ class NiceHash():
                 "limit": "{:.2f}".format(float(speed)),
                 "price": "{:.4f}".format(float(price)),
                 "marketFactor": marketFactor,
-                "displayMarketFactor": displayMarketFactor.encode(),
+                "displayMarketFactor": displayMarketFactor,
             }
-        self.logger.warn("createOrder_body: {}".format(createOrder_body))
+        self.logger.debug("createOrder_body: {}".format(createOrder_body))
         try:
             result = self.call_nicehash_api(
                     path = createOrder_path,
                     body = createOrder_body,
                     method = "POST",
+                    priority = PRIORITY_ORDER,
                 )
             order = result
-            self.logger.warn("order: {}".format(order))
+            self.logger.debug("order: {}".format(order))
         except Exception as e:
             self.logger.error("failed createOrder(): {}".format(e))
             raise
@@ -261,6 +393,7 @@ class NiceHash():
                     path = getMyOrders_path,
                     args = getMyOrders_args,
                     method = "GET",
+                    priority = PRIORITY_ORDER,
                 )
             myorders = result["list"]
         except Exception as e:
@@ -277,6 +410,7 @@ class NiceHash():
                     path = getOrder_path,
                     args = getOrder_args,
                     method = "GET",
+                    priority = PRIORITY_ORDER,
                 )
         except Exception as e:
             self.logger.error("failed getOrder(): {}".format(e))
@@ -293,6 +427,7 @@ class NiceHash():
                     path = cancelOrder_path,
                     args = cancelOrder_args,
                     method = "DELETE",
+                    priority = PRIORITY_ORDER,
                 )
         except Exception as e:
             self.logger.error("failed cancelOrder(): {}".format(e))
@@ -300,8 +435,9 @@ class NiceHash():
         return result
 
     def updateOrder(self, algo, order_id, speed, price):
-        marketFactor = self.getMarketFactorData(algo)["marketFactor"]
-        displayMarketFactor = self.getMarketFactorData(algo)["displayMarketFactor"]
+        mfd = self.getMarketFactorData(algo)
+        marketFactor = mfd["marketFactor"]
+        displayMarketFactor = mfd["displayMarketFactor"]
         # Update an orders price and/or speed limit
         increasePrice_path = "/main/api/v2/hashpower/order/{}/updatePriceAndLimit".format(order_id)
         increasePrice_body = {
@@ -310,14 +446,15 @@ class NiceHash():
                  "limit": "{:.2f}".format(float(speed)),
                  "price": "{:.4f}".format(float(price)),
              }
-        self.logger.warn("increasePrice_body: {}".format(increasePrice_body))
+        self.logger.debug("increasePrice_body: {}".format(increasePrice_body))
         try:
             result = self.call_nicehash_api(
                     path = increasePrice_path,
                     body = increasePrice_body,
                     method = "POST",
+                    priority = PRIORITY_ORDER,
                )
-            self.logger.warn("updated order: {}".format(result))
+            self.logger.debug("updated order: {}".format(result))
         except Exception as e:
             self.logger.error("failed updateOrder(): {}".format(e))
             raise
@@ -328,18 +465,32 @@ class NiceHash():
 
 
     def getCurrentPrice(self, market, algo):
-        # Find the lowest price thats has miners working
         orderbook = self.getOrderBook(market, algo)
-        prices = [o["price"] for o in orderbook["orders"] if int(o["rigsCount"]) > 0 and float(o["acceptedSpeed"]) > 0.00000005 and o["type"] == "STANDARD"]
-        prices = sorted(prices)
-        return float(prices[0])
+        return findLowestPrice(orderbook)
 
     def getCurrentSpeed(self, market, algo):
-        # Find the current Total Available NiceHash Speed
-        # aka How much hash nicehash is producing
         orderbook = self.getOrderBook(market, algo)
-        speed = orderbook["totalSpeed"]
-        return float(speed)
+        return findTotalSpeed(orderbook)
+
+
+## Orderbook helpers - work on a single market orderbook as returned by the api
+
+def isWorkingOrder(order):
+    # A standard order that has miners working on it
+    return int(order["rigsCount"]) > 0 and float(order["acceptedSpeed"]) > 0.00000005 and order["type"] == "STANDARD"
+
+def findLowestPrice(orderbook):
+    # Find the lowest price thats has miners working
+    prices = [float(o["price"]) for o in orderbook["orders"] if isWorkingOrder(o)]
+    if len(prices) == 0:
+        raise IndexError("No working orders")
+    return min(prices)
+
+def findTotalSpeed(orderbook):
+    # Find the current Total Available NiceHash Speed
+    # aka How much hash nicehash is producing
+    speed = orderbook["totalSpeed"]
+    return float(speed)
 
 
 
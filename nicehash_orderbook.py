@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime
+from threading import Thread, Lock
+
+import metrics
+from nicehash_api import NiceHash, findTotalSpeed, isWorkingOrder
+
+
+##
+# Shared NiceHash orderbook snapshots
+#
+# A single orderBook response holds every market for an algorithm, so fetch it
+# once per interval and hand the same point-in-time view to every consumer
+# (grin51 watchers, order management, ...)
+
+FETCHES = metrics.counter("gnd_watcher_fetch_total", "Watcher data fetches", ["watcher", "result"])
+
+MarketStats = namedtuple("MarketStats", ["market", "price", "speed", "depth"], defaults=[None])
+
+
+##
+# Orderbook depth index
+#
+# Working STANDARD orders sorted by price, with running totals of accepted
+# speed and rigs, so pricing questions are answered with a binary search.
+#
+# Hashpower goes to the highest bids first, so an order priced above p takes
+# over the hashpower currently working for every order priced below p.
+# Speeds are in the same units NiceHash uses for order limits.
+
+class OrderBookDepth():
+    def __init__(self, orders):
+        working = sorted(
+                (float(o["price"]), float(o["acceptedSpeed"]), int(o["rigsCount"]), o.get("id"))
+                for o in orders if isWorkingOrder(o)
+            )
+        self.prices = []
+        self.speeds = []
+        self.cum_speed = []
+        self.cum_rigs = []
+        self.index = {}     # { order id: position }
+        speed = 0.0
+        rigs = 0
+        for price, accepted, rig_count, order_id in working:
+            speed += accepted
+            rigs += rig_count
+            self.index[order_id] = len(self.prices)
+            self.prices.append(price)
+            self.speeds.append(accepted)
+            self.cum_speed.append(speed)
+            self.cum_rigs.append(rigs)
+
+    def getSize(self):
+        return len(self.prices)
+
+    def getLowestPrice(self):
+        if len(self.prices) == 0:
+            raise IndexError("No working orders")
+        return self.prices[0]
+
+    def getTotalSpeed(self):
+        return self.cum_speed[-1] if self.cum_speed else 0.0
+
+    # Hashpower (and rigs) working for orders priced below price
+    def getSpeedBelow(self, price):
+        i = bisect_left(self.prices, price)
+        return self.cum_speed[i - 1] if i > 0 else 0.0
+
+    def getRigsBelow(self, price):
+        i = bisect_left(self.prices, price)
+        return self.cum_rigs[i - 1] if i > 0 else 0
+
+    # Highest order price we must outbid to secure speed - bid anything above
+    # it.  If the whole book has less than speed, outbid the whole book.
+    # Orders in exclude (our own) are skipped: we never need to outbid them.
+    def getPriceForSpeed(self, speed, exclude=None):
+        excluded = sorted(self.index[i] for i in (exclude or []) if i in self.index)
+        extra = 0.0
+        for j in excluded:
+            if j > bisect_left(self.cum_speed, speed + extra):
+                break
+            extra += self.speeds[j]
+        i = min(bisect_left(self.cum_speed, speed + extra), len(self.prices) - 1)
+        while i >= 0 and i in excluded:
+            i -= 1
+        if i < 0:
+            raise IndexError("No working orders")
+        return self.prices[i]
+
+    # Extra price needed to secure another delta of speed on top of speed
+    def getMarginalPrice(self, speed, delta=0.1, exclude=None):
+        return self.getPriceForSpeed(speed + delta, exclude) - self.getPriceForSpeed(speed, exclude)
+
+
+class OrderBookSnapshot():
+    def __init__(self, algo, markets, ts=None):
+        self.algo = algo
+        self.markets = markets   # { market: MarketStats }
+        self.ts = ts if ts is not None else datetime.now()
+
+    @classmethod
+    def fromOrderBooks(cls, algo, orderbooks, ts=None):
+        markets = {}
+        for market, orderbook in orderbooks.items():
+            depth = OrderBookDepth(orderbook["orders"])
+            try:
+                price = depth.getLowestPrice()
+            except IndexError:
+                # No working orders on this market right now
+                price = None
+            markets[market] = MarketStats(
+                    market = market,
+                    price = price,
+                    speed = findTotalSpeed(orderbook),
+                    depth = depth,
+                )
+        return cls(algo, markets, ts)
+
+    def getMarkets(self):
+        return list(self.markets.keys())
+
+    def getPrice(self, market):
+        return self.markets[market].price
+
+    def getSpeed(self, market):
+        return self.markets[market].speed
+
+    # OrderBookDepth for market, None if the snapshot was built without orders
+    def getDepth(self, market):
+        return self.markets[market].depth
+
+    def getAge(self, now=None):
+        if now is None:
+            now = datetime.now()
+        return (now - self.ts).total_seconds()
+
+
+class OrderBookService():
+    def __init__(self, logger, algos, nh_api=None, interval=60, clock=datetime.now, sampler=None):
+        self.logger = logger
+        self.algos = list(algos)
+        self.nh_api = nh_api if nh_api is not None else NiceHash(logger=logger)
+        self.interval = interval
+        self.clock = clock
+        self.sampler = sampler    # Optional AdaptiveSampler to set the fetch interval
+        if sampler is not None:
+            sampler.register("orderbook", len(self.algos))
+        self.snapshots = {}      # { algo: OrderBookSnapshot }
+        self.subscribers = []
+        self.fetch_lock = Lock()
+        self.thread = None
+
+    # callback(snapshot) is called (from the fetching thread) for every new snapshot
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    # Fetch a new snapshot - unless another caller fetched one while this one
+    # waited for the lock, or the current one is at most max_age seconds old
+    def refresh(self, algo, max_age=None):
+        requested = self.clock()
+        # Serialize fetches so concurrent callers dont download the same orderbook twice
+        with self.fetch_lock:
+            snapshot = self.snapshots.get(algo)
+            if snapshot is not None and (snapshot.ts > requested or (max_age is not None and snapshot.getAge(self.clock()) <= max_age)):
+                return snapshot
+            orderbooks = self.nh_api.getOrderBooks(algo)
+            snapshot = OrderBookSnapshot.fromOrderBooks(algo, orderbooks, self.clock())
+            self.snapshots[algo] = snapshot
+        self.publish(snapshot)
+        return snapshot
+
+    # Make snapshot the current one and hand it to all subscribers
+    def publish(self, snapshot):
+        self.snapshots[snapshot.algo] = snapshot
+        for callback in self.subscribers:
+            try:
+                callback(snapshot)
+            except Exception as e:
+                self.logger.error("Error in OrderBookService subscriber - {}".format(e))
+
+    # Get the most recent snapshot, fetching a new one if there is none or
+    # it is older than max_age seconds
+    def getSnapshot(self, algo, max_age=None):
+        snapshot = self.snapshots.get(algo)
+        if snapshot is None or (max_age is not None and snapshot.getAge(self.clock()) > max_age):
+            snapshot = self.refresh(algo, max_age)
+        return snapshot
+
+    def run(self):
+        # Skip the first fetch if we just got fresh snapshots (ex: during startup)
+        if self.isFresh():
+            self.sleep()
+        while True:
+            self.refreshAll()
+            # sleep interval
+            self.sleep()
+
+    # Fetch a new snapshot for every algo, logging (not raising) errors
+    def refreshAll(self):
+        for algo in self.algos:
+            try:
+                self.refresh(algo)
+                FETCHES.inc(watcher="orderbook_{}".format(algo), result="ok")
+            except Exception as e:
+                FETCHES.inc(watcher="orderbook_{}".format(algo), result="error")
+                self.logger.error("Error in OrderBookService - {}".format(e))
+
+    # True if every algo has a snapshot younger than the fetch interval
+    def isFresh(self):
+        return len(self.snapshots) == len(self.algos) and all(s.getAge(self.clock()) < self.interval for s in self.snapshots.values())
+
+    def sleep(self):
+        if self.sampler is not None:
+            self.sampler.sleep()
+        else:
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target = self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+
+
+def main():
+    # A few tests
+    import logging
+    service = OrderBookService(logging.getLogger("gnd"), ["GRINCUCKATOO32"])
+    snapshot = service.getSnapshot("GRINCUCKATOO32")
+    for market in snapshot.getMarkets():
+        depth = snapshot.getDepth(market)
+        print("{}: lowest price {}, total speed {}".format(market, snapshot.getPrice(market), snapshot.getSpeed(market)))
+        print("    price to secure 0.5: {}, marginal price of next 0.1: {}".format(depth.getPriceForSpeed(0.5), depth.getMarginalPrice(0.5)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import uuid
+from threading import Lock
+
+
+##
+# In-process simulated NiceHash hashpower market
+#
+# Implements the subset of the NiceHash client interface the defender uses
+# (orderbooks, pools, order CRUD) against local state, so the detection and
+# order management code can be driven without spending real BTC.
+#
+# Fill model: an order whose price is at or above the lowest working price on
+# its market gets its full speed limit; otherwise it gets nothing.  Spend is
+# price (BTC/unit/day) * accepted speed * elapsed days, until the order amount
+# is used up.
+
+SECONDS_PER_DAY = 60*60*24
+
+
+class SimulatedNiceHash():
+    def __init__(self, pool_name="defender", clock=None):
+        self.pool_id = str(uuid.uuid4())
+        self.pool_name = pool_name
+        self.clock = clock
+        self.markets = {}    # { algo: { market: {"price": float, "speed": float} } }
+        self.orders = {}     # { order_id: order dict }
+        self.last_ts = None
+        self.spent = 0.0
+        self.calls = {}      # { method name: count }
+        self.lock = Lock()
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    # Set the market state (lowest working price and total speed)
+    def setMarket(self, algo, market, price, speed):
+        self.markets.setdefault(algo, {})[market] = {"price": float(price), "speed": float(speed)}
+
+    # Move simulated time forward to ts (epoch seconds), filling live orders
+    def advance(self, ts):
+        with self.lock:
+            if self.last_ts is not None and ts > self.last_ts:
+                elapsed_days = (ts - self.last_ts) / SECONDS_PER_DAY
+                for order in self.orders.values():
+                    if not order["alive"]:
+                        continue
+                    market = self.markets.get(order["algorithm"], {}).get(order["market"])
+                    if market is not None and order["price"] >= market["price"]:
+                        order["acceptedCurrentSpeed"] = order["limit"]
+                    else:
+                        order["acceptedCurrentSpeed"] = 0.0
+                    cost = min(order["price"] * order["acceptedCurrentSpeed"] * elapsed_days, order["availableAmount"])
+                    order["availableAmount"] -= cost
+                    order["payedAmount"] += cost
+                    self.spent += cost
+                    if order["availableAmount"] <= 0:
+                        order["alive"] = False
+                        order["acceptedCurrentSpeed"] = 0.0
+            self.last_ts = ts
+
+    def formatOrder(self, order):
+        # Same field types the real api returns (numbers as strings)
+        result = dict(order)
+        for field in ["price", "limit", "amount", "availableAmount", "payedAmount", "acceptedCurrentSpeed"]:
+            result[field] = "{:.8f}".format(order[field])
+        return result
+
+    def getOrderFor(self, order_id):
+        if order_id not in self.orders:
+            raise Exception("Error calling getOrder. Reason: Order {} not found".format(order_id))
+        return self.orders[order_id]
+
+
+    ## NiceHash client interface
+
+    def setAuth(self, nhid, nhkey, nhorg):
+        pass
+
+    def getMarketFactorData(self, algo):
+        self.count("getMarketFactorData")
+        return {"algorithm": algo, "marketFactor": "1000000000000", "displayMarketFactor": "TH"}
+
+    def getOrderBooks(self, algo):
+        self.count("getOrderBooks")
+        orderbooks = {}
+        for market, state in self.markets.get(algo, {}).items():
+            orderbooks[market] = {
+                    "totalSpeed": "{:.8f}".format(state["speed"]),
+                    "orders": [{
+                            "id": "market-{}".format(market),
+                            "type": "STANDARD",
+                            "price": "{:.4f}".format(state["price"]),
+                            "limit": "0",
+                            "rigsCount": 1,
+                            "acceptedSpeed": "{:.8f}".format(state["speed"]),
+                            "alive": True,
+                        }],
+                }
+        return orderbooks
+
+    def getOrderBook(self, market, algo):
+        return self.getOrderBooks(algo)[market]
+
+    def getPoolId(self, pool_name):
+        self.count("getPoolId")
+        if pool_name == self.pool_name:
+            return self.pool_id
+        return None
+
+    def createOrder(self, algo, market, pool_id, price, speed, amount):
+        self.count("createOrder")
+        with self.lock:
+            order_id = str(uuid.uuid4())
+            self.orders[order_id] = {
+                    "id": order_id,
+                    "algorithm": algo,
+                    "market": market,
+                    "type": "STANDARD",
+                    "pool": {"id": pool_id},
+                    "alive": True,
+                    "price": float(price),
+                    "limit": float(speed),
+                    "amount": float(amount),
+                    "availableAmount": float(amount),
+                    "payedAmount": 0.0,
+                    "acceptedCurrentSpeed": 0.0,
+                }
+            return self.formatOrder(self.orders[order_id])
+
+    def getMyOrders(self, market, algo):
+        self.count("getMyOrders")
+        with self.lock:
+            return [self.formatOrder(o) for o in self.orders.values() if o["alive"] and o["market"] == market and o["algorithm"] == algo]
+
+    def getOrder(self, order_id):
+        self.count("getOrder")
+        with self.lock:
+            return self.formatOrder(self.getOrderFor(order_id))
+
+    def cancelOrder(self, order_id):
+        self.count("cancelOrder")
+        with self.lock:
+            order = self.getOrderFor(order_id)
+            order["alive"] = False
+            order["acceptedCurrentSpeed"] = 0.0
+            return self.formatOrder(order)
+
+    def updateOrder(self, algo, order_id, speed, price):
+        self.count("updateOrder")
+        with self.lock:
+            order = self.getOrderFor(order_id)
+            if not order["alive"]:
+                raise Exception("Error calling updateOrder. Reason: Order {} is not active".format(order_id))
+            order["price"] = float(price)
+            order["limit"] = float(speed)
+            return self.formatOrder(order)
+
+    def getCurrentPrice(self, market, algo):
+        self.count("getCurrentPrice")
+        return self.markets[algo][market]["price"]
+
+    def getCurrentSpeed(self, market, algo):
+        self.count("getCurrentSpeed")
+        return self.markets[algo][market]["speed"]
+
+
+
+def main():
+    # A few tests
+    sim = SimulatedNiceHash()
+    sim.setMarket("GRINCUCKATOO32", "EU", 0.30, 2.0)
+    sim.advance(0)
+    order = sim.createOrder("GRINCUCKATOO32", "EU", sim.pool_id, 0.31, 0.5, 0.002)
+    sim.advance(3600)
+    print("After 1h: {}".format(sim.getOrder(order["id"])))
+    print("Total spent: {:.8f} BTC".format(sim.spent))
+
+if __name__ == "__main__":
+    main()
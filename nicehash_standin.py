@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+import hmac
+import json
+import time
+import random
+import hashlib
+import argparse
+from threading import Thread, Lock
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from nicehash_sim import SimulatedNiceHash
+
+
+##
+# Local stand-in for the NiceHash api2 endpoints used by nicehash_api.NiceHash
+#
+# Orders are kept in a SimulatedNiceHash market.  Requests are checked for a
+# valid X-Auth HMAC signature, and latency and errors can be injected to see
+# how the defender behaves when NiceHash is slow or failing.
+#
+# Point the client at it with: NiceHash(..., url="http://127.0.0.1:<port>")
+
+ALGO = "GRINCUCKATOO32"
+ORDER_PATH = re.compile(r"^/main/api/v2/hashpower/order/([^/]+)/?$")
+UPDATE_PATH = re.compile(r"^/main/api/v2/hashpower/order/([^/]+)/updatePriceAndLimit/?$")
+
+
+class StandInError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class NiceHashStandIn():
+    def __init__(self, api_id="standin-id", api_key="standin-key", org_id="standin-org",
+                 host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_code=500):
+        self.api_id = api_id
+        self.api_key = api_key
+        self.org_id = org_id
+        self.latency = latency          # Seconds added to every response
+        self.jitter = jitter            # Random extra seconds, 0..jitter
+        self.error_rate = error_rate    # Fraction of requests that fail with error_code
+        self.error_code = error_code
+        self.sim = SimulatedNiceHash()
+        self.sim.setMarket(ALGO, "EU", 0.30, 2.0)
+        self.sim.setMarket(ALGO, "USA", 0.31, 1.0)
+        self.calls = {}                 # { "METHOD endpoint": count }
+        self.lock = Lock()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                standin.handle(self, "GET")
+
+            def do_POST(self):
+                standin.handle(self, "POST")
+
+            def do_DELETE(self):
+                standin.handle(self, "DELETE")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def getUrl(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self.thread = Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def getCallCount(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def setMarket(self, market, price, speed, algo=ALGO):
+        self.sim.setMarket(algo, market, price, speed)
+
+
+    ## Request handling
+
+    def verifySignature(self, request, method, path, query, body):
+        auth = request.headers.get("X-Auth", "")
+        if ":" not in auth:
+            raise StandInError(401, "Missing X-Auth header")
+        api_id, signature = auth.split(":", 1)
+        if api_id != self.api_id:
+            raise StandInError(401, "Unknown api key id")
+        if request.headers.get("X-Organization-ID", "") != self.org_id:
+            raise StandInError(401, "Unknown organization id")
+        fields = [
+                api_id,
+                request.headers.get("X-Time", ""),
+                request.headers.get("X-Nonce", ""),
+                "",
+                self.org_id,
+                "",
+                method,
+                path,
+                query,
+            ]
+        if body != "":
+            fields.append(body)
+        message = "\x00".join(fields).encode("ISO-8859-1")
+        expected = hmac.new(self.api_key.encode("ISO-8859-1"), msg=message, digestmod=hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, signature):
+            raise StandInError(401, "Invalid signature")
+
+    def route(self, method, path, args, body):
+        sim = self.sim
+        if method == "GET" and path == "/main/api/v2/hashpower/orderBook/":
+            return "orderBook", {"stats": sim.getOrderBooks(args.get("algorithm", ALGO))}
+        if method == "GET" and path == "/main/api/v2/pools":
+            return "pools", {"list": [{"id": sim.pool_id, "name": sim.pool_name, "algorithm": ALGO}]}
+        if method == "GET" and path == "/main/api/v2/mining/algorithms/":
+            return "algorithms", {"miningAlgorithms": [sim.getMarketFactorData(ALGO)]}
+        if method == "GET" and path == "/main/api/v2/hashpower/myOrders/":
+            return "myOrders", {"list": sim.getMyOrders(args.get("market"), args.get("algorithm"))}
+        if method == "POST" and path == "/main/api/v2/hashpower/order":
+            order = sim.createOrder(body["algorithm"], body["market"], body["poolId"], body["price"], body["limit"], body["amount"])
+            return "createOrder", order
+        match = UPDATE_PATH.match(path)
+        if method == "POST" and match:
+            order = sim.getOrderFor(match.group(1))
+            return "updatePriceAndLimit", sim.updateOrder(order["algorithm"], order["id"], body["limit"], body["price"])
+        match = ORDER_PATH.match(path)
+        if method == "GET" and match:
+            return "getOrder", sim.getOrder(match.group(1))
+        if method == "DELETE" and match:
+            return "cancelOrder", sim.cancelOrder(match.group(1))
+        raise StandInError(404, "No such endpoint: {} {}".format(method, path))
+
+    def handle(self, request, method):
+        started = time.time()
+        parts = urlsplit(request.path)
+        length = int(request.headers.get("Content-Length", 0))
+        body_str = request.rfile.read(length).decode("ISO-8859-1") if length > 0 else ""
+        endpoint = "unknown"
+        try:
+            self.verifySignature(request, method, parts.path, parts.query, body_str)
+            if self.error_rate > 0 and random.random() < self.error_rate:
+                raise StandInError(self.error_code, "Injected error")
+            args = dict((k, v[0]) for k, v in parse_qs(parts.query).items())
+            body = json.loads(body_str) if body_str != "" else {}
+            self.sim.advance(time.time())
+            endpoint, result = self.route(method, parts.path, args, body)
+            code = 200
+        except StandInError as e:
+            code = e.code
+            result = {"error_id": "standin", "errors": [{"code": code, "message": str(e)}]}
+        except Exception as e:
+            code = 400
+            result = {"error_id": "standin", "errors": [{"code": code, "message": str(e)}]}
+        with self.lock:
+            key = "{} {}".format(method, endpoint)
+            self.calls[key] = self.calls.get(key, 0) + 1
+        # Injected latency
+        delay = self.latency + random.random() * self.jitter - (time.time() - started)
+        if delay > 0:
+            time.sleep(delay)
+        data = json.dumps(result).encode()
+        request.send_response(code)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local NiceHash API stand-in server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency to add to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many random extra seconds of latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests to fail")
+    parser.add_argument("--error-code", type=int, default=500, help="HTTP status for injected failures")
+    args = parser.parse_args()
+    standin = NiceHashStandIn(port=args.port, latency=args.latency, jitter=args.jitter,
+                              error_rate=args.error_rate, error_code=args.error_code)
+    print("NiceHash stand-in listening on {}".format(standin.getUrl()))
+    print("Credentials: NICEHASH_API_ID={} NICEHASH_API_KEY={} NICEHASH_ORG_ID={}".format(standin.api_id, standin.api_key, standin.org_id))
+    print("Pool: {} ({})".format(standin.sim.pool_name, standin.sim.pool_id))
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from threading import Lock
+
+
+##
+# Local state of our NiceHash orders
+#
+# Every create / get / update response is an order, so the last known
+# price, limit, accepted speed and amounts are kept per (algo, market).
+# Order management compares the bid it wants with this state and only calls
+# updatePriceAndLimit when the price or limit would actually change, and
+# only re-reads an order (getOrder) when its state is older than the status
+# interval or after a failed call left it in doubt.
+
+# NiceHash takes prices with 4 and limits with 2 decimals (see nicehash_api)
+PRICE_DECIMALS = 4
+LIMIT_DECIMALS = 2
+
+
+class OrderState():
+    def __init__(self, order, now):
+        self.id = order["id"]
+        self.price = float(order["price"])
+        self.limit = float(order.get("limit", 0.0))
+        self.accepted_speed = float(order.get("acceptedCurrentSpeed", 0.0))
+        self.available = float(order.get("availableAmount", 0.0))
+        self.paid = float(order.get("payedAmount", 0.0))
+        self.alive = order.get("alive", True)
+        self.refreshed = now     # When NiceHash last told us about this order
+
+    # Would an update with this price and limit change anything
+    def differs(self, price, limit):
+        return round(float(price), PRICE_DECIMALS) != round(self.price, PRICE_DECIMALS) or \
+               round(float(limit), LIMIT_DECIMALS) != round(self.limit, LIMIT_DECIMALS)
+
+
+class OrderStateCache():
+    def __init__(self, status_interval=300):
+        self.status_interval = status_interval     # Seconds between getOrder status refreshes
+        self.states = {}      # { (algo, market): OrderState }
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.states.get(key)
+
+    # Record an order from any NiceHash response
+    def update(self, key, order, now):
+        state = OrderState(order, now)
+        with self.lock:
+            self.states[key] = state
+        return state
+
+    # Forget the state (order canceled, or a failed call left it unknown)
+    def invalidate(self, key):
+        with self.lock:
+            self.states.pop(key, None)
+
+    # True when the order should be re-read from NiceHash first
+    def isStale(self, key, now):
+        state = self.get(key)
+        return state is None or now - state.refreshed >= self.status_interval
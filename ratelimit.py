@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+import random
+from threading import Lock, Condition
+
+import metrics
+
+
+##
+# Process-wide NiceHash api rate limiting
+#
+# Every NiceHash call takes a token from one shared bucket.  Order management
+# calls have priority: telemetry (orderbook, pools, ...) can not use the last
+# "reserve" tokens and always lets waiting order calls go first.  Each
+# endpoint also has a circuit breaker so a failing endpoint is not hammered.
+
+PRIORITY_ORDER = 0       # Order create / get / update / cancel
+PRIORITY_TELEMETRY = 1   # Data polling
+
+THROTTLED = metrics.counter("gnd_ratelimit_throttled_total", "Calls that had to wait for a rate limit token", ["priority"])
+BREAKER_OPEN = metrics.counter("gnd_circuit_breaker_open_total", "Circuit breaker trips", ["endpoint"])
+RETRIES = metrics.counter("gnd_api_retries_total", "Api call retries after a 429/5xx response", ["endpoint"])
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket():
+    def __init__(self, rate_per_minute=60, burst=10, reserve=2):
+        self.rate = float(rate_per_minute) / 60.0   # Tokens per second
+        self.burst = float(burst)
+        self.reserve = min(float(reserve), self.burst - 1)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.waiting_orders = 0
+        self.cond = Condition()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, priority):
+        if priority == PRIORITY_ORDER:
+            return self.tokens >= 1
+        # Telemetry leaves the reserve for orders and yields to waiting orders
+        return self.tokens >= 1 + self.reserve and self.waiting_orders == 0
+
+    def acquire(self, priority=PRIORITY_TELEMETRY, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            self.refill()
+            if self.available(priority):
+                self.tokens -= 1
+                return
+            THROTTLED.inc(priority="order" if priority == PRIORITY_ORDER else "telemetry")
+            if priority == PRIORITY_ORDER:
+                self.waiting_orders += 1
+            try:
+                while True:
+                    self.refill()
+                    if self.available(priority):
+                        self.tokens -= 1
+                        return
+                    needed = (1 + (0 if priority == PRIORITY_ORDER else self.reserve)) - self.tokens
+                    wait = max(needed / self.rate, 0.01)
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise RateLimitTimeout("Timed out waiting for a NiceHash rate limit token")
+                        wait = min(wait, remaining)
+                    self.cond.wait(wait)
+            finally:
+                if priority == PRIORITY_ORDER:
+                    self.waiting_orders -= 1
+                    self.cond.notify_all()
+
+
+class CircuitBreaker():
+    def __init__(self, name, failures=5, cooldown=60):
+        self.name = name
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None     # Time the breaker opened, None while closed
+        self.trial = False     # A half-open trial call is in flight
+        self.lock = Lock()
+
+    # Raise CircuitOpenError unless a call is allowed now
+    def before(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.time() - self.opened < self.cooldown or self.trial:
+                raise CircuitOpenError("Circuit open for {} - not calling".format(self.name))
+            # Half open: let one trial call through
+            self.trial = True
+
+    # The call allowed by before() was never sent (ex: no rate limit token) -
+    # a half open trial is still due
+    def abort(self):
+        with self.lock:
+            self.trial = False
+
+    def isOpen(self):
+        with self.lock:
+            return self.opened is not None
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.max_failures:
+                if self.opened is None:
+                    BREAKER_OPEN.inc(endpoint=self.name)
+                # (Re)open - a failed half open trial starts a new cooldown
+                self.opened = time.time()
+            self.trial = False
+
+
+# Exponential backoff with full jitter
+def backoffDelay(attempt, base=1.0, cap=30.0):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class RateLimiter():
+    def __init__(self, rate_per_minute=60, burst=10, reserve=2, max_retries=3, breaker_failures=5, breaker_cooldown=60, acquire_timeout=30):
+        self.bucket = TokenBucket(rate_per_minute, burst, reserve)
+        self.max_retries = int(max_retries)
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.acquire_timeout = acquire_timeout
+        self.breakers = {}
+        self.lock = Lock()
+
+    def getBreaker(self, endpoint):
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(endpoint, self.breaker_failures, self.breaker_cooldown)
+            return self.breakers[endpoint]
+
+    def acquire(self, priority):
+        self.bucket.acquire(priority, self.acquire_timeout)
+
+
+##
+# Process-wide limiter
+
+_limiter = None
+_limiter_lock = Lock()
+
+def configure(config):
+    # Build the shared limiter from the defender config.yml settings
+    global _limiter
+    with _limiter_lock:
+        _limiter = RateLimiter(
+                rate_per_minute = config.get("NICEHASH_RATE_LIMIT", 60),
+                burst = config.get("NICEHASH_RATE_BURST", 10),
+                reserve = config.get("NICEHASH_ORDER_RESERVE", 2),
+                max_retries = config.get("NICEHASH_MAX_RETRIES", 3),
+                breaker_failures = config.get("NICEHASH_BREAKER_FAILURES", 5),
+                breaker_cooldown = config.get("NICEHASH_BREAKER_COOLDOWN", 60),
+            )
+    return _limiter
+
+def get_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import csv
+import copy
+import json
+import time
+import yaml
+import random
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+from history_store import MAGIC, RECORD
+from journal import Journal
+from nicehash_orderbook import OrderBookService, OrderBookSnapshot, OrderBookDepth, MarketStats
+from nicehash_sim import SimulatedNiceHash
+from grin51 import Grin51
+from grin_nicehash_defender import GrinNiceHashDefender
+
+
+##
+# Offline replay / backtesting
+#
+# Feeds recorded minute data through Grin51 detection and the defender order
+# management as fast as possible, with NiceHash replaced by an in-process
+# simulated market, and reports detection latency, false positives and BTC
+# spent for each scenario.
+#
+# Scenario rows are dicts with:
+#   ts (epoch seconds), grin_price, grin_speed,
+#   nh_eu_price, nh_eu_speed, nh_us_price, nh_us_speed,
+#   attack (optional 0/1 ground truth label)
+
+ALGO = "GRINCUCKATOO32"
+SERIES = ["grin_price", "grin_speed", "nh_eu_price", "nh_eu_speed", "nh_us_price", "nh_us_speed"]
+
+
+class ReplayClock():
+    def __init__(self):
+        self.now = datetime.fromtimestamp(0)
+
+    def __call__(self):
+        return self.now
+
+
+##
+# Scenario loaders
+
+def loadCsv(path):
+    rows = []
+    with open(path, "r") as f:
+        for line in csv.DictReader(f):
+            row = {}
+            ts = line["ts"]
+            try:
+                row["ts"] = float(ts)
+            except ValueError:
+                row["ts"] = datetime.fromisoformat(ts).timestamp()
+            for name in SERIES:
+                if line.get(name) not in [None, ""]:
+                    row[name] = float(line[name])
+            row["attack"] = line.get("attack") not in [None, "", "0", "false", "False"]
+            rows.append(row)
+    rows.sort(key=lambda r: r["ts"])
+    return rows
+
+# Build minute rows from the Grin51 GRIN51_HISTORY_DIR files
+def loadHistoryDir(path):
+    minutes = {}
+    for name in SERIES:
+        filename = os.path.join(path, "{}.hist".format(name))
+        if not os.path.exists(filename):
+            continue
+        with open(filename, "rb") as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise Exception("{} is not a history file".format(filename))
+        data = data[len(MAGIC):]
+        data = data[:len(data) - len(data) % RECORD.size]
+        for ts, value in RECORD.iter_unpack(data):
+            minute = int(ts // 60) * 60
+            minutes.setdefault(minute, {"ts": float(minute), "attack": False})[name] = value
+    return [minutes[m] for m in sorted(minutes.keys())]
+
+# Noisy market with injected attacks (price and available speed spike
+# on NiceHash well above what mining grin is worth) and optional one sample
+# orderbook glitches that should not be detected as attacks
+def syntheticScenario(days=30, attacks=3, attack_minutes=90, seed=0, glitches=0):
+    rnd = random.Random(seed)
+    count = int(days * 24 * 60)
+    start = time.time() - count * 60
+    attack_starts = sorted(rnd.sample(range(count // 10, count - attack_minutes), attacks))
+    glitch_at = set()
+    if glitches > 0:
+        glitch_at = set(rnd.sample([i for i in range(count // 10, count) if not any(a - 60 <= i < a + attack_minutes + 60 for a in attack_starts)], glitches))
+    rows = []
+    # Mean reverting noise around a fixed base so long scenarios dont drift
+    base = {"grin_price": 0.00004, "grin_speed": 12000.0, "nh_eu_price": 0.30, "nh_us_price": 0.31, "nh_eu_speed": 2.0, "nh_us_speed": 1.0}
+    noise = dict((name, 0.0) for name in base)
+    for i in range(count):
+        attack = any(a <= i < a + attack_minutes for a in attack_starts)
+        row = {"ts": start + i * 60, "attack": attack}
+        for name in base:
+            noise[name] = noise[name] * 0.98 + rnd.gauss(0, 0.01)
+            boost = 1.0
+            if name.startswith("nh_") and attack:
+                boost = 2.0
+            elif name.startswith("nh_") and i in glitch_at:
+                boost = 2.5
+            row[name] = base[name] * (1 + noise[name]) * boost
+        rows.append(row)
+    return rows
+
+
+##
+# Replay engine
+
+class Replay():
+    def __init__(self, config, logger=None, journal_dir=None):
+        self.config = config
+        self.journal_dir = journal_dir
+        if logger is not None:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger("gnd")
+
+    def run(self, rows, name="scenario"):
+        config = copy.deepcopy(self.config)
+        config["CHECK_TYPE"] = "grin51"
+        clock = ReplayClock()
+        sim = SimulatedNiceHash(pool_name=config["POOL_NAME"])
+        orderbook = OrderBookService(self.logger, [ALGO], nh_api=sim, clock=clock)
+        grin51 = Grin51(config["GRIN51_SCORE_THREASHOLD"], config["GRIN51_MIN_HISTORY"], config["GRIN51_MAX_HISTORY"], logger=self.logger, orderbook=orderbook, baseline_days=config.get("GRIN51_BASELINE_DAYS", 30), baseline_check=config.get("GRIN51_BASELINE_CHECK", False), score_function=config.get("GRIN51_SCORE_FUNCTION", "mean"), min_zscore=config.get("GRIN51_MIN_ZSCORE", 0))
+        grin51.createWatchers()
+        wake = []
+        grin51.scheduler.addListener(lambda under_attack: wake.append(under_attack))
+        defender = GrinNiceHashDefender(nh_api=sim, clock=clock)
+        defender.config = config
+        defender.nh_order_add_duration = timedelta(minutes=int(config["ADD_ORDER_DURATION"]))
+        defender.nh_pool_ids[ALGO] = sim.pool_id
+        defender.orderbook = orderbook
+        defender.grin51 = { ALGO: grin51 }
+        if self.journal_dir is not None:
+            defender.journal = Journal(self.journal_dir)
+
+        loop_interval = float(config["LOOP_INTERVAL"])
+        last_loop = None
+        incidents = []          # Labeled attack windows: [start_ts, end_ts, detected_ts]
+        detections = []         # Defender attack episodes: [start_ts, end_ts]
+        was_attack = False
+        was_detected = False
+        started = time.time()
+        for row in rows:
+            ts = row["ts"]
+            clock.now = datetime.fromtimestamp(ts)
+            # Ground truth incidents
+            if row.get("attack") and not was_attack:
+                incidents.append([ts, ts, None])
+            if row.get("attack"):
+                incidents[-1][1] = ts
+            was_attack = bool(row.get("attack"))
+            # Market state and data feeds
+            markets = {}
+            for market, key in [("EU", "eu"), ("USA", "us")]:
+                price = row.get("nh_{}_price".format(key))
+                speed = row.get("nh_{}_speed".format(key))
+                if price is not None and speed is not None:
+                    sim.setMarket(ALGO, market, price, speed)
+                    markets[market] = MarketStats(market=market, price=price, speed=speed)
+            if len(markets) > 0:
+                # Depth index of the simulated orderbooks, so ORDER_PRICING "depth" is replayed too
+                orderbooks = sim.getOrderBooks(ALGO)
+                for market, stats in markets.items():
+                    markets[market] = stats._replace(depth=OrderBookDepth(orderbooks[market]["orders"]))
+            sim.advance(ts)
+            # Grin51 scoring is driven by the scheduler as samples arrive
+            if "grin_price" in row:
+                grin51.grin_price.notify(grin51.grin_price.addSample(row["grin_price"], ts))
+            if "grin_speed" in row:
+                grin51.grin_speed.notify(grin51.grin_speed.addSample(row["grin_speed"], ts))
+            if len(markets) > 0:
+                orderbook.publish(OrderBookSnapshot(ALGO, markets, clock.now))
+            if grin51.getHistorySize() < grin51.min_history:
+                continue
+            grin51.scheduler.enable()
+            # Order management on the control loop cadence, or right away
+            # when the detection state changes
+            if len(wake) == 0 and last_loop is not None and ts - last_loop < loop_interval:
+                continue
+            del wake[:]
+            last_loop = ts
+            defender.checkForAttack()
+            defender.manageOrders()
+            detected = defender.isUnderAttack()
+            if detected and not was_detected:
+                detections.append([ts, ts])
+            if detected:
+                detections[-1][1] = ts
+                if was_attack and incidents[-1][2] is None:
+                    incidents[-1][2] = ts
+            was_detected = detected
+        elapsed = time.time() - started
+        if defender.journal is not None:
+            defender.journal.close()
+
+        # Score the run
+        latencies = [(i[2] - i[0]) / 60.0 for i in incidents if i[2] is not None]
+        false_positives = [d for d in detections if not any(i[0] <= d[0] <= i[1] for i in incidents)]
+        result = {
+                "scenario": name,
+                "samples": len(rows),
+                "replay_seconds": round(elapsed, 3),
+                "incidents": len(incidents),
+                "detected": len(latencies),
+                "missed": len(incidents) - len(latencies),
+                "detection_latency_minutes": latencies,
+                "false_positives": len(false_positives),
+                "false_positive_minutes": sum((d[1] - d[0]) / 60.0 + 1 for d in false_positives),
+                "orders_created": sim.calls.get("createOrder", 0),
+                "btc_spent": round(sim.spent, 8),
+            }
+        return result
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded data through Grin51 detection and order management")
+    parser.add_argument("scenarios", nargs="*", help="Scenario CSV files")
+    parser.add_argument("--history", action="append", default=[], help="Replay a GRIN51_HISTORY_DIR directory")
+    parser.add_argument("--synthetic", type=float, default=None, help="Replay a generated scenario of this many days")
+    parser.add_argument("--glitches", type=int, default=0, help="Add this many one sample orderbook glitches to the generated scenario")
+    parser.add_argument("--config", default="config.yml", help="Configuration file (default: config.yml)")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a config value, ex: --set GRIN51_SCORE_THREASHOLD=1.2")
+    parser.add_argument("--verbose", action="store_true", help="Show defender logging")
+    parser.add_argument("--journal", default=None, metavar="DIR", help="Write an audit journal of the replay to DIR (query it with journal.py)")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as c:
+        config = yaml.safe_load(c.read())[0]
+    for override in args.set:
+        key, value = override.split("=", 1)
+        config[key] = yaml.safe_load(value)
+    if not args.verbose:
+        logging.getLogger("gnd").setLevel(logging.CRITICAL)
+
+    scenarios = []
+    for path in args.scenarios:
+        scenarios.append((path, loadCsv(path)))
+    for path in args.history:
+        scenarios.append((path, loadHistoryDir(path)))
+    if args.synthetic is not None:
+        scenarios.append(("synthetic-{}d".format(args.synthetic), syntheticScenario(args.synthetic, glitches=args.glitches)))
+    if len(scenarios) == 0:
+        parser.error("Nothing to replay")
+
+    replay = Replay(config, journal_dir=args.journal)
+    for name, rows in scenarios:
+        print(json.dumps(replay.run(rows, name)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import math
+import time
+from array import array
+from collections import deque
+
+
+##
+# Fixed-capacity rolling window of (timestamp, value) samples
+#
+# Appending is O(1) and sum / mean / variance / min / max are maintained
+# incrementally, so reading stats does not walk the whole history.
+# Timestamps are epoch seconds (floats).
+#
+# Values and timestamps are kept as raw doubles in RecordRings rather than
+# as python float objects, 8 bytes per sample per column instead of 32+.
+# getValueViews / getTimeViews read the window without copying (one or two
+# memoryviews), getValueView / getTimeView as one memoryview, ex:
+# np.asarray(series.getValueView()) for analysis.
+
+
+# Fixed-capacity ring of fixed-width float records in one array('d')
+#
+# Reads never move records.  getViews() returns memoryviews into the array
+# itself: one, or two when the records wrap around the end of the ring.
+# getView() returns a single memoryview - into the array when the records
+# are contiguous, else over a copy.  A view into the array shows later
+# appends - copy it (list(), np.array()) to keep it.
+class RecordRing():
+    def __init__(self, capacity, width=1):
+        if capacity < 1:
+            raise Exception("RecordRing capacity must be at least 1")
+        self.capacity = int(capacity)
+        self.width = int(width)
+        self.data = array("d", bytes(self.capacity * self.width * 8))
+        self.head = 0        # Next record to write
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    # record is a float (width 1) or a sequence of width floats
+    def append(self, record):
+        if self.width == 1:
+            self.data[self.head] = record
+        else:
+            start = self.head * self.width
+            self.data[start:start + self.width] = array("d", record)
+        self.head = (self.head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    # Record i of the window (0 is the oldest, -1 the newest)
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if i < 0 or i >= self.size:
+            raise IndexError("RecordRing index out of range")
+        start = (self.head - self.size + i) % self.capacity * self.width
+        if self.width == 1:
+            return self.data[start]
+        return tuple(self.data[start:start + self.width])
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
+    def __reversed__(self):
+        for i in range(self.size - 1, -1, -1):
+            yield self[i]
+
+    # Flat memoryviews into the array of the newest n records (all by
+    # default), oldest first
+    def getParts(self, n=None):
+        n = self.size if n is None else max(0, min(n, self.size))
+        if n == 0:
+            return []
+        start = (self.head - n) % self.capacity
+        end = start + n
+        data = memoryview(self.data)
+        if end <= self.capacity:
+            return [data[start * self.width:end * self.width]]
+        return [data[start * self.width:], data[:(end - self.capacity) * self.width]]
+
+    # Flat view to shape [n] for width 1, else [n, width]
+    def shape(self, view):
+        count = len(view) // self.width
+        if self.width == 1 or count == 0:
+            return view
+        return view.cast("B").cast("d", [count, self.width])
+
+    # Zero-copy memoryviews of the newest n records, oldest first
+    def getViews(self, n=None):
+        return [self.shape(part) for part in self.getParts(n)]
+
+    # One memoryview of the newest n records, oldest first - copied when
+    # they wrap around the end of the ring
+    def getView(self, n=None):
+        parts = self.getParts(n)
+        if len(parts) == 1:
+            return self.shape(parts[0])
+        data = array("d")
+        for part in parts:
+            data.frombytes(part.cast("B"))
+        return self.shape(memoryview(data))
+
+    # The newest n records as a list, oldest first
+    def tolist(self, n=None):
+        return [record for view in self.getViews(n) for record in view.tolist()]
+
+    def getBytes(self):
+        return self.data.itemsize * len(self.data)
+
+
+class RollingSeries():
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise Exception("RollingSeries capacity must be at least 1")
+        self.capacity = int(capacity)
+        self.values = RecordRing(self.capacity)
+        self.times = RecordRing(self.capacity)
+        self.size = 0
+        self.count = 0       # Total samples ever appended
+        self.sum = 0.0
+        self.sumsq = 0.0
+        # Monotonic deques of (count, value) for the window min and max
+        self.mins = deque()
+        self.maxs = deque()
+
+    def append(self, value, ts=None):
+        value = float(value)
+        if ts is None:
+            ts = time.time()
+        if self.size == self.capacity:
+            old = self.values[0]
+            self.sum -= old
+            self.sumsq -= old * old
+        else:
+            self.size += 1
+        self.values.append(value)
+        self.times.append(float(ts))
+        self.count += 1
+        self.sum += value
+        self.sumsq += value * value
+        # Floating point drift builds up with add/subtract, so recompute
+        # exactly once per full turn of the buffer (still O(1) amortized)
+        if self.count % self.capacity == 0:
+            window = self.values.tolist()
+            self.sum = math.fsum(window)
+            self.sumsq = math.fsum(v * v for v in window)
+        # Maintain window min / max
+        oldest = self.count - self.size
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((self.count, value))
+        while self.mins[0][0] <= oldest:
+            self.mins.popleft()
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((self.count, value))
+        while self.maxs[0][0] <= oldest:
+            self.maxs.popleft()
+
+    def getSize(self):
+        return self.size
+
+    def getLast(self):
+        if self.size == 0:
+            raise IndexError("RollingSeries is empty")
+        return self.values[-1]
+
+    def getFirstTime(self):
+        if self.size == 0:
+            raise IndexError("RollingSeries is empty")
+        return self.times[0]
+
+    def getLastTime(self):
+        if self.size == 0:
+            raise IndexError("RollingSeries is empty")
+        return self.times[-1]
+
+    def getSum(self):
+        return self.sum
+
+    def getMean(self):
+        if self.size == 0:
+            raise ZeroDivisionError("RollingSeries is empty")
+        return self.sum / self.size
+
+    def getVariance(self):
+        # Population variance
+        mean = self.getMean()
+        return max(self.sumsq / self.size - mean * mean, 0.0)
+
+    def getStdDev(self):
+        return math.sqrt(self.getVariance())
+
+    def getMin(self):
+        if self.size == 0:
+            raise IndexError("RollingSeries is empty")
+        return self.mins[0][1]
+
+    def getMax(self):
+        if self.size == 0:
+            raise IndexError("RollingSeries is empty")
+        return self.maxs[0][1]
+
+    # The newest n values, oldest to newest
+    def getNewest(self, n):
+        return self.values.tolist(n)
+
+    # Oldest to newest
+    def getValues(self):
+        return self.values.tolist()
+
+    def getTimes(self):
+        return self.times.tolist()
+
+    # Zero-copy views of the newest n (all by default) values / timestamps,
+    # oldest to newest - two views when the window wraps around the ring
+    def getValueViews(self, n=None):
+        return self.values.getViews(n)
+
+    def getTimeViews(self, n=None):
+        return self.times.getViews(n)
+
+    # The same as one view each (a copy when the window wraps)
+    def getValueView(self, n=None):
+        return self.values.getView(n)
+
+    def getTimeView(self, n=None):
+        return self.times.getView(n)
+
+    def getBytes(self):
+        return self.values.getBytes() + self.times.getBytes()
+
+
+
+def main():
+    # A few tests
+    import random
+    series = RollingSeries(1440)
+    data = [random.random() for i in range(5000)]
+    for v in data:
+        series.append(v)
+    window = data[-1440:]
+    mean = sum(window) / len(window)
+    print("Size: {}".format(series.getSize()))
+    print("Mean: {} (expected {})".format(series.getMean(), mean))
+    print("Variance: {} (expected {})".format(series.getVariance(), sum((v - mean) ** 2 for v in window) / len(window)))
+    print("Min: {} (expected {})".format(series.getMin(), min(window)))
+    print("Max: {} (expected {})".format(series.getMax(), max(window)))
+    print("Values view: {} (expected {})".format(list(series.getValueView()) == window, True))
+    ring = RecordRing(3, 2)
+    for i in range(5):
+        ring.append((i, i * 10))
+    print("Records: {} (expected {})".format(ring.getView().tolist(), [[2.0, 20.0], [3.0, 30.0], [4.0, 40.0]]))
+
+if __name__ == "__main__":
+    main()
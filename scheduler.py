@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+from threading import Lock, Condition
+
+import metrics
+
+
+##
+# Event driven detection scheduler
+#
+# Watchers publish every new sample here.  As soon as every input has a
+# sample and they are all close enough in time to be a consistent set, the
+# detector is re-scored, and listeners are called right away when its
+# under_attack state changes (instead of waiting for the next control loop).
+#
+# With an AdaptiveSampler the inputs can be up to one (live) max polling
+# interval apart, so the allowed skew follows it.
+
+SKEW_INTERVALS = 2.5    # Allowed input skew in sampler max polling intervals
+
+SKIPPED = metrics.counter("gnd_detection_skipped_total", "Detection scorings skipped because the inputs were too far apart", ["detector"])
+
+class DetectionScheduler():
+    def __init__(self, logger, detector, inputs, max_skew=150, sampler=None, name="grin51"):
+        self.logger = logger
+        self.detector = detector     # Has checkForAttack() and under_attack
+        self.inputs = list(inputs)
+        self.max_skew = max_skew     # Seconds - max age difference between inputs, without a sampler
+        self.sampler = sampler
+        self.name = name
+        self.latest = {}             # { input name: ts of newest sample }
+        self.listeners = []
+        self.enabled = False
+        self.scores = 0
+        self.skipping = False        # Inputs were too far apart at the last publish
+        self.lock = Lock()
+
+    # callback(under_attack) is called on every detection state change
+    def addListener(self, callback):
+        self.listeners.append(callback)
+
+    # Dont score until the detector has enough history
+    def enable(self):
+        self.enabled = True
+
+    def getMaxSkew(self):
+        if self.sampler is not None:
+            return SKEW_INTERVALS * self.sampler.max_interval
+        return self.max_skew
+
+    def getSkew(self):
+        return max(self.latest.values()) - min(self.latest.values())
+
+    def isConsistent(self):
+        if any(name not in self.latest for name in self.inputs):
+            return False
+        return self.getSkew() <= self.getMaxSkew()
+
+    def publish(self, name, ts):
+        with self.lock:
+            self.latest[name] = ts
+            if not self.enabled or any(name not in self.latest for name in self.inputs):
+                return
+            if not self.isConsistent():
+                SKIPPED.inc(detector=self.name)
+                if not self.skipping:
+                    self.logger.warning("Skipping {} scoring until its inputs are within {:.0f}s of each other: {}".format(
+                            self.name, self.getMaxSkew(), ", ".join("{} {:.0f}s behind".format(n, max(self.latest.values()) - t) for n, t in sorted(self.latest.items()))))
+                self.skipping = True
+                return
+            if self.skipping:
+                self.logger.warning("Resuming {} scoring".format(self.name))
+                self.skipping = False
+            was_attack = self.detector.under_attack
+            try:
+                self.detector.checkForAttack()
+                self.scores += 1
+            except Exception as e:
+                self.logger.error("Error in DetectionScheduler scoring - {}".format(e))
+                return
+            under_attack = self.detector.under_attack
+        if under_attack != was_attack:
+            self.logger.warning("Detection state changed: under_attack={}".format(under_attack))
+            for callback in self.listeners:
+                try:
+                    callback(under_attack)
+                except Exception as e:
+                    self.logger.error("Error in DetectionScheduler listener - {}".format(e))
+
+
+##
+# Adaptive polling interval
+#
+# Pollers sleep slowly (max_interval) while the Grin51 scores are far below
+# the attack threashold and speed up towards min_interval as they approach
+# it.  An attack needs every score over the threashold, so the lowest score
+# is the one that decides how close an algo is.  Pollers are shared by every
+# algo, so the algo closest to an attack sets the interval.  The interval
+# never goes below what keeps all registered pollers together within
+# api_budget calls/minute.
+
+class AdaptiveSampler():
+    def __init__(self, threashold, min_interval=5, max_interval=60, approach=0.85, api_budget=None):
+        self.pollers = {}                  # { name: api calls per poll }
+        self.proximity = {}                # { algo: lowest score / threashold }
+        self.cond = Condition()
+        self.configure(threashold, min_interval, max_interval, approach, api_budget)
+
+    # Also called with new settings on a config reload
+    def configure(self, threashold, min_interval=5, max_interval=60, approach=0.85, api_budget=None):
+        with self.cond:
+            if hasattr(self, "threashold"):
+                # Keep the proximity relative to the new threashold
+                for algo in self.proximity:
+                    self.proximity[algo] *= self.threashold / float(threashold)
+            self.threashold = float(threashold)
+            self.min_interval = max(float(min_interval), 1.0)
+            self.max_interval = max(float(max_interval), self.min_interval)
+            self.approach = float(approach)    # Fraction of the threashold where speed-up starts
+            self.api_budget = api_budget       # Calls per minute for all pollers together
+            self.cond.notify_all()
+
+    def register(self, name, calls_per_poll=1):
+        with self.cond:
+            self.pollers[name] = calls_per_poll
+
+    # Called with the latest Grin51 scores of algo
+    def update(self, algo, scores):
+        with self.cond:
+            self.proximity[algo] = min(scores.values()) / self.threashold
+            # Wake sleeping pollers so they pick up a shorter interval now
+            self.cond.notify_all()
+
+    def getBudgetFloor(self):
+        if not self.api_budget:
+            return 0.0
+        return 60.0 * sum(self.pollers.values()) / float(self.api_budget)
+
+    def getProximity(self):
+        return max(self.proximity.values()) if self.proximity else 0.0
+
+    def getInterval(self):
+        proximity = self.getProximity()
+        if proximity <= self.approach:
+            interval = self.max_interval
+        elif proximity >= 1.0:
+            interval = self.min_interval
+        else:
+            fraction = (proximity - self.approach) / (1.0 - self.approach)
+            interval = self.max_interval - fraction * (self.max_interval - self.min_interval)
+        return max(interval, self.getBudgetFloor())
+
+    # Sleep one polling interval, cut short if the interval shrinks meanwhile
+    def sleep(self):
+        started = time.time()
+        with self.cond:
+            while True:
+                remaining = started + self.getInterval() - time.time()
+                if remaining <= 0:
+                    return
+                self.cond.wait(remaining)
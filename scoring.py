@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# numpy is optional - without it grin51 keeps the plain current / mean scores
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+##
+# Batched robust scoring for grin51
+#
+# Mirrors the history of a set of watchers into one numpy matrix (a row per
+# series, used as a ring buffer) and computes mean, median, MAD, robust
+# z-score, EWMA and rate of change for every series in one pass.  New
+# samples are copied in incrementally, EWMA is updated per sample, so an
+# evaluation is a few vectorized reductions over the matrix.  A lone sample
+# far outside the window is clipped before it goes into the EWMA.
+#
+# The score function (config.yml GRIN51_SCORE_FUNCTION) turns that batch
+# into the "x times normal" ratio the grin51 threashold is compared to.
+
+MAD_SCALE = 1.4826     # MAD to standard deviation for normally distributed data
+
+SCORE_FUNCTIONS = {}
+
+def scoreFunction(name):
+    def register(fn):
+        SCORE_FUNCTIONS[name] = fn
+        return fn
+    return register
+
+# Current value over the window mean (the original grin51 score)
+@scoreFunction("mean")
+def meanScore(batch):
+    return batch.current / batch.mean
+
+# Current value over the window median - one bad sample cant move the baseline
+@scoreFunction("median")
+def medianScore(batch):
+    return batch.current / batch.median
+
+# Smoothed recent value over the window median
+@scoreFunction("ewma")
+def ewmaScore(batch):
+    return batch.ewma / batch.median
+
+# Median of the last few samples over the window median - a single orderbook
+# glitch can move neither side
+@scoreFunction("robust")
+def robustScore(batch):
+    return batch.recent / batch.median
+
+
+# Row medians of a full matrix - one partition per row is several times
+# faster than np.median
+def rowMedian(values):
+    k = values.shape[1] // 2
+    part = np.partition(values, k, axis=1)
+    if values.shape[1] % 2 == 1:
+        return part[:, k]
+    return (part[:, :k].max(axis=1) + part[:, k]) / 2.0
+
+
+class ScoreBatch():
+    def __init__(self, current, recent, mean, median, mad, ewma, roc):
+        self.current = current
+        self.recent = recent    # Median of the current value and the newest samples
+        self.mean = mean
+        self.median = median
+        self.mad = mad
+        self.ewma = ewma
+        self.roc = roc      # Relative change over the last roc_lag samples
+        scale = MAD_SCALE * mad
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.zscore = np.where(scale > 0, (current - median) / scale, 0.0)
+
+
+class ScoringEngine():
+    def __init__(self, watchers, capacity, function="mean", halflife=5, roc_lag=5, recent=5, clip=5):
+        if np is None:
+            raise Exception("numpy is required for the grin51 scoring engine (pip install numpy)")
+        if function not in SCORE_FUNCTIONS:
+            raise Exception("Unknown score function {} - use one of {}".format(function, sorted(SCORE_FUNCTIONS)))
+        self.watchers = list(watchers)
+        self.index = dict((id(w), i) for i, w in enumerate(self.watchers))
+        self.capacity = int(capacity)
+        self.function = SCORE_FUNCTIONS[function]
+        self.alpha = 1.0 - 0.5 ** (1.0 / halflife)    # EWMA weight from the half-life in samples
+        self.roc_lag = int(roc_lag)
+        self.clip = clip        # A lone EWMA sample is clipped to median +/- clip * MAD_SCALE * MAD, None to disable
+        self.recent = int(recent)
+        count = len(self.watchers)
+        self.values = np.full((count, self.capacity), np.nan)
+        self.heads = np.zeros(count, dtype=np.int64)
+        self.sizes = np.zeros(count, dtype=np.int64)
+        self.synced = [0] * count      # series.count already copied
+        self.ewma = np.full(count, np.nan)
+        self.outside = [False] * count    # Last sample was outside the clip bounds
+        self.window_stats = None       # (mean, median, mad) until new samples arrive
+
+    def getIndex(self, watcher):
+        return self.index[id(watcher)]
+
+    # Samples outside the window median +/- clip robust standard deviations
+    # are glitches until the next sample is outside too
+    def getClipBounds(self):
+        low = np.full(len(self.watchers), -np.inf)
+        high = np.full(len(self.watchers), np.inf)
+        if self.clip is None:
+            return low, high
+        mean, median, mad = self.getWindowStats()
+        spread = self.clip * MAD_SCALE * mad
+        known = ~np.isnan(median) & ~np.isnan(spread)
+        low[known] = median[known] - spread[known]
+        high[known] = median[known] + spread[known]
+        return low, high
+
+    # Copy samples added to the watcher series since the last sync
+    def sync(self):
+        added = {}
+        for i, watcher in enumerate(self.watchers):
+            series = watcher.series
+            new = series.count - self.synced[i]
+            if new == 0:
+                continue
+            self.synced[i] = series.count
+            added[i] = series.getNewest(new)
+            for value in added[i]:
+                self.values[i, self.heads[i]] = value
+                self.heads[i] = (self.heads[i] + 1) % self.capacity
+            self.sizes[i] = min(self.sizes[i] + new, self.capacity)
+        if len(added) == 0:
+            return
+        self.window_stats = None
+        low, high = self.getClipBounds()
+        for i, values in added.items():
+            for value in values:
+                outside = not low[i] <= value <= high[i]
+                if outside and not self.outside[i]:
+                    # A lone orderbook glitch cant drag the EWMA along, a move that lasts can
+                    value = min(max(value, low[i]), high[i])
+                self.outside[i] = outside
+                if np.isnan(self.ewma[i]):
+                    self.ewma[i] = value
+                else:
+                    self.ewma[i] += self.alpha * (value - self.ewma[i])
+
+    # Window mean, median and MAD only change when samples are added
+    def getWindowStats(self):
+        if self.window_stats is not None:
+            return self.window_stats
+        values = self.values
+        if np.all(self.sizes == self.sizes[0]) and self.sizes[0] > 0:
+            # Every series equally full (the usual case) - still filling up
+            # means the samples are the first size slots
+            window = values[:, :self.sizes[0]] if self.sizes[0] < self.capacity else values
+            mean = window.mean(axis=1)
+            median = rowMedian(window)
+            mad = rowMedian(np.abs(window - median[:, None]))
+        else:
+            # Still filling up - the unused slots are nan
+            mean = np.nanmean(values, axis=1)
+            median = np.nanmedian(values, axis=1)
+            mad = np.nanmedian(np.abs(values - median[:, None]), axis=1)
+        self.window_stats = (mean, median, mad)
+        return self.window_stats
+
+    def evaluate(self):
+        self.sync()
+        current = np.array([w.getCurrent() for w in self.watchers], dtype=np.float64)
+        mean, median, mad = self.getWindowStats()
+        values = self.values
+        rows = np.arange(len(self.watchers))
+        lag = np.minimum(self.roc_lag, np.maximum(self.sizes, 1))
+        past = values[rows, (self.heads - lag) % self.capacity]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            roc = current / past - 1.0
+        # The current value with the newest history samples (nan while filling up)
+        newest = values[rows[:, None], (self.heads[:, None] - np.arange(1, self.recent)) % self.capacity]
+        if np.all(self.sizes >= self.recent - 1):
+            recent = np.median(np.column_stack([current, newest]), axis=1)
+        else:
+            recent = np.nanmedian(np.column_stack([current, newest]), axis=1)
+        return ScoreBatch(current, recent, mean, median, mad, self.ewma.copy(), roc)
+
+    # Score of every series: (scores array, batch)
+    def score(self):
+        batch = self.evaluate()
+        return self.function(batch), batch
+
+
+
+def main():
+    # A few tests
+    import time
+    import random
+    from timeseries import TieredSeries
+
+    class Watcher():
+        def __init__(self):
+            self.series = TieredSeries(1440)
+        def getCurrent(self):
+            return self.series.getLast()
+
+    watchers = [Watcher() for i in range(6)]
+    for i in range(2000):
+        for w in watchers:
+            w.series.append(1.0 + random.gauss(0, 0.02), i * 60)
+    # One wild orderbook glitch in the history of series 0
+    watchers[0].series.append(50.0, 2000 * 60)
+    watchers[0].series.append(1.0, 2001 * 60)
+    loops = 1000
+    for name in sorted(SCORE_FUNCTIONS):
+        engine = ScoringEngine(watchers, 1440, name)
+        scores, batch = engine.score()
+        started = time.time()
+        for i in range(loops):
+            engine.score()
+        cached = (time.time() - started) / loops * 1e6
+        print("{:<7} series 0 score {:.4f}, z {:.2f}, {:.1f}us per evaluation of {} series".format(
+                name, scores[0], batch.zscore[0], cached, len(watchers)))
+    # With a new sample in every series before each evaluation
+    started = time.time()
+    for i in range(loops):
+        for w in watchers:
+            w.series.append(1.0 + random.gauss(0, 0.02), (2002 + i) * 60)
+        engine.score()
+    print("new samples: {:.1f}us per append + evaluation of {} series".format((time.time() - started) / loops * 1e6, len(watchers)))
+
+if __name__ == "__main__":
+    main()
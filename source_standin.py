@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import time
+import random
+import argparse
+from threading import Thread, Lock
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+##
+# Local stand-in for a grin price / network hashrate provider
+#
+# Serves the CoinGecko price (/price -> {"grin": {"btc": ...}}) and GrinMint
+# networkStats (/networkStats -> {"hashrates": {"31": ..., "32": ...}})
+# response shapes, with injectable latency, slow tail responses and errors,
+# so several can stand in for the GRIN_PRICE_SOURCES / GRIN_SPEED_SOURCES
+# providers.
+
+class SourceStandIn():
+    def __init__(self, host="127.0.0.1", port=0, price=0.00004, hashrates=None,
+                 latency=0.0, jitter=0.0, tail_rate=0.0, tail_latency=1.0, error_rate=0.0):
+        self.price = price
+        self.hashrates = hashrates or { "31": 2.0, "32": 60.0 }
+        self.latency = latency            # Seconds added to every response
+        self.jitter = jitter              # Random extra seconds, 0..jitter
+        self.tail_rate = tail_rate        # Fraction of responses that take tail_latency instead
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate      # Fraction of requests answered with a 503
+        self.calls = 0
+        self.lock = Lock()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                standin.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def getUrl(self, path=""):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}{}".format(host, port, path)
+
+    def start(self):
+        self.thread = Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request):
+        with self.lock:
+            self.calls += 1
+        path = urlsplit(request.path).path
+        if random.random() < self.tail_rate:
+            time.sleep(self.tail_latency)
+        else:
+            time.sleep(self.latency + random.random() * self.jitter)
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            code, result = 503, {"error": "Injected error"}
+        elif path == "/price":
+            code, result = 200, {"grin": {"btc": self.price}}
+        elif path == "/networkStats":
+            code, result = 200, {"hashrates": self.hashrates}
+        else:
+            code, result = 404, {"error": "No such endpoint: {}".format(path)}
+        data = json.dumps(result).encode()
+        try:
+            request.send_response(code)
+            request.send_header("Content-Type", "application/json")
+            request.send_header("Content-Length", str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up (ex: a hedged request that lost)
+            pass
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local grin price / hashrate provider stand-ins")
+    parser.add_argument("--count", type=int, default=3, help="Number of providers to start")
+    parser.add_argument("--port", type=int, default=8770, help="Port of the first provider")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds of latency to add to every response")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="Fraction of responses that are slow")
+    parser.add_argument("--tail-latency", type=float, default=2.0, help="Seconds a slow response takes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests to fail")
+    args = parser.parse_args()
+    standins = []
+    for i in range(args.count):
+        standins.append(SourceStandIn(port=args.port + i, latency=args.latency, tail_rate=args.tail_rate,
+                                      tail_latency=args.tail_latency, error_rate=args.error_rate).start())
+    print("config.yml:")
+    print("  GRIN_PRICE_SOURCES:")
+    for i, s in enumerate(standins):
+        print('    - {{ name: "standin{}", url: "{}", path: "grin.btc" }}'.format(i, s.getUrl("/price")))
+    print("  GRIN_SPEED_SOURCES:")
+    for i, s in enumerate(standins):
+        print('    - {{ name: "standin{}", url: "{}", path: "hashrates.{{graph}}" }}'.format(i, s.getUrl("/networkStats")))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+import asyncio
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import http_transport
+import metrics
+
+
+##
+# Multi-provider data sources for the grin price and network hashrate
+#
+# A JsonSource reads one number out of one provider's json api.  A
+# MultiSource asks several providers for the same metric:
+#   "hedged": ask the fastest healthy provider first, and the next one each
+#             time hedge_delay passes (or a provider fails) without an
+#             answer - the first good answer wins
+#   "median": ask every provider at once, use the median of the answers
+#             that arrive within the timeout
+# so a slow or failing provider neither stalls nor stops the watcher.
+# Latency and freshness are tracked per provider.  fetch() runs the
+# providers in threads, fetchAsync() runs them as coroutines on the asyncio
+# runtime's HTTP session.
+
+SOURCE_LATENCY = metrics.histogram("gnd_source_latency_seconds", "Data source fetch latency", ["source"])
+SOURCE_FETCHES = metrics.counter("gnd_source_fetch_total", "Data source fetches", ["source", "result"])
+SOURCE_LAST_OK = metrics.gauge("gnd_source_last_success_timestamp", "Time of the last good answer from a data source", ["source"])
+
+LATENCY_WEIGHT = 0.3      # EWMA weight of the newest latency sample
+
+# Used when config.yml has no GRIN_PRICE_SOURCES / GRIN_SPEED_SOURCES
+DEFAULT_SOURCES = {
+        "grin_price": [
+                { "name": "coingecko", "url": "https://api.coingecko.com/api/v3/simple/price?ids=grin&vs_currencies=btc", "path": "grin.btc" },
+            ],
+        "grin_speed": [
+                { "name": "grinmint", "url": "https://api.grinmint.com/v2/networkStats", "path": "hashrates.{graph}" },
+            ],
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class JsonSource():
+    def __init__(self, name, url, path):
+        self.name = name
+        self.url = url
+        self.path = [key for key in path.split(".") if key != ""]
+        self.latency = None       # EWMA seconds
+        self.last_ok = None
+        self.failures = 0         # Consecutive
+        self.lock = Lock()
+
+    def parse(self, data):
+        for key in self.path:
+            if isinstance(data, list):
+                data = data[int(key)]
+            else:
+                data = data[key]
+        return float(data)
+
+    def fetch(self):
+        started = time.time()
+        try:
+            r = http_transport.get_transport().get(self.url)
+            r.raise_for_status()
+            value = self.parse(r.json())
+        except Exception:
+            self.record(time.time() - started, False)
+            raise
+        self.record(time.time() - started, True)
+        return value
+
+    # get_json(url) is a coroutine returning the parsed response
+    async def fetchAsync(self, get_json):
+        started = time.time()
+        try:
+            value = self.parse(await get_json(self.url))
+        except Exception:
+            self.record(time.time() - started, False)
+            raise
+        self.record(time.time() - started, True)
+        return value
+
+    def record(self, latency, ok):
+        SOURCE_LATENCY.observe(latency, source=self.name)
+        SOURCE_FETCHES.inc(source=self.name, result="ok" if ok else "error")
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_WEIGHT * (latency - self.latency)
+            if ok:
+                self.failures = 0
+                self.last_ok = time.time()
+                SOURCE_LAST_OK.set(self.last_ok, source=self.name)
+            else:
+                self.failures += 1
+
+    def getStats(self):
+        return {
+                "latency": None if self.latency is None else round(self.latency, 3),
+                "age": None if self.last_ok is None else round(time.time() - self.last_ok, 1),
+                "failures": self.failures,
+            }
+
+
+class MultiSource():
+    def __init__(self, name, sources, mode="hedged", hedge_delay=1.0, timeout=10.0):
+        if mode not in ["hedged", "median"]:
+            raise Exception("Unknown source mode {} - use hedged or median".format(mode))
+        if len(sources) == 0:
+            raise Exception("No sources for {}".format(name))
+        self.name = name
+        self.sources = list(sources)
+        self.mode = mode
+        self.hedge_delay = float(hedge_delay)
+        self.timeout = float(timeout)
+        # Losing hedged requests finish in the background
+        self.executor = ThreadPoolExecutor(max_workers=2 * len(self.sources), thread_name_prefix="source_{}".format(name))
+
+    # New hedge delay / timeout on a config reload
+    def configure(self, hedge_delay, timeout):
+        self.hedge_delay = float(hedge_delay)
+        self.timeout = float(timeout)
+
+    # Api calls made per fetch (for the polling budget)
+    def getCallsPerFetch(self):
+        return len(self.sources) if self.mode == "median" else 1
+
+    def fetch(self):
+        if len(self.sources) == 1:
+            return self.sources[0].fetch()
+        if self.mode == "median":
+            return self.fetchMedian()
+        return self.fetchHedged()
+
+    # Healthy providers first, fastest first (config order until measured)
+    def getOrder(self):
+        return sorted(self.sources, key=lambda s: (s.failures > 0, s.latency if s.latency is not None else 0.0))
+
+    def fetchHedged(self):
+        deadline = time.time() + self.timeout
+        waiting = list(self.getOrder())
+        pending = set()
+        error = None
+        while True:
+            if len(waiting) > 0:
+                pending.add(self.executor.submit(waiting.pop(0).fetch))
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # Give the pending requests hedge_delay before asking one more provider
+            done, pending = wait(pending, timeout=min(self.hedge_delay, remaining) if len(waiting) > 0 else remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+            if len(pending) == 0 and len(waiting) == 0:
+                break
+        raise Exception("No {} source answered: {}".format(self.name, error if error is not None else "timed out"))
+
+    def fetchMedian(self):
+        futures = [self.executor.submit(s.fetch) for s in self.sources]
+        done, pending = wait(futures, timeout=self.timeout)
+        values = []
+        error = None
+        for future in done:
+            try:
+                values.append(future.result())
+            except Exception as e:
+                error = e
+        if len(values) == 0:
+            raise Exception("No {} source answered: {}".format(self.name, error if error is not None else "timed out"))
+        return median(values)
+
+    async def fetchAsync(self, get_json):
+        if len(self.sources) == 1:
+            return await self.sources[0].fetchAsync(get_json)
+        if self.mode == "median":
+            return await self.fetchMedianAsync(get_json)
+        return await self.fetchHedgedAsync(get_json)
+
+    # Same as fetchHedged - the losing requests are canceled
+    async def fetchHedgedAsync(self, get_json):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        waiting = list(self.getOrder())
+        pending = set()
+        error = None
+        try:
+            while True:
+                if len(waiting) > 0:
+                    pending.add(asyncio.ensure_future(waiting.pop(0).fetchAsync(get_json)))
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=min(self.hedge_delay, remaining) if len(waiting) > 0 else remaining, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        error = e
+                if len(pending) == 0 and len(waiting) == 0:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+        raise Exception("No {} source answered: {}".format(self.name, error if error is not None else "timed out"))
+
+    async def fetchMedianAsync(self, get_json):
+        futures = [asyncio.ensure_future(s.fetchAsync(get_json)) for s in self.sources]
+        done, pending = await asyncio.wait(futures, timeout=self.timeout)
+        for future in pending:
+            future.cancel()
+        values = []
+        error = None
+        for future in done:
+            try:
+                values.append(future.result())
+            except Exception as e:
+                error = e
+        if len(values) == 0:
+            raise Exception("No {} source answered: {}".format(self.name, error if error is not None else "timed out"))
+        return median(values)
+
+    def getStats(self):
+        return dict((s.name, s.getStats()) for s in self.sources)
+
+
+# MultiSource for a metric ("grin_price" or "grin_speed") from config.yml
+# GRIN_PRICE_SOURCES / GRIN_SPEED_SOURCES.  "{graph}" in a path is the
+# cuckoo graph size.
+def build(metric, config, graph="32"):
+    configured = config.get("GRIN_PRICE_SOURCES" if metric == "grin_price" else "GRIN_SPEED_SOURCES") or DEFAULT_SOURCES[metric]
+    sources = []
+    for source in configured:
+        name = source["name"] if metric == "grin_price" else "{}_c{}".format(source["name"], graph)
+        sources.append(JsonSource(name, source["url"], source["path"].format(graph=graph)))
+    return MultiSource(
+            metric if metric == "grin_price" else "{}_c{}".format(metric, graph),
+            sources,
+            mode = config.get("SOURCE_MODE", "hedged"),
+            hedge_delay = config.get("SOURCE_HEDGE_DELAY", 1.0),
+            timeout = config.get("SOURCE_TIMEOUT", 10),
+        )
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+import struct
+from itertools import chain
+
+from rolling import RollingSeries, RecordRing
+
+
+##
+# Multi-resolution time series
+#
+# The newest samples are kept raw (a RollingSeries), and every sample is
+# also folded into fixed-size rollup buckets - by default 5 minute buckets
+# for a week and hourly buckets for 30 days.  Each bucket is
+# (start, count, sum, min, max, last), so memory stays bounded however long
+# the history is, and window queries read the finest tier that still
+# covers the window.  Closed buckets are kept as raw doubles in a
+# RecordRing (48 bytes each, see rolling.py).
+
+# On-disk rollup records (see HistoryStore)
+ROLLUP_MAGIC = b"GNDROLL1"
+ROLLUP_RECORD = struct.Struct("<dddddd")
+ROLLUP_FIELDS = ("start", "count", "sum", "min", "max", "last")
+
+DAY = 24 * 60 * 60
+
+
+# Default tiers: [(resolution seconds, buckets kept), ...] finest first
+def defaultTiers(baseline_days=30):
+    return [(300, 7 * DAY // 300), (3600, int(baseline_days) * DAY // 3600)]
+
+def percentile(values, pct):
+    values = sorted(values)
+    if len(values) == 0:
+        raise IndexError("No values in window")
+    index = min(int(round(pct / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class Rollup():
+    def __init__(self, resolution, capacity):
+        self.resolution = int(resolution)
+        self.capacity = int(capacity)
+        self.buckets = RecordRing(self.capacity, len(ROLLUP_FIELDS))   # Closed buckets, oldest first
+        self.current = None        # Open bucket [start, count, sum, min, max, last]
+        self.closed_until = None   # End of the newest closed bucket
+        self.count = 0             # Samples in the closed buckets
+        self.sum = 0.0
+        self.store = None
+
+    def add(self, value, ts):
+        # Already rolled up (ex: raw history reloaded after the rollups)
+        if self.closed_until is not None and ts < self.closed_until:
+            return
+        start = ts - ts % self.resolution
+        if self.current is not None and start != self.current[0]:
+            if start < self.current[0]:
+                # Out of order sample for a bucket that is already done
+                return
+            self.close()
+        if self.current is None:
+            self.current = [start, 0, 0.0, value, value, value]
+        bucket = self.current
+        bucket[1] += 1
+        bucket[2] += value
+        bucket[3] = min(bucket[3], value)
+        bucket[4] = max(bucket[4], value)
+        bucket[5] = value
+
+    def close(self):
+        bucket = tuple(self.current)
+        self.current = None
+        self.push(bucket)
+        if self.store is not None:
+            self.store.appendRecord(bucket)
+
+    def push(self, bucket):
+        if len(self.buckets) == self.capacity:
+            oldest = self.buckets[0]
+            self.count -= oldest[1]
+            self.sum -= oldest[2]
+        self.buckets.append(bucket)
+        self.count += bucket[1]
+        self.sum += bucket[2]
+        self.closed_until = bucket[0] + self.resolution
+
+    # Reload closed buckets from a rollup HistoryStore and keep writing to it
+    def setStore(self, store, max_age=None):
+        for bucket in store.load(max_age):
+            self.push(tuple(bucket))
+        self.store = store
+        return len(self.buckets)
+
+    # Mean of everything in this tier - O(1)
+    def getMean(self):
+        count = self.count
+        total = self.sum
+        if self.current is not None:
+            count += self.current[1]
+            total += self.current[2]
+        if count == 0:
+            raise ZeroDivisionError("Rollup is empty")
+        return total / count
+
+    def getOldest(self):
+        if len(self.buckets) > 0:
+            return self.buckets[0][0]
+        if self.current is not None:
+            return self.current[0]
+        return None
+
+    # [buckets, 6] views of the closed buckets, oldest first (see RecordRing)
+    def getViews(self):
+        return self.buckets.getViews()
+
+    def getView(self):
+        return self.buckets.getView()
+
+    # Buckets starting at or after start, oldest first (open bucket included)
+    def getBuckets(self, start):
+        found = []
+        if self.current is not None and self.current[0] >= start:
+            found.append(tuple(self.current))
+        for bucket in reversed(self.buckets):
+            if bucket[0] < start:
+                break
+            found.append(bucket)
+        found.reverse()
+        return found
+
+
+class TieredSeries(RollingSeries):
+    def __init__(self, capacity, tiers=None):
+        super().__init__(capacity)
+        self.rollups = [Rollup(resolution, buckets) for resolution, buckets in (tiers or [])]
+
+    def append(self, value, ts=None):
+        if ts is None:
+            ts = time.time()
+        super().append(value, ts)
+        value = float(value)
+        for rollup in self.rollups:
+            rollup.add(value, ts)
+
+    def getRollup(self, resolution):
+        for rollup in self.rollups:
+            if rollup.resolution == resolution:
+                return rollup
+        return None
+
+    # Samples in the last window seconds as buckets, from the finest tier
+    # that reaches back far enough (else the one reaching back furthest)
+    def getWindow(self, window, now=None):
+        if now is None:
+            now = time.time()
+        start = now - window
+        if self.getSize() > 0 and (self.getFirstTime() <= start or len(self.rollups) == 0):
+            return self.getRawBuckets(start)
+        best = None
+        for rollup in self.rollups:
+            oldest = rollup.getOldest()
+            if oldest is None:
+                continue
+            if oldest <= start:
+                return rollup.getBuckets(start - start % rollup.resolution)
+            if best is None or oldest < best.getOldest():
+                best = rollup
+        if best is None:
+            return self.getRawBuckets(start)
+        return best.getBuckets(start)
+
+    # Raw samples since start as single sample buckets
+    def getRawBuckets(self, start):
+        return [(ts, 1, v, v, v, v) for ts, v in zip(chain(*self.getTimeViews()), chain(*self.getValueViews())) if ts >= start]
+
+    def getWindowMean(self, window, now=None):
+        buckets = self.getWindow(window, now)
+        count = sum(b[1] for b in buckets)
+        if count == 0:
+            raise ZeroDivisionError("No samples in window")
+        return sum(b[2] for b in buckets) / count
+
+    # Percentile of the samples (raw tier) or of the bucket means (rollup tiers)
+    def getWindowPercentile(self, pct, window, now=None):
+        return percentile([b[2] / b[1] for b in self.getWindow(window, now)], pct)
+
+    def getWindowMin(self, window, now=None):
+        return min(b[3] for b in self.getWindow(window, now))
+
+    def getWindowMax(self, window, now=None):
+        return max(b[4] for b in self.getWindow(window, now))
+
+    # Mean over the longest (coarsest) tier, ex: the 30 day baseline - O(1)
+    def getBaselineMean(self):
+        if len(self.rollups) == 0:
+            return self.getMean()
+        return self.rollups[-1].getMean()
+
+    # Seconds of history held (oldest sample in any tier until now)
+    def getSpan(self, now=None):
+        if now is None:
+            now = time.time()
+        oldest = [r.getOldest() for r in self.rollups if r.getOldest() is not None]
+        if self.getSize() > 0:
+            oldest.append(self.getFirstTime())
+        if len(oldest) == 0:
+            return 0.0
+        return now - min(oldest)
+
+    # Bytes held by the raw window and all rollup tiers
+    def getBytes(self):
+        return super().getBytes() + sum(r.buckets.getBytes() for r in self.rollups)
+
+
+
+def main():
+    # A few tests
+    import random
+    series = TieredSeries(4 * 60, defaultTiers(30))
+    now = time.time()
+    start = now - 40 * DAY
+    data = []
+    for i in range(40 * 24 * 60):
+        value = 1.0 + 0.1 * random.random()
+        series.append(value, start + i * 60)
+        data.append((start + i * 60, value))
+    for window in [3600, DAY, 7 * DAY, 30 * DAY]:
+        expected = [v for ts, v in data if ts >= now - window]
+        print("{:>8}s: mean {:.5f} (expected {:.5f}), p95 {:.5f}, buckets {}".format(
+                window, series.getWindowMean(window, now), sum(expected) / len(expected),
+                series.getWindowPercentile(95, window, now), len(series.getWindow(window, now))))
+    print("Baseline mean: {:.5f}".format(series.getBaselineMean()))
+    print("Rollup buckets held: {}".format([len(r.buckets) for r in series.rollups]))
+
+if __name__ == "__main__":
+    main()